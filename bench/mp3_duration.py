@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare MP3 duration by frame headers (mp3info) with pymad.
+
+Usage: python mp3_duration.py [--repeat N] file.mp3 [file.mp3 ...]
+
+For every file this prints the duration each method reports and the mean
+time it took. pymad is optional; without it only mp3info is timed.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import mp3info
+
+try:
+    import mad
+except ImportError:
+    mad = None
+
+
+def time_call(func, repeat):
+    result = None
+    start = time.time()
+    for i in range(repeat):
+        result = func()
+    return result, (time.time() - start) / repeat
+
+
+def mad_duration(path):
+    return mad.MadFile(path).total_time()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MP3 duration benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args()
+
+    print("%-30s %10s %8s %10s %10s %10s %8s" % ("file", "size MB", "method",
+          "header ms", "header s", "mad ms", "mad s"))
+    for path in args.files:
+        size_mb = os.path.getsize(path) / 1024.0 / 1024.0
+        info, header_time = time_call(lambda: mp3info.analyse(path), args.repeat)
+        if mad != None:
+            mad_ms, mad_time = time_call(lambda: mad_duration(path), args.repeat)
+            mad_cols = "%10d %8.4f" % (mad_ms, mad_time)
+        else:
+            mad_cols = "%10s %8s" % ("-", "-")
+        print("%-30s %10.2f %8s %10d %10.4f %s" % (os.path.basename(path)[:30],
+              size_mb, info.method, info.duration_ms, header_time, mad_cols))
+
+
+if __name__ == "__main__":
+    main()
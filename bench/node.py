@@ -0,0 +1,468 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks for a whole node, simulated with the stub IRLP tree.
+
+Usage: python node.py [--quick] [--output results.json] [--compare old.json]
+
+A throwaway copy of testirlp/ is made next to an empty config and files
+directory, and the Radio, Player (playing into an engine.NullSink) and
+Scheduler are started against it just as server.py wires them up. Then:
+
+  tick       the cost of one run of the main ticker, idle and with status
+             listeners connected
+  http       requests per second and latency for /radio/status and
+             /schedule/list at several numbers of concurrent clients
+  scheduler  bulk import, single adds and deletes, listing, timeline
+             queries, re-arming and reloading from disk at 10, 1k and 100k
+             schedules (--quick stops at 1k)
+  duration   AudioFile.duration calls per second for indexed and unindexed
+             files
+
+Results are written as JSON along with the git revision, so a run can be
+compared with one from another revision using --compare.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from datetime import datetime, timedelta
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(REPO, "src"))
+
+import twisted
+from twisted.internet import defer, reactor, task, threads
+from twisted.web import resource, server
+
+import control
+import engine
+import inputs
+import library
+import playback
+import radio
+import scheduler
+import status
+import web
+
+SAMPLE_RATE = 8000
+AUDIO_FILES = 16
+AUDIO_SECONDS = 30
+
+
+class Services(object):
+    pass
+
+
+def summary(samples):
+    """Returns count, mean and percentiles of timings in seconds, as ms."""
+    ordered = sorted(samples)
+    if not ordered:
+        return {"count": 0}
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000.0
+
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) * 1000.0 / len(ordered),
+        "p50_ms": percentile(0.50),
+        "p99_ms": percentile(0.99),
+        "max_ms": ordered[-1] * 1000.0,
+    }
+
+
+def timed(func, repeat):
+    """Returns the mean seconds per call of func over repeat calls."""
+    started = time.time()
+    for i in range(repeat):
+        func()
+    return (time.time() - started) / repeat
+
+
+def write_wave(path, seconds):
+    w = wave.open(path, "wb")
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(SAMPLE_RATE)
+    w.writeframes(b"\0\0" * (SAMPLE_RATE * seconds))
+    w.close()
+
+
+def make_node(root):
+    """Lays out a node under root and returns the directory to run from.
+
+    The layout matches a checkout: src/ is the working directory and the
+    stub IRLP scripts find their state in ../testirlp/local.
+    """
+    shutil.copytree(os.path.join(REPO, "testirlp"),
+                    os.path.join(root, "testirlp"))
+    for directory in ("src", "config", "files", "unindexed"):
+        os.makedirs(os.path.join(root, directory))
+    for i in range(AUDIO_FILES):
+        name = "bench-%02d.wav" % i
+        write_wave(os.path.join(root, "files", name), AUDIO_SECONDS)
+        write_wave(os.path.join(root, "unindexed", name), AUDIO_SECONDS)
+    return os.path.join(root, "src")
+
+
+def start_services():
+    # Runs in the reactor thread, wired up as in server.py without renders,
+    # which would need sox
+    s = Services()
+    s.library = library.MetadataIndex("../files/", "../config/metadata.dat")
+    library.set_default_index(s.library)
+    s.runner = control.CommandRunner(max_concurrent=2)
+    s.radio = radio.Radio("../testirlp",
+                          inputs.BinInputs("../testirlp",
+                                           control.CommandRunner(max_concurrent=2)),
+                          runner=s.runner)
+    s.player = playback.Player(
+        s.radio, None, engine.AudioEngine(sink_factory=engine.NullSink))
+    s.scheduler = scheduler.Scheduler(s.player, s.radio, s.library)
+    s.status = status.StatusPublisher(s)
+    d = s.library.rescan()
+    d.addCallback(lambda _: s)
+    return d
+
+
+def top_ticker(s):
+    # The body of server.top_ticker, which can't be imported without
+    # starting the server
+    s.radio.tick()
+    s.player.tick()
+    s.status.tick()
+
+
+def schedule_json(index, filename):
+    start = datetime.now() + timedelta(days=1, minutes=10 * index)
+    return {
+        "date": start.strftime("%d/%m/%Y"),
+        "time": start.strftime("%I:%M:%S %p"),
+        "playlist": [filename],
+    }
+
+
+# Benchmarks. Functions taking s run in the reactor thread.
+
+def measure_ticks(s, count, interval, listeners):
+    callbacks = [lambda message: None for i in range(listeners)]
+    for callback in callbacks:
+        s.status.subscribe(callback)
+    samples = []
+
+    def tick():
+        started = time.time()
+        top_ticker(s)
+        samples.append(time.time() - started)
+        if len(samples) >= count:
+            loop.stop()
+
+    def done(_):
+        for callback in callbacks:
+            s.status.unsubscribe(callback)
+        return summary(samples)
+
+    loop = task.LoopingCall(tick)
+    d = loop.start(interval)
+    d.addCallback(done)
+    return d
+
+
+def bench_ticks(s, quick):
+    count = 200 if quick else 2000
+    results = {}
+    for name, listeners in (("idle", 0), ("listeners", 20)):
+        results[name] = threads.blockingCallFromThread(
+            reactor, measure_ticks, s, count, 0.01, listeners)
+    return results
+
+
+def start_site(s):
+    root = resource.Resource()
+    root.putChild(b"radio", web.RadioController(s))
+    root.putChild(b"schedule", web.ScheduleController(s))
+    site = server.Site(root)
+    site.requestFactory = web.TimedRequest
+    return reactor.listenTCP(0, site, interface="127.0.0.1")
+
+
+def http_clients(port, path, clients, seconds):
+    """Requests path from clients threads for seconds; returns the results."""
+    latencies = [[] for i in range(clients)]
+    errors = [0]
+    deadline = time.time() + seconds
+
+    def client(samples):
+        conn = httplib.HTTPConnection("127.0.0.1", port, timeout=10)
+        while time.time() < deadline:
+            started = time.time()
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors[0] += 1
+                    continue
+            except Exception:
+                errors[0] += 1
+                conn.close()
+                conn = httplib.HTTPConnection("127.0.0.1", port, timeout=10)
+                continue
+            samples.append(time.time() - started)
+        conn.close()
+
+    workers = [threading.Thread(target=client, args=(samples,))
+               for samples in latencies]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - started
+    samples = [sample for samples in latencies for sample in samples]
+    result = summary(samples)
+    result["requests_per_second"] = len(samples) / elapsed
+    result["errors"] = errors[0]
+    return result
+
+
+def bench_http(s, quick):
+    filenames = s.library.filenames()
+    threads.blockingCallFromThread(
+        reactor, s.scheduler.add_schedules,
+        [schedule_json(i, filenames[i % len(filenames)]) for i in range(200)])
+    port = threads.blockingCallFromThread(reactor, start_site, s)
+    seconds = 1.0 if quick else 3.0
+    results = {}
+    try:
+        for name, path in (("radio/status", "/radio/status"),
+                           ("schedule/list", "/schedule/list?limit=50")):
+            results[name] = {}
+            for clients in (1, 8, 32):
+                results[name][str(clients)] = http_clients(
+                    port.getHost().port, path, clients, seconds)
+    finally:
+        threads.blockingCallFromThread(reactor, port.stopListening)
+    return results
+
+
+def scheduler_at(s, size):
+    for name in ("schedule.dat", "schedule.dat.journal", "archive.dat"):
+        path = os.path.join("..", "config", name)
+        if os.path.exists(path):
+            os.remove(path)
+    filenames = s.library.filenames()
+    schedules = [schedule_json(i, filenames[i % len(filenames)])
+                 for i in range(size)]
+    sched = scheduler.Scheduler(s.player, s.radio, s.library)
+    result = {}
+
+    started = time.time()
+    sched.add_schedules(schedules)
+    result["import_us_per_item"] = (time.time() - started) * 1e6 / size
+
+    extra = [schedule_json(size + i, filenames[0]) for i in range(100)]
+    identifiers = []
+    started = time.time()
+    for json_dict in extra:
+        identifiers.append(sched.add_new_schedule(json_dict))
+    result["add_ms"] = (time.time() - started) * 1000.0 / len(extra)
+    started = time.time()
+    sched.flush()
+    result["flush_ms"] = (time.time() - started) * 1000.0
+    started = time.time()
+    for identifier in identifiers:
+        sched.delete_schedule(identifier)
+    result["delete_ms"] = (time.time() - started) * 1000.0 / len(identifiers)
+    sched.flush()
+
+    now = datetime.now()
+    result["list_ms"] = timed(lambda: sched.query("upcoming", limit=50),
+                              20) * 1000.0
+    result["timeline_ms"] = timed(
+        lambda: sched.timeline(now, now + timedelta(days=2)), 20) * 1000.0
+    # What each change costs in keeping the next wakeup armed
+    result["arm_ms"] = timed(sched._arm, 100) * 1000.0
+
+    started = time.time()
+    reloaded = scheduler.Scheduler(s.player, s.radio, s.library)
+    result["load_ms"] = (time.time() - started) * 1000.0
+    if len(reloaded.items()) != size:
+        raise RuntimeError("Reloaded %d schedules, expected %d" %
+                           (len(reloaded.items()), size))
+    size_bytes = 0
+    for name in ("schedule.dat", "schedule.dat.journal"):
+        path = os.path.join("..", "config", name)
+        if os.path.exists(path):
+            size_bytes += os.path.getsize(path)
+    result["bytes_on_disk"] = size_bytes
+    return result
+
+
+def bench_scheduler(s, quick):
+    sizes = (10, 1000) if quick else (10, 1000, 100000)
+    results = {}
+    for size in sizes:
+        print("  %d schedules" % size)
+        results[str(size)] = threads.blockingCallFromThread(
+            reactor, scheduler_at, s, size)
+    return results
+
+
+def durations(s, quick):
+    repeat = 200 if quick else 2000
+    indexed = [playback.AudioFile(s.library.path(f))
+               for f in s.library.filenames()]
+    unindexed_dir = os.path.join("..", "unindexed")
+    unindexed = [playback.AudioFile(os.path.join(unindexed_dir, f))
+                 for f in sorted(os.listdir(unindexed_dir))]
+    for audio_file in indexed + unindexed:
+        if abs(audio_file.duration() - AUDIO_SECONDS) > 0.1:
+            raise RuntimeError("%s has duration %f" %
+                               (audio_file, audio_file.duration()))
+
+    def per_second(files, repeat):
+        seconds = timed(lambda: [f.duration() for f in files], repeat)
+        return len(files) / seconds
+
+    return {
+        "indexed_per_second": per_second(indexed, repeat),
+        "unindexed_per_second": per_second(unindexed, max(1, repeat // 20)),
+    }
+
+
+def bench_durations(s, quick):
+    return threads.blockingCallFromThread(reactor, durations, s, quick)
+
+
+BENCHMARKS = (("tick", bench_ticks), ("http", bench_http),
+              ("scheduler", bench_scheduler), ("duration", bench_durations))
+
+
+# Reporting
+
+def revision():
+    """Returns (commit, dirty) for the checkout, or (None, None)."""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         cwd=REPO).decode().strip()
+        changes = subprocess.check_output(["git", "status", "--porcelain"],
+                                          cwd=REPO)
+        return commit, bool(changes.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def flatten(results, prefix=""):
+    """Returns {"a.b.c": number} for every number in nested results."""
+    flat = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(old, new):
+    old_flat = flatten(old["results"])
+    new_flat = flatten(new["results"])
+    print("%-50s %12s %12s %8s" % ("", old.get("revision", "")[:12] or "old",
+                                   (new.get("revision") or "")[:12] or "new",
+                                   "change"))
+    for name in sorted(set(old_flat) & set(new_flat)):
+        if name.endswith(".count") or name.endswith(".errors"):
+            continue
+        before, after = old_flat[name], new_flat[name]
+        if before:
+            change = "%+7.1f%%" % ((after - before) * 100.0 / before)
+        else:
+            change = "-"
+        print("%-50s %12.3f %12.3f %8s" % (name, before, after, change))
+
+
+def run(args, results):
+    s = threads.blockingCallFromThread(reactor, start_services)
+    for name, bench in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        print("Running %s" % name)
+        results[name] = bench(s, args.quick)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated node benchmarks")
+    parser.add_argument("--quick", action="store_true",
+                        help="fewer samples and no 100k schedule run")
+    parser.add_argument("--only", nargs="+",
+                        choices=[name for name, bench in BENCHMARKS])
+    parser.add_argument("--output", help="JSON results file, by default "
+                        "node-<revision>.json in the current directory")
+    parser.add_argument("--compare", help="earlier results to compare with")
+    args = parser.parse_args()
+
+    commit, dirty = revision()
+    report = {
+        "revision": commit,
+        "dirty": dirty,
+        "time": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "twisted": twisted.__version__,
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "results": {},
+    }
+    output = args.output
+    if output == None:
+        output = "node-%s.json" % ((commit or "unknown")[:12])
+    output = os.path.abspath(output)
+    previous = None
+    if args.compare != None:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    root = tempfile.mkdtemp(prefix="broadcaster-bench-")
+    cwd = os.getcwd()
+    failure = []
+
+    def driver():
+        try:
+            run(args, report["results"])
+        except Exception as e:
+            failure.append(e)
+        finally:
+            reactor.callFromThread(reactor.stop)
+
+    try:
+        os.chdir(make_node(root))
+        reactor.callWhenRunning(threading.Thread(target=driver).start)
+        reactor.run()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+    if failure:
+        raise failure[0]
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("Results written to %s" % output)
+    if previous != None:
+        compare(previous, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+/* Microbenchmark of the cost gpio_override.so adds to open() and read().
+ *
+ * Builds a fake sysfs GPIO tree in /tmp, opens a number of pins the way the
+ * IRLP binaries do, then times reads of a pin, reads of an ordinary file and
+ * opening and closing a pin. Run it through ./bench, which runs it once
+ * plain and once with the shim preloaded so the two can be compared.
+ *
+ * Usage: bench_override [iterations] [pins held open]
+ */
+#include <fcntl.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <sys/stat.h>
+#include <time.h>
+#include <unistd.h>
+
+static double now(void)
+{
+        struct timespec ts;
+        clock_gettime(CLOCK_MONOTONIC, &ts);
+        return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+/* Create <root>/gpio/gpio<pin>/value holding "1" and return its path */
+static char *make_pin(const char *root, int pin)
+{
+        static char path[4096];
+        FILE *f;
+        snprintf(path, sizeof(path), "%s/gpio", root);
+        mkdir(path, 0700);
+        snprintf(path, sizeof(path), "%s/gpio/gpio%d", root, pin);
+        mkdir(path, 0700);
+        snprintf(path, sizeof(path), "%s/gpio/gpio%d/value", root, pin);
+        f = fopen(path, "w");
+        if (!f)
+        {
+                perror(path);
+                exit(1);
+        }
+        fputs("1\n", f);
+        fclose(f);
+        return path;
+}
+
+static void report(const char *name, double seconds, long iterations)
+{
+        printf("%-24s %10.1f ns/call\n", name, seconds * 1e9 / iterations);
+}
+
+int main(int argc, char **argv)
+{
+        long iterations = argc > 1 ? atol(argv[1]) : 1000000;
+        int held = argc > 2 ? atoi(argv[2]) : 32;
+        char root[] = "/tmp/gpio_benchXXXXXX";
+        char buf[8];
+        char command[4096];
+        double started;
+        long i;
+        int fd, plain;
+
+        if (!mkdtemp(root))
+        {
+                perror("mkdtemp");
+                return 1;
+        }
+
+        /* Pins opened earlier, so the one we read was opened last */
+        for (i = 0; i < held; i++)
+        {
+                if (open(make_pin(root, 100 + i), O_RDONLY) < 0)
+                {
+                        perror("open");
+                        return 1;
+                }
+        }
+        char *cos = make_pin(root, 10);
+        fd = open(cos, O_RDONLY);
+        plain = open("/dev/zero", O_RDONLY);
+        if (fd < 0 || plain < 0)
+        {
+                perror("open");
+                return 1;
+        }
+
+        printf("%ld iterations, %d other pins open\n", iterations, held);
+
+        started = now();
+        for (i = 0; i < iterations; i++)
+        {
+                lseek(fd, 0, SEEK_SET);
+                if (read(fd, buf, 1) != 1)
+                {
+                        perror("read");
+                        return 1;
+                }
+        }
+        report("lseek+read GPIO pin", now() - started, iterations);
+
+        started = now();
+        for (i = 0; i < iterations; i++)
+        {
+                if (read(plain, buf, 1) != 1)
+                {
+                        perror("read");
+                        return 1;
+                }
+        }
+        report("read /dev/zero", now() - started, iterations);
+
+        started = now();
+        for (i = 0; i < iterations / 10; i++)
+        {
+                int pin = open(cos, O_RDONLY);
+                if (pin < 0)
+                {
+                        perror("open");
+                        return 1;
+                }
+                close(pin);
+        }
+        report("open+close GPIO pin", now() - started, iterations / 10);
+
+        snprintf(command, sizeof(command), "rm -rf %s", root);
+        return system(command) == 0 ? 0 : 1;
+}
@@ -1,81 +1,69 @@
 #include <stdio.h>
 #include <dlfcn.h>
 #include <stdlib.h>
-#include <glib.h>
 #include <string.h>
 #include <unistd.h>
 
-/* Keep a single global list of open GPIO fds for the running application */
-static GList *open_files = NULL;
+/* GPIO pin open on each fd of the running application, indexed by fd, -1 for
+ * none. Lookups sit on every intercepted read(), so they must not depend on
+ * how many files are open. Grown as higher fds turn up. */
+static int *pins = NULL;
+static int pins_size = 0;
 
 /* Pointers to the real library functions, set once the first time we need them */
 static int (*real_open)(const char *pathname, int flags) = NULL;
 static int (*real_close)(int fd) = NULL;
 static ssize_t (*real_read)(int fd, void *buf, size_t count) = NULL;
 
-/* Data type keeping track of all GPIO files opened by the current app */
-typedef struct _open_file
-{
-        int descriptor; /* fd */
-        int gpio;   /* corresponding GPIO pin */
-} open_file;
-
-/* Search list to find out what GPIO pin is open on a given descriptor */
+/* Find out what GPIO pin is open on a given descriptor */
 int get_pin_for_descriptor(int descriptor)
 {
-        GList *l;
-        for (l = open_files; l != NULL; l = l->next)
+        if (descriptor < 0 || descriptor >= pins_size)
         {
-                open_file *file = l->data;
-                if (file->descriptor == descriptor)
-                {
-                        return file->gpio;
-                }
+                return -1;
         }
-        return -1;
+        return pins[descriptor];
 }
 
-/* Remember (by reassignment or appending) that a given fd has a given GPIO pin open */
+/* Remember that a given fd has a given GPIO pin open, or -1 for none */
 void assign_pin_for_descriptor(int descriptor, int pin)
 {
-        GList *l;
-        int set = 0;
-        for (l = open_files; l != NULL; l = l->next)
+        if (descriptor < 0)
         {
-                open_file *file = l->data;
-                if (file->descriptor == descriptor)
-                {
-                        file->gpio = pin;
-                        set = 1;
-                }
+                return;
         }
-        if (!set)
+        if (descriptor >= pins_size)
         {
-                open_file *file = malloc(sizeof(open_file));
-                if (!file)
+                if (pin == -1)
+                {
+                        /* Nothing to forget */
+                        return;
+                }
+                int size = pins_size ? pins_size : 64;
+                while (size <= descriptor)
+                {
+                        size *= 2;
+                }
+                int *grown = realloc(pins, size * sizeof(int));
+                if (!grown)
                 {
                         exit(1);
                 }
-                file->descriptor = descriptor;
-                file->gpio = pin;
-                open_files = g_list_append(open_files, file);
+                int i;
+                for (i = pins_size; i < size; i++)
+                {
+                        grown[i] = -1;
+                }
+                pins = grown;
+                pins_size = size;
         }
+        pins[descriptor] = pin;
 }
 
 /* Clear entry for closed descriptor */
 void close_descriptor(int descriptor)
 {
-        GList *l;
-        for (l = open_files; l != NULL; l = l->next)
-        {
-                open_file *file = l->data;
-                if (file->descriptor == descriptor)
-                {
-                        open_files = g_list_remove(open_files, file);
-                        free(file);
-                        return;
-                }
-        }
+        assign_pin_for_descriptor(descriptor, -1);
 }
 
 /* Helper func to obtain the real code. Loads functions from library specified in
@@ -118,10 +106,8 @@ int open(const char *pathname, int flags)
                 sscanf(gpio_part, "gpio/gpio%d", &pin);
         }
         int fileno = real_open(pathname, flags);
-        if (pin >= 0)
-        {
-                assign_pin_for_descriptor(fileno, pin);
-        }
+        /* Also clears a pin left behind on a reused fd */
+        assign_pin_for_descriptor(fileno, pin);
         return fileno;
 }
 
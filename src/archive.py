@@ -0,0 +1,154 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Store of finished broadcasts.
+
+Once a ScheduledItem has been played (or its start time passed without it
+playing) the scheduler no longer needs it. It is summarised into a plain
+dictionary and appended here, keeping the scheduler's own list down to
+upcoming and on-air broadcasts.
+
+The archive is an append-only file of journal records. Only a sorted index
+of (start time, identifier, file offset) is kept in memory; summaries are
+read back from disk when a query asks for them.
+"""
+
+import bisect
+import os
+
+import journal
+
+ADD = "add"
+DELETE = "delete"
+
+
+class CorruptArchive(Exception):
+    """The archive has an unreadable record before its end."""
+
+
+class Archive(object):
+    """Summaries of finished schedules, queried by start time.
+
+    A record torn by a crash at the end of the file is cut off on loading.
+    Any other unreadable record raises CorruptArchive, leaving the file
+    as it is so the summaries after it can still be recovered.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        # Sorted (start_time, identifier, offset) of live summaries
+        self._index = []
+        self._offsets = {}
+        self._file = None
+        if os.path.isfile(path):
+            self._load()
+
+    def __len__(self):
+        return len(self._index)
+
+    def add(self, summary):
+        """Appends a summary dictionary. It needs 'identifier' and 'start_time'."""
+        self.add_many([summary])
+
+    def add_many(self, summaries):
+        """Appends several summaries with a single write and fsync."""
+        records = [(ADD, summary) for summary in summaries]
+        for offset, summary in zip(self._append(records), summaries):
+            self._remove(summary["identifier"])
+            key = (summary["start_time"], summary["identifier"], offset)
+            bisect.insort(self._index, key)
+            self._offsets[summary["identifier"]] = key
+
+    def delete(self, identifier):
+        """Forgets a summary. Returns False if it was not archived."""
+        if identifier not in self._offsets:
+            return False
+        self._append([(DELETE, identifier)])
+        self._remove(identifier)
+        return True
+
+    def query(self, start=None, end=None, after=None, limit=50):
+        """Returns up to limit summaries ordered by start time.
+
+        start and end bound the start time (end is exclusive). after is a
+        (start_time, identifier) pair from a previous page; only summaries
+        ordered after it are returned. The second value returned is the
+        (start_time, identifier) to continue from, or None if there is no more.
+        """
+        if after != None:
+            position = bisect.bisect_right(self._index, (after[0], after[1], float("inf")))
+        elif start != None:
+            position = bisect.bisect_left(self._index, (start,))
+        else:
+            position = 0
+        selected = []
+        for key in self._index[position:]:
+            if start != None and key[0] < start:
+                continue
+            if end != None and key[0] >= end:
+                break
+            if len(selected) == limit:
+                last = selected[-1]
+                return self._read(selected), (last[0], last[1])
+            selected.append(key)
+        return self._read(selected), None
+
+    # Private
+
+    def _load(self):
+        end = 0
+        with open(self._path, "rb") as f:
+            for offset, (operation, payload) in journal.read_records(f):
+                end = f.tell()
+                if operation == ADD:
+                    self._remove(payload["identifier"])
+                    key = (payload["start_time"], payload["identifier"], offset)
+                    self._index.append(key)
+                    self._offsets[payload["identifier"]] = key
+                else:
+                    self._remove(payload)
+        self._index.sort()
+        if end == os.path.getsize(self._path):
+            return
+        with open(self._path, "r+b") as f:
+            if not journal.is_torn(f, end):
+                raise CorruptArchive("Unreadable record at byte %d of %s" %
+                                     (end, self._path))
+            # Cut off a record torn by a crash so appends stay readable
+            f.truncate(end)
+
+    def _remove(self, identifier):
+        key = self._offsets.pop(identifier, None)
+        if key != None:
+            position = bisect.bisect_left(self._index, key)
+            if position < len(self._index) and self._index[position] == key:
+                del self._index[position]
+
+    def _append(self, records):
+        # Returns the offset each record was written at
+        if self._file == None:
+            self._file = open(self._path, "ab")
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        offsets = []
+        data = []
+        for record in records:
+            encoded = journal.encode_record(record)
+            offsets.append(offset)
+            data.append(encoded)
+            offset += len(encoded)
+        self._file.write(b"".join(data))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return offsets
+
+    def _read(self, keys):
+        summaries = []
+        if not keys:
+            return summaries
+        with open(self._path, "rb") as f:
+            for start_time, identifier, offset in keys:
+                f.seek(offset)
+                for ignored, (operation, payload) in journal.read_records(f):
+                    summaries.append(payload)
+                    break
+        return summaries
@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Non-blocking execution of node binaries and scripts.
+
+Everything that controls the IRLP/echolink node is an external program. Run
+with subprocess they block the reactor for as long as the program takes,
+which stalls the tick loop and every web request. CommandRunner runs them
+with spawnProcess instead and hands back Deferreds.
+
+Identical commands that are already running are not started again; the new
+caller just waits for the one in flight. At most max_concurrent commands run
+at once and each one is killed if it outlives its timeout.
+
+Commands run for their exit code get no pipes; they write to our stdout and
+stderr. Some, like bin/dtmf, leave a daemon behind that would otherwise hold
+a pipe open and keep the command from ever finishing.
+"""
+
+import os
+import signal
+
+from twisted.internet import defer, error, protocol, reactor
+from twisted.python import failure
+
+
+class CommandTimeout(Exception):
+    """A command was killed because it ran longer than its timeout."""
+
+
+class _CommandProtocol(protocol.ProcessProtocol):
+
+    def __init__(self, finished):
+        self._finished = finished
+        self._output = []
+        self._exited = None
+        self.timed_out = False
+
+    def connectionMade(self):
+        # Nothing is ever written to a command
+        self.transport.closeStdin()
+
+    def outReceived(self, data):
+        self._output.append(data)
+
+    def processExited(self, reason):
+        self._exited = reason
+
+    def processEnded(self, reason):
+        self._finish(reason)
+
+    def abandon(self):
+        """Finishes without waiting for pipes a child may have inherited."""
+        self.transport.loseConnection()
+        self._finish(self._exited)
+
+    def _finish(self, reason):
+        if self._finished.called:
+            return
+        output = b"".join(self._output)
+        if self.timed_out:
+            self._finished.errback(CommandTimeout())
+        elif reason.check(error.ProcessDone):
+            self._finished.callback((0, output))
+        else:
+            self._finished.callback((reason.value.exitCode, output))
+
+
+class CommandRunner(object):
+    """Runs external commands without blocking the reactor.
+
+    run() fires with the exit code of the command, output() with whatever it
+    wrote to stdout. Failures to start the command and timeouts arrive as
+    errbacks. A command run with group=True gets a process group of its own
+    through setsid, and a timeout kills the whole group, e.g. every command
+    of a shell pipeline rather than just the shell.
+    """
+
+    def __init__(self, max_concurrent=2, default_timeout=30.0, clock=reactor):
+        self._clock = clock
+        self._default_timeout = default_timeout
+        self._semaphore = defer.DeferredSemaphore(max_concurrent)
+        self._in_flight = {}
+
+    def run(self, args, timeout=None, group=False):
+        d = self._execute(args, timeout, False, group)
+        d.addCallback(lambda result: result[0])
+        return d
+
+    def output(self, args, timeout=None):
+        d = self._execute(args, timeout, True, False)
+        d.addCallback(lambda result: result[1])
+        return d
+
+    def in_flight(self):
+        """Returns the number of distinct commands running or queued."""
+        return len(self._in_flight)
+
+    def _execute(self, args, timeout, capture, group):
+        key = (capture,) + tuple(args)
+        mine = defer.Deferred()
+        if key in self._in_flight:
+            # Already running, share its result
+            self._in_flight[key].append(mine)
+            return mine
+        self._in_flight[key] = [mine]
+        if timeout == None:
+            timeout = self._default_timeout
+        d = self._semaphore.run(self._spawn, list(args), timeout, capture,
+                                group)
+        d.addBoth(self._finished, key)
+        return mine
+
+    def _finished(self, result, key):
+        for d in self._in_flight.pop(key, []):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _spawn(self, args, timeout, capture, group):
+        finished = defer.Deferred()
+        if group:
+            args = ["setsid"] + args
+        proto = _CommandProtocol(finished)
+        if capture:
+            child_fds = {0: "w", 1: "r", 2: 2}
+        else:
+            child_fds = {0: "w", 1: 1, 2: 2}
+        try:
+            transport = self._clock.spawnProcess(proto, args[0], args,
+                                                 env=os.environ,
+                                                 childFDs=child_fds)
+        except (OSError, IOError) as e:
+            return defer.fail(e)
+        if timeout:
+            kill = self._clock.callLater(timeout, self._kill, proto, transport,
+                                         transport.pid if group else None)
+            finished.addBoth(self._cancel_kill, kill)
+        return finished
+
+    def _kill(self, proto, transport, group_id):
+        proto.timed_out = True
+        if group_id != None:
+            # setsid made the command the leader of its own group
+            try:
+                os.killpg(group_id, signal.SIGKILL)
+            except OSError:
+                pass
+        try:
+            transport.signalProcess("KILL")
+        except error.ProcessExitedAlready:
+            # Exited long ago, and whatever it left running still has our
+            # pipe open
+            proto.abandon()
+
+    def _cancel_kill(self, result, kill):
+        if kill.active():
+            kill.cancel()
+        return result
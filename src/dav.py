@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""WebDAV access to the files directory that never writes a file in place.
+
+Files in the files directory are hard links to blobs in the content store
+(see store.py), so writing into one would change the stored contents and
+every schedule that refers to them. WsgiDAV's FilesystemProvider writes an
+upload straight into the existing file and copies over an existing file.
+This provider writes uploads to a hidden temporary file next to the target
+and renames it into place when complete, and removes the target before a
+copy, so the old contents are left untouched in the store.
+
+The library does not index hidden files, so an upload in progress is never
+taken into the store half written.
+"""
+
+import os
+import tempfile
+
+from wsgidav import fs_dav_provider
+from wsgidav.dav_error import DAVError, HTTP_FORBIDDEN
+
+
+def _replacing(res):
+    # The same resource, with writes that replace files
+    if type(res) is fs_dav_provider.FileResource:
+        return _FileResource(res.path, res.environ, res._filePath)
+    if type(res) is fs_dav_provider.FolderResource:
+        return _FolderResource(res.path, res.environ, res._filePath)
+    return res
+
+
+class _FileResource(fs_dav_provider.FileResource):
+
+    _tmp_path = None
+
+    def beginWrite(self, contentType=None):
+        if self.provider.readonly:
+            raise DAVError(HTTP_FORBIDDEN)
+        directory, name = os.path.split(self._filePath)
+        fd, self._tmp_path = tempfile.mkstemp(dir=directory,
+                                              prefix="." + name + ".",
+                                              suffix=".upload")
+        os.chmod(self._tmp_path, 0o644)
+        return os.fdopen(fd, "wb")
+
+    def endWrite(self, withErrors):
+        if self._tmp_path == None:
+            return
+        if withErrors:
+            os.remove(self._tmp_path)
+        else:
+            os.rename(self._tmp_path, self._filePath)
+        self._tmp_path = None
+
+    def copyMoveSingle(self, destPath, isMove):
+        dest = self.provider._locToFilePath(destPath)
+        if not isMove and os.path.isfile(dest):
+            # Copying over it would write into its blob
+            os.remove(dest)
+        return fs_dav_provider.FileResource.copyMoveSingle(self, destPath,
+                                                           isMove)
+
+
+class _FolderResource(fs_dav_provider.FolderResource):
+
+    def getMember(self, name):
+        return _replacing(fs_dav_provider.FolderResource.getMember(self, name))
+
+
+class FilesystemProvider(fs_dav_provider.FilesystemProvider):
+    """FilesystemProvider whose writes replace files rather than change them."""
+
+    def getResourceInst(self, path, environ):
+        return _replacing(fs_dav_provider.FilesystemProvider.getResourceInst(
+            self, path, environ))
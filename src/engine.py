@@ -0,0 +1,529 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""In-process audio playback engine.
+
+One AudioEngine session covers one PTT session. A decode thread reads queued
+sources into a preallocated ring buffer and an output thread feeds the ring
+to a sink (the sound device) that stays open for the whole session. Sources
+are queued ahead of time, so consecutive files play back to back with no
+gap and no process restarts between them.
+
+A session can also be told to start at a given instant. The sink is fed
+silence while the decoder fills the ring, stopping when the audio the sink
+has queued, as its latency() reports it, would run out at the instant. The
+first sample is then written, however long the decoder took to get going.
+How close that came is estimated the same way, from the audio queued ahead
+of the first sample when it was written.
+
+All audio is signed 16 bit little endian mono at render.SAMPLE_RATE, the
+same format as the render cache.
+
+Callbacks passed to the engine are always called on the reactor thread.
+Stopping never waits for the threads. It tells them the session is over and
+they close their source and sink themselves on the way out.
+"""
+
+import array
+import fcntl
+import os
+import subprocess
+import termios
+import threading
+import time
+
+from twisted.internet import reactor
+
+import render
+
+BYTES_PER_SECOND = render.SAMPLE_RATE * 2
+
+
+class RingBuffer(object):
+    """A fixed size byte FIFO shared by one writer and one reader thread."""
+
+    def __init__(self, capacity):
+        self._buf = bytearray(capacity)
+        self._capacity = capacity
+        self._read_pos = 0
+        self._fill = 0
+        self._cond = threading.Condition()
+        self._generation = 0
+
+    def fill(self):
+        return self._fill
+
+    def generation(self):
+        """Counts clears, so a writer can tell its data is no longer wanted."""
+        return self._generation
+
+    def write(self, data, generation=None):
+        """Writes all of data, waiting for space.
+
+        Returns False if the buffer is cleared first, or was cleared since
+        generation.
+        """
+        if generation == None:
+            generation = self._generation
+        view = memoryview(data)
+        with self._cond:
+            while len(view) > 0:
+                while self._fill == self._capacity:
+                    self._cond.wait(0.5)
+                    if generation != self._generation:
+                        return False
+                if generation != self._generation:
+                    return False
+                write_pos = (self._read_pos + self._fill) % self._capacity
+                n = min(len(view), self._capacity - self._fill,
+                        self._capacity - write_pos)
+                self._buf[write_pos:write_pos + n] = view[:n]
+                self._fill += n
+                view = view[n:]
+                self._cond.notify_all()
+        return True
+
+    def read(self, count, timeout):
+        """Reads up to count bytes, waiting up to timeout for any to arrive."""
+        with self._cond:
+            if self._fill == 0:
+                self._cond.wait(timeout)
+            n = min(count, self._fill, self._capacity - self._read_pos)
+            data = bytes(self._buf[self._read_pos:self._read_pos + n])
+            self._read_pos = (self._read_pos + n) % self._capacity
+            self._fill -= n
+            self._cond.notify_all()
+            return data
+
+    def clear(self):
+        """Discards everything and releases a blocked writer."""
+        with self._cond:
+            self._read_pos = 0
+            self._fill = 0
+            self._generation += 1
+            self._cond.notify_all()
+
+
+# Sources
+
+class PcmFileSource(object):
+    """Raw PCM already in broadcast format, e.g. from the render cache.
+
+    The file is opened as soon as the source is made, raising IOError if it
+    is not there, so it still plays should the render cache evict it while
+    queued or playing.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, "rb")
+
+    def open(self):
+        pass
+
+    def read(self, count):
+        return self._file.read(count)
+
+    def close(self):
+        if self._file != None:
+            self._file.close()
+            self._file = None
+
+
+class DecoderSource(object):
+    """Decodes and companders an audio file on the fly with mpg123/sox.
+
+    effects are the sox effects to apply, by default just the compander.
+    """
+
+    def __init__(self, path, is_mp3, effects=None):
+        self._path = path
+        self._is_mp3 = is_mp3
+        if effects == None:
+            effects = render.COMPAND
+        self._effects = effects
+        self._process = None
+
+    def open(self):
+        if self._is_mp3:
+            script = render.MP3_PIPELINE
+        else:
+            script = render.SOX_PIPELINE
+        self._process = subprocess.Popen(
+            ["/bin/sh", "-c", script, "decode", self._path, "-"] +
+            list(self._effects),
+            stdout=subprocess.PIPE)
+
+    def read(self, count):
+        return self._process.stdout.read(count)
+
+    def close(self):
+        if self._process != None:
+            if self._process.poll() == None:
+                self._process.terminate()
+            self._process.stdout.close()
+            self._process.wait()
+            self._process = None
+
+
+# Sinks
+
+class ProcessSink(object):
+    """Plays PCM through sox's 'play' reading from a pipe.
+
+    device, e.g. "hw:1" for a second sound card, picks the output device
+    instead of the default one. device_latency is the seconds of audio the
+    sound card itself buffers, which play cannot tell us.
+    """
+
+    # Bytes play reads ahead of the device, from --buffer
+    buffer_bytes = 2048
+
+    def __init__(self, command=None, device=None, device_latency=0.0):
+        if command == None:
+            command = ["play", "-q", "--buffer", str(self.buffer_bytes)] + \
+                render.PCM_FORMAT + ["-"]
+        self._command = command
+        self._device_latency = device_latency
+        self._env = None
+        if device != None:
+            self._env = dict(os.environ, AUDIODEV=device)
+        self._process = None
+
+    def open(self):
+        self._process = subprocess.Popen(self._command, stdin=subprocess.PIPE,
+                                         env=self._env)
+
+    def write(self, data):
+        self._process.stdin.write(data)
+
+    def latency(self):
+        """Seconds until audio written now is heard.
+
+        Counts what is waiting in the pipe, which includes everything
+        written before play got going, play's buffer and device_latency.
+        """
+        queued = array.array("i", [0])
+        try:
+            fcntl.ioctl(self._process.stdin.fileno(), termios.FIONREAD, queued)
+        except (IOError, OSError, AttributeError, ValueError):
+            return None
+        return (queued[0] + self.buffer_bytes) / float(BYTES_PER_SECOND) + \
+            self._device_latency
+
+    def interrupt(self):
+        """Silences the sink at once. Safe to call from any thread."""
+        process = self._process
+        if process != None:
+            try:
+                process.terminate()
+            except OSError:
+                pass
+
+    def close(self):
+        if self._process != None:
+            try:
+                self._process.stdin.close()
+            except IOError:
+                pass
+            self._process.terminate()
+            self._process.wait()
+            self._process = None
+
+
+class NullSink(object):
+    """Discards audio at real-time rate. For testing without a sound card."""
+
+    def open(self):
+        self._next = time.time()
+
+    def write(self, data):
+        self._next += len(data) / float(BYTES_PER_SECOND)
+        delay = self._next - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def latency(self):
+        return max(0.0, self._next - time.time())
+
+    def close(self):
+        pass
+
+
+class _Entry(object):
+
+    def __init__(self, source, started, finished):
+        self.source = source
+        self.started = started
+        self.finished = finished
+        self.start_offset = None
+        self.end_offset = None
+
+
+class AudioEngine(object):
+    """Gapless playback of a queue of sources through one sink.
+
+    sink_factory is called with no arguments at the start of each session
+    to produce a sink. buffer_seconds sizes the ring buffer.
+    """
+
+    # Bytes handed to the sink at a time, about 46ms
+    period = 4096
+
+    def __init__(self, sink_factory=ProcessSink, buffer_seconds=2.0):
+        self._sink_factory = sink_factory
+        self._ring = RingBuffer(int(buffer_seconds * BYTES_PER_SECOND))
+        self._lock = threading.Condition()
+        self._queue = []
+        self._playing = []
+        self._written = 0
+        self._played = 0
+        self._running = False
+        self._sink = None
+        self._idle_callback = None
+        self._key_time = None
+        self._session = 0
+        # When the first sample of the session should be heard, and when
+        # the sink opened and how much has gone to it, for sinks that
+        # cannot report their latency
+        self._start_at = None
+        self._opened = None
+        self._sent = 0
+        # Statistics
+        self.underruns = 0
+        self.start_latency = None
+        # When the first audio sample of the session is heard, estimated
+        # from the sink's latency as it was written
+        self.first_sample_time = None
+
+    # Public
+
+    def start_session(self, idle_callback, key_time=None, start_at=None):
+        """Opens the sink and starts playing whatever gets queued.
+
+        idle_callback() is called when the queue runs dry. key_time is when
+        PTT was keyed, used to measure the latency to the first sample.
+        start_at, a time.time(), holds the first sample back until then.
+        """
+        if self._running:
+            return
+        self._session += 1
+        self._idle_callback = idle_callback
+        self._key_time = key_time if key_time != None else time.time()
+        self.start_latency = None
+        self.first_sample_time = None
+        self._written = 0
+        self._played = 0
+        self._sent = 0
+        self._ring.clear()
+        self._sink = self._sink_factory()
+        self._sink.open()
+        self._opened = time.time()
+        self._start_at = start_at
+        self._running = True
+        # Threads of an earlier session may still be on their way out; each
+        # only works while its own session is current
+        threads = [
+            threading.Thread(target=self._decode_loop, name="audio-decode",
+                             args=(self._session, self._ring.generation())),
+            threading.Thread(target=self._output_loop, name="audio-output",
+                             args=(self._session, self._sink))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+    def enqueue(self, source, started=None, finished=None):
+        """Queues a source to play after everything already queued."""
+        with self._lock:
+            self._queue.append(_Entry(source, started, finished))
+            self._lock.notify_all()
+
+    def stop(self):
+        """Stops playback at once and ends the session.
+
+        Returns straight away. Queued sources are closed now, the decode
+        thread closes its source once its current read returns and the
+        output thread closes the sink.
+        """
+        with self._lock:
+            self._running = False
+            dropped = self._queue
+            self._queue = []
+            self._playing = []
+            self._lock.notify_all()
+        # Never opened by the decode thread, so safe to close here
+        for entry in dropped:
+            entry.source.close()
+        # Release a decoder waiting for ring space, and an output thread
+        # blocked on a sink that is still playing what it was given
+        self._ring.clear()
+        if self._sink != None:
+            if hasattr(self._sink, "interrupt"):
+                self._sink.interrupt()
+            self._sink = None
+
+    def is_running(self):
+        return self._running
+
+    def buffered_seconds(self):
+        return self._ring.fill() / float(BYTES_PER_SECOND)
+
+    def stats(self):
+        return {
+            "underruns": self.underruns,
+            "start_latency": self.start_latency,
+            "first_sample_time": self.first_sample_time,
+            "buffered_seconds": self.buffered_seconds(),
+        }
+
+    # Private, decode thread
+
+    def _current(self, session):
+        return self._running and session == self._session
+
+    def _decode_loop(self, session, generation):
+        while True:
+            with self._lock:
+                while self._current(session) and not self._queue:
+                    self._lock.wait(0.5)
+                if not self._current(session):
+                    return
+                entry = self._queue.pop(0)
+                entry.start_offset = self._written
+                self._playing.append(entry)
+            try:
+                entry.source.open()
+                while self._current(session):
+                    data = entry.source.read(self.period)
+                    if not data:
+                        break
+                    with self._lock:
+                        if not self._current(session):
+                            break
+                        self._written += len(data)
+                    if not self._ring.write(data, generation):
+                        break
+            except (IOError, OSError) as e:
+                print("Audio source failed: %s" % e)
+            # Only ever closed here, never under a read in progress
+            entry.source.close()
+            with self._lock:
+                if not self._current(session):
+                    return
+                entry.end_offset = self._written
+                self._lock.notify_all()
+
+    # Private, output thread
+
+    def _output_loop(self, session, sink):
+        try:
+            self._output(session, sink)
+        finally:
+            sink.close()
+
+    def _output(self, session, sink):
+        silence = b"\0" * self.period
+        while self._current(session):
+            if self._start_at != None:
+                # Waiting for the start instant; the decoder fills the ring
+                lead = (self._start_at - time.time() - self._sink_latency(sink)) * \
+                    BYTES_PER_SECOND
+                # Whole samples only
+                count = min(int(lead) & ~1, self.period)
+                if count <= 0:
+                    self._start_at = None
+                    continue
+                try:
+                    sink.write(silence[:count])
+                except (IOError, OSError):
+                    if not self._current(session):
+                        return
+                self._sent += count
+                continue
+            data = self._ring.read(self.period, 0.1)
+            if not self._current(session):
+                return
+            if data:
+                if self.start_latency == None:
+                    now = time.time()
+                    self.start_latency = now - self._key_time
+                    self.first_sample_time = now + self._sink_latency(sink)
+                try:
+                    sink.write(data)
+                except (IOError, OSError) as e:
+                    if self._current(session):
+                        print("Audio sink failed: %s" % e)
+                        reactor.callFromThread(self._sink_failed, session)
+                    return
+                self._sent += len(data)
+                with self._lock:
+                    self._played += len(data)
+            else:
+                with self._lock:
+                    decoding = bool(self._playing) and \
+                        self._playing[-1].end_offset == None
+                if decoding:
+                    # The decoder could not keep up. Keep the device fed,
+                    # but a ring still filling at the start is no underrun.
+                    if self.start_latency != None:
+                        self.underruns += 1
+                    try:
+                        sink.write(silence)
+                    except (IOError, OSError):
+                        if not self._current(session):
+                            return
+                    self._sent += len(silence)
+            self._check_progress(session)
+
+    def _sink_latency(self, sink):
+        # Seconds of audio the sink holds ahead of what we write next
+        latency = None
+        if hasattr(sink, "latency"):
+            latency = sink.latency()
+        if latency == None:
+            # Assume the sink plays from when it opened, in real time
+            latency = max(0.0, self._opened + self._sent / float(BYTES_PER_SECOND)
+                          - time.time())
+        return latency
+
+    def _check_progress(self, session):
+        started = []
+        finished = []
+        idle = False
+        with self._lock:
+            for entry in self._playing:
+                if entry.started == None:
+                    continue
+                ended = entry.end_offset != None and entry.end_offset <= self._played
+                if self._played > entry.start_offset or ended:
+                    started.append(entry.started)
+                    entry.started = None
+            while self._playing and self._playing[0].end_offset != None \
+                    and self._playing[0].end_offset <= self._played:
+                finished.append(self._playing.pop(0).finished)
+            if finished and not self._playing and not self._queue:
+                idle = True
+        if started or finished:
+            reactor.callFromThread(self._report, session, started,
+                                   finished, idle)
+
+    def _report(self, session, started, finished, idle):
+        # On the reactor thread. Finished callbacks may queue more audio, so
+        # only report idle if they did not.
+        if session != self._session or not self._running:
+            return
+        for callback in started:
+            callback()
+        for callback in finished:
+            if callback != None:
+                callback()
+        if idle and self._running and not self._queue and not self._playing:
+            if self._idle_callback != None:
+                self._idle_callback()
+
+    def _sink_failed(self, session):
+        if session != self._session or not self._running:
+            return
+        callback = self._idle_callback
+        self.stop()
+        if callback != None:
+            callback()
@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""COS and PTT input backends.
+
+The Radio needs to know two things about the interface: whether somebody else
+is using the channel (COS) and whether the node is currently transmitting
+(PTT). The original way to find out is to run the IRLP 'cosstate' and
+'pttstate' binaries, which costs a fork and exec each time. On a node where
+the interface is wired to GPIO pins we can read the pins ourselves instead.
+
+Every backend offers the same small interface:
+    start(callback) - begin monitoring. callback(cos, ptt) is called on the
+                      reactor thread whenever either input changes. An
+                      argument is None if that input was not re-read.
+    poll()          - refresh state for backends that cannot be notified.
+    refresh_ptt()   - re-read PTT, which poll() may leave alone because it
+                      costs more to read than COS.
+    cos_active()    - True if the channel is in use by somebody else
+    ptt_active()    - True if the node is transmitting, as last read, or
+                      None if not read yet. Never reads anything itself.
+    stop()          - release any resources
+"""
+
+import os
+import select
+import threading
+
+from twisted.internet import reactor
+
+
+class BinInputs(object):
+    """Query state by running the binaries of an IRLP installation.
+
+    This is the fallback that works with every node. The binaries are run
+    through a CommandRunner so the reactor never waits for them; results
+    arrive through the callback. COS is sampled once per poll(). PTT is only
+    run when refresh_ptt() asks for it, and at most one run is in flight.
+    """
+
+    # cosstate/pttstate normally answer in milliseconds
+    timeout = 5.0
+
+    def __init__(self, root_path, runner):
+        self._root = root_path
+        self._runner = runner
+        self._callback = None
+        self._cos = True
+        # Unknown until pttstate first answers
+        self._ptt = None
+        self._ptt_pending = False
+
+    def start(self, callback):
+        self._callback = callback
+        self.poll()
+        self.refresh_ptt()
+
+    def stop(self):
+        self._callback = None
+
+    def poll(self):
+        d = self._run_bin("cosstate")
+        d.addCallback(self._cos_result)
+
+    def cos_active(self):
+        return self._cos
+
+    def ptt_active(self):
+        return self._ptt
+
+    def refresh_ptt(self):
+        if self._ptt_pending:
+            return
+        self._ptt_pending = True
+        d = self._run_bin("pttstate")
+        d.addCallback(self._ptt_result)
+
+    def _cos_result(self, cos):
+        if cos != self._cos:
+            self._cos = cos
+            if self._callback != None:
+                self._callback(cos, None)
+
+    def _ptt_result(self, ptt):
+        self._ptt_pending = False
+        if ptt != self._ptt:
+            self._ptt = ptt
+            if self._callback != None:
+                self._callback(None, ptt)
+
+    def _run_bin(self, command):
+        # Any failure is treated as "active" so we never key up blind
+        bin_path = os.path.join(self._root, "bin", command)
+        d = self._runner.run([bin_path], timeout=self.timeout)
+        d.addCallbacks(lambda code: code == 1, lambda failure: True)
+        return d
+
+
+class SysfsGpioInputs(object):
+    """Read COS and PTT straight from sysfs GPIO value files.
+
+    Defaults match the VK7RAD interface: COS on GPIO10, which reads 1 when the
+    channel is clear, and PTT on GPIO17, which reads 1 when transmitting.
+
+    Where the kernel lets us set a pin's 'edge' attribute to 'both' we wait
+    for changes with poll() in a background thread, so nothing is read until
+    the pin actually changes. Other pins are re-read by poll(), which is
+    still just a read() without any process creation.
+    """
+
+    def __init__(self, cos_pin=10, ptt_pin=17, cos_active_low=True,
+                 ptt_active_low=False, gpio_root="/sys/class/gpio"):
+        self._gpio_root = gpio_root
+        self._cos_active_low = cos_active_low
+        self._ptt_active_low = ptt_active_low
+        self._cos_fd = self._open_pin(cos_pin)
+        self._ptt_fd = self._open_pin(ptt_pin)
+        self._cos = self._read_pin(self._cos_fd, cos_active_low)
+        self._ptt = self._read_pin(self._ptt_fd, ptt_active_low)
+        self._callback = None
+        self._thread = None
+        self._running = False
+        # PTT is usually an output pin, which cannot raise edge interrupts
+        self._cos_watched = self._set_edge(cos_pin)
+        self._ptt_watched = self._set_edge(ptt_pin)
+
+    def start(self, callback):
+        self._callback = callback
+        watched = []
+        if self._cos_watched:
+            watched.append(self._cos_fd)
+        if self._ptt_watched:
+            watched.append(self._ptt_fd)
+        if watched:
+            self._running = True
+            self._thread = threading.Thread(target=self._watch, args=(watched,),
+                                            name="gpio-watch")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._callback = None
+        if self._thread != None:
+            self._thread.join(2.0)
+            self._thread = None
+        for fd in (self._cos_fd, self._ptt_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def poll(self):
+        if self._cos_watched and self._ptt_watched:
+            return
+        cos = self._cos
+        ptt = self._ptt
+        if not self._cos_watched:
+            cos = self._read_pin(self._cos_fd, self._cos_active_low)
+        if not self._ptt_watched:
+            ptt = self._read_pin(self._ptt_fd, self._ptt_active_low)
+        self._update(cos, ptt)
+
+    def refresh_ptt(self):
+        if not self._ptt_watched:
+            self._update(self._cos,
+                         self._read_pin(self._ptt_fd, self._ptt_active_low))
+
+    def cos_active(self):
+        return self._cos
+
+    def ptt_active(self):
+        return self._ptt
+
+    def _pin_path(self, pin, attribute):
+        return os.path.join(self._gpio_root, "gpio%d" % pin, attribute)
+
+    def _open_pin(self, pin):
+        return os.open(self._pin_path(pin, "value"), os.O_RDONLY)
+
+    def _set_edge(self, pin):
+        try:
+            with open(self._pin_path(pin, "edge"), "w") as f:
+                f.write("both")
+            return True
+        except (IOError, OSError):
+            return False
+
+    def _read_pin(self, fd, active_low):
+        # Any read failure is treated as "active" so we never key up blind
+        try:
+            os.lseek(fd, 0, os.SEEK_SET)
+            value = os.read(fd, 2)[:1]
+        except OSError:
+            return True
+        if value not in (b"0", b"1"):
+            return True
+        return (value == b"0") if active_low else (value == b"1")
+
+    def _update(self, cos, ptt):
+        if cos != self._cos or ptt != self._ptt:
+            self._cos = cos
+            self._ptt = ptt
+            if self._callback != None:
+                self._callback(cos, ptt)
+
+    def _watch(self, fds):
+        # sysfs signals a changed value file with POLLPRI | POLLERR. The value
+        # has to be read back here or poll() keeps reporting the same edge.
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLPRI | select.POLLERR)
+        while self._running:
+            try:
+                events = poller.poll(1000)
+            except select.error:
+                continue
+            if not events or not self._running:
+                continue
+            cos = self._cos
+            ptt = self._ptt
+            for fd, event in events:
+                if fd == self._cos_fd:
+                    cos = self._read_pin(fd, self._cos_active_low)
+                elif fd == self._ptt_fd:
+                    ptt = self._read_pin(fd, self._ptt_active_low)
+            reactor.callFromThread(self._update, cos, ptt)
+
+
+def create_inputs(root_path, settings, runner):
+    """Build the input backend described by the application settings.
+
+    'input_backend' may be 'bin' (the default) or 'gpio'. If GPIO access fails
+    we fall back to the IRLP binaries so the node keeps working.
+    """
+    backend = settings.get("input_backend", "bin")
+    if backend == "gpio":
+        try:
+            return SysfsGpioInputs(
+                cos_pin=int(settings.get("cos_gpio", 10)),
+                ptt_pin=int(settings.get("ptt_gpio", 17)),
+                gpio_root=settings.get("gpio_root", "/sys/class/gpio"))
+        except OSError as e:
+            print("GPIO inputs unavailable (%s), using IRLP binaries" % e)
+    return BinInputs(root_path, runner)
@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Crash-safe persistence for a collection of identified objects.
+
+State is kept as a snapshot file plus an append-only journal of changes made
+since the snapshot. Each change costs one small append instead of a rewrite
+of everything, and appends made close together share a single fsync. When
+the journal grows long it is folded into a new snapshot, which is written
+to a temporary file and renamed into place so a power cut leaves either the
+old snapshot or the new one.
+
+The snapshot is a pickled list of objects, the same format schedule.dat has
+always had. Journal records are length-prefixed pickles of (operation,
+payload); a torn record at the end of the journal is ignored on replay.
+"""
+
+import os
+import pickle
+import struct
+
+from twisted.internet import reactor
+
+ADD = "add"
+UPDATE = "update"
+DELETE = "delete"
+
+_LENGTH = struct.Struct(">I")
+
+
+def encode_record(record):
+    """Returns the bytes for one length-prefixed pickled record."""
+    data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+    return _LENGTH.pack(len(data)) + data
+
+
+def read_records(f):
+    """Yields (offset, record) for each complete record in an open file.
+
+    Stops quietly at a torn or unreadable record, which is what a crash in
+    the middle of an append leaves behind.
+    """
+    while True:
+        offset = f.tell()
+        header = f.read(_LENGTH.size)
+        if len(header) < _LENGTH.size:
+            return
+        length = _LENGTH.unpack(header)[0]
+        data = f.read(length)
+        if len(data) < length:
+            print("Ignoring torn record at end of %s" % f.name)
+            return
+        try:
+            record = pickle.loads(data)
+        except Exception as e:
+            print("Ignoring unreadable record in %s: %s" % (f.name, e))
+            return
+        yield offset, record
+
+
+def is_torn(f, offset):
+    """Whether the bytes from offset to the end of an open file are a record
+    cut short, rather than a whole record that could not be read."""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(offset)
+    header = f.read(_LENGTH.size)
+    if len(header) < _LENGTH.size:
+        return True
+    return offset + _LENGTH.size + _LENGTH.unpack(header)[0] > size
+
+
+class Journal(object):
+    """Snapshot and journal for objects with an 'identifier' attribute.
+
+    snapshot_source() must return every live object; it is called when the
+    journal is compacted. Records are flushed flush_delay seconds after the
+    first unflushed change, and compacted into a snapshot after
+    compact_after records.
+    """
+
+    def __init__(self, snapshot_path, snapshot_source, flush_delay=0.2,
+                 compact_after=500, clock=reactor):
+        self._snapshot_path = snapshot_path
+        self._journal_path = snapshot_path + ".journal"
+        self._snapshot_source = snapshot_source
+        self._flush_delay = flush_delay
+        self._compact_after = compact_after
+        self._clock = clock
+        self._buffer = []
+        self._records = 0
+        self._flush_call = None
+        self._file = None
+
+    # Public
+
+    def load(self):
+        """Returns the objects recorded on disk, replaying the journal."""
+        objects = {}
+        if os.path.isfile(self._snapshot_path):
+            with open(self._snapshot_path, "rb") as f:
+                for obj in pickle.load(f):
+                    objects[obj.identifier] = obj
+        self._records = 0
+        for operation, payload in self._replay():
+            if operation == DELETE:
+                objects.pop(payload, None)
+            else:
+                objects[payload.identifier] = payload
+            self._records += 1
+        return objects
+
+    def add(self, obj):
+        self._append(ADD, obj)
+
+    def update(self, obj):
+        self._append(UPDATE, obj)
+
+    def delete(self, identifier):
+        self._append(DELETE, identifier)
+
+    def flush(self):
+        """Writes and fsyncs everything recorded so far."""
+        if self._flush_call != None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        if not self._buffer:
+            return
+        if self._file == None:
+            self._file = open(self._journal_path, "ab")
+        self._file.write(b"".join(self._buffer))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._records += len(self._buffer)
+        self._buffer = []
+        if self._records >= self._compact_after:
+            self.compact()
+
+    def compact(self):
+        """Writes a fresh snapshot and empties the journal."""
+        self._buffer = []
+        if self._flush_call != None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        tmp_path = self._snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(list(self._snapshot_source()), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._snapshot_path)
+        self._sync_directory()
+        # Only now is it safe to forget the journal
+        if self._file != None:
+            self._file.close()
+            self._file = None
+        with open(self._journal_path, "wb") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self._records = 0
+
+    def pending_records(self):
+        """Returns the number of records in the journal since the snapshot."""
+        return self._records + len(self._buffer)
+
+    # Private
+
+    def _append(self, operation, payload):
+        self._buffer.append(encode_record((operation, payload)))
+        if self._flush_call == None:
+            self._flush_call = self._clock.callLater(self._flush_delay,
+                                                     self.flush)
+
+    def _replay(self):
+        if not os.path.isfile(self._journal_path):
+            return
+        with open(self._journal_path, "rb") as f:
+            for offset, record in read_records(f):
+                yield record
+
+    def _sync_directory(self):
+        directory = os.path.dirname(os.path.abspath(self._snapshot_path))
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
@@ -0,0 +1,415 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Index of the audio files available for broadcast.
+
+Working out the duration of an MP3 means reading the whole file, and even a
+directory listing touches the disk. The MetadataIndex does that work once per
+file version, keyed by (size, mtime), and keeps the answers in memory and on
+disk. It is kept current by watching the files directory with inotify, or
+by rescanning it periodically where inotify is unavailable.
+
+Given a store.ContentStore, each new file is also taken into the store and
+its SHA-256 recorded, which makes the index the name to content catalogue.
+Hidden files are left out, as uploads are written to one before taking
+their name.
+A file whose contents are already indexed under another name reuses that
+metadata instead of being probed.
+
+The loudness.Analysis of each file's contents, made when it is rendered, is
+kept by digest in a second file next to the index.
+
+Scans run in a worker thread. Everything else, including all queries, is
+expected to happen on the reactor thread.
+"""
+
+from collections import namedtuple
+import contextlib
+import os
+import pickle
+import threading
+import wave
+
+from twisted.internet import reactor, task, threads
+from twisted.python.filepath import FilePath
+
+import mp3info
+
+try:
+    import mad
+except ImportError:
+    mad = None
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+
+class AudioInfo(namedtuple("AudioInfo", ["filename", "size", "mtime",
+        "duration", "file_format", "sample_rate", "channels", "digest"])):
+    """What we know about one version of one audio file.
+
+    digest is the SHA-256 of the contents, or None if not stored.
+    """
+    __slots__ = ()
+
+# Indexes saved before digests existed still load, and get hashed on the
+# next scan
+AudioInfo.__new__.__defaults__ = (None,)
+
+
+def file_format_for(filename):
+    """Returns "WAVE", "MP3" or "unsupported" based on the extension."""
+    ext = os.path.splitext(filename)[1].upper()
+    if ext == ".WAV":
+        return "WAVE"
+    elif ext == ".MP3":
+        return "MP3"
+    return "unsupported"
+
+
+def probe(path, filename=None):
+    """Reads an audio file and returns an AudioInfo describing it.
+
+    filename, which decides the format, defaults to the name in path. Give
+    it when path is a stored blob. Unreadable files are reported with zero
+    duration, sample rate and channels, the same as AudioFile has always
+    done.
+    """
+    st = os.stat(path)
+    if filename == None:
+        filename = os.path.basename(path)
+    file_format = file_format_for(filename)
+    duration = 0.0
+    sample_rate = 0
+    channels = 0
+    try:
+        if file_format == "WAVE":
+            with contextlib.closing(wave.open(path)) as f:
+                sample_rate = f.getframerate()
+                channels = f.getnchannels()
+                duration = f.getnframes() / float(sample_rate)
+        elif file_format == "MP3":
+            try:
+                info = mp3info.analyse(path)
+                duration = info.duration_ms / 1000.0
+                sample_rate = info.sample_rate
+                channels = info.channels
+            except mp3info.Mp3Error:
+                # Decoding with pymad copes with some damaged files
+                if mad == None:
+                    raise
+                mf = mad.MadFile(path)
+                duration = mf.total_time() / 1000.0
+                sample_rate = mf.samplerate()
+                channels = 1 if mf.mode() == mad.MODE_SINGLE_CHANNEL else 2
+    except Exception:
+        pass
+    return AudioInfo(filename, st.st_size, st.st_mtime, duration, file_format,
+                     sample_rate, channels, None)
+
+
+# The index used by AudioFile objects. They get pickled as part of schedules
+# so they cannot hold a reference to it themselves.
+_default_index = None
+
+
+def set_default_index(index):
+    global _default_index
+    _default_index = index
+
+
+def lookup(path):
+    """Returns the indexed AudioInfo for a path, or None if not indexed."""
+    if _default_index == None:
+        return None
+    return _default_index.info_for_path(path)
+
+
+def path_for_digest(digest):
+    """Returns a path to content by its digest, or None if it is gone."""
+    if _default_index == None:
+        return None
+    return _default_index.path_for_digest(digest)
+
+
+def analysis_for(digest):
+    """Returns the loudness.Analysis of content by its digest, or None."""
+    if _default_index == None:
+        return None
+    return _default_index.analysis_for(digest)
+
+
+def record_analysis(digest, analysis):
+    """Keeps the loudness.Analysis of content, if there is an index."""
+    if _default_index != None:
+        _default_index.record_analysis(digest, analysis)
+
+
+class MetadataIndex(object):
+    """Metadata for every file in a directory, kept up to date.
+
+    files_path is the directory of audio files, index_path the file the index
+    is saved to between runs and store an optional store.ContentStore.
+    """
+
+    # Seconds between rescans when inotify is not available
+    rescan_interval = 30.0
+
+    # Wait for a burst of file changes (e.g. an upload) to settle
+    settle_delay = 1.0
+
+    def __init__(self, files_path, index_path, store=None):
+        self._files_path = os.path.abspath(files_path)
+        self._index_path = index_path
+        self._analysis_path = index_path + ".analysis"
+        self._store = store
+        self._entries = {}
+        self._by_digest = {}
+        # digest -> loudness.Analysis
+        self._analyses = {}
+        # filename -> (size, digest) worked out while a file was uploaded
+        self._expected = {}
+        self._expected_lock = threading.Lock()
+        self._scanning = False
+        self._rescan_wanted = False
+        self._pending_rescan = None
+        self._notifier = None
+        self._rescan_loop = None
+        self._listeners = []
+        # Incremented every time the set of files or their metadata changes
+        self.version = 0
+
+        if os.path.isfile(self._index_path):
+            try:
+                with open(self._index_path, "rb") as f:
+                    self._entries = pickle.load(f)
+            except Exception as e:
+                print("Ignoring unreadable metadata index: %s" % e)
+                self._entries = {}
+        self._index_digests()
+        if os.path.isfile(self._analysis_path):
+            try:
+                with open(self._analysis_path, "rb") as f:
+                    self._analyses = pickle.load(f)
+            except Exception as e:
+                print("Ignoring unreadable loudness analyses: %s" % e)
+                self._analyses = {}
+
+    # Public
+
+    def start(self):
+        """Scan now and keep watching the directory for changes."""
+        self.rescan()
+        if inotify != None:
+            try:
+                self._notifier = inotify.INotify()
+                self._notifier.startReading()
+                mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | \
+                    inotify.IN_MOVED_FROM | inotify.IN_DELETE | inotify.IN_CREATE
+                self._notifier.watch(FilePath(self._files_path), mask=mask,
+                                     callbacks=[self._directory_changed])
+                return
+            except Exception as e:
+                print("inotify unavailable (%s), rescanning periodically" % e)
+                self._notifier = None
+        self._rescan_loop = task.LoopingCall(self.rescan)
+        self._rescan_loop.start(self.rescan_interval, now=False)
+
+    def stop(self):
+        if self._notifier != None:
+            self._notifier.loseConnection()
+            self._notifier = None
+        if self._rescan_loop != None and self._rescan_loop.running:
+            self._rescan_loop.stop()
+        if self._pending_rescan != None and self._pending_rescan.active():
+            self._pending_rescan.cancel()
+
+    def add_listener(self, callback):
+        """Register callback(index), called after the index changes."""
+        self._listeners.append(callback)
+
+    def filenames(self):
+        return sorted(self._entries.keys())
+
+    def contains(self, filename):
+        return filename in self._entries
+
+    def info(self, filename):
+        return self._entries.get(filename)
+
+    def info_for_path(self, path):
+        path = os.path.abspath(path)
+        directory, filename = os.path.split(path)
+        if directory != self._files_path:
+            if self._store != None and path == self._store.path(filename):
+                # A blob, named by its digest
+                return self.info_for_digest(filename)
+            return None
+        return self._entries.get(filename)
+
+    def info_for_digest(self, digest):
+        """Returns the AudioInfo of a file with these contents, or None."""
+        filename = self._by_digest.get(digest)
+        if filename == None:
+            return None
+        return self._entries.get(filename)
+
+    def path_for_digest(self, digest):
+        """Returns a path to the contents with digest, or None.
+
+        This is the stored blob, which never changes, if there is one.
+        Otherwise it is a file of that content in the files directory,
+        whatever it is called now.
+        """
+        if self._store != None and self._store.contains(digest):
+            return self._store.path(digest)
+        filename = self._by_digest.get(digest)
+        if filename != None:
+            return self.path(filename)
+        return None
+
+    def digests(self):
+        """Returns the set of digests of all indexed files."""
+        return set(self._by_digest.keys())
+
+    def analysis_for(self, digest):
+        """Returns the loudness.Analysis of the contents, or None."""
+        if digest == None:
+            return None
+        return self._analyses.get(digest)
+
+    def record_analysis(self, digest, analysis):
+        """Keeps the loudness.Analysis of the contents with digest.
+
+        Written straight to disk; analyses are made once per render, so
+        this is rare.
+        """
+        if digest == None or analysis == None \
+                or self._analyses.get(digest) == analysis:
+            return
+        self._analyses[digest] = analysis
+        self._write(self._analysis_path, self._analyses)
+
+    def expect(self, filename, size, digest):
+        """Records the digest of a file computed while it was uploaded.
+
+        The next scan uses it instead of reading the file again, if the file
+        is still that size. Safe to call from any thread.
+        """
+        with self._expected_lock:
+            self._expected[filename] = (size, digest)
+
+    def path(self, filename):
+        return os.path.join(self._files_path, filename)
+
+    def rescan(self):
+        """Re-read the directory in a worker thread.
+
+        Returns a Deferred, or None if a scan is already running. In that case
+        another scan follows as soon as the current one finishes.
+        """
+        if self._scanning:
+            # Make sure changes that arrive mid-scan are picked up
+            self._rescan_wanted = True
+            return
+        self._scanning = True
+        d = threads.deferToThread(self._scan, dict(self._entries))
+        d.addCallback(self._scan_done)
+        d.addErrback(self._scan_failed)
+        return d
+
+    # Private
+
+    def _directory_changed(self, ignored, filepath, mask):
+        if self._pending_rescan != None and self._pending_rescan.active():
+            self._pending_rescan.reset(self.settle_delay)
+        else:
+            self._pending_rescan = reactor.callLater(self.settle_delay,
+                                                     self.rescan)
+
+    def _scan(self, previous):
+        # Runs in a worker thread. Only files whose size or mtime changed
+        # get probed again, and not even those if their contents are known.
+        known = {}
+        for info in previous.values():
+            if info.digest != None:
+                known[info.digest] = info
+        entries = {}
+        for filename in os.listdir(self._files_path):
+            if filename.startswith("."):
+                # Hidden, such as an upload still being written
+                continue
+            path = os.path.join(self._files_path, filename)
+            try:
+                st = os.stat(path)
+                if not os.path.isfile(path):
+                    continue
+                old = previous.get(filename)
+                if old != None and old.size == st.st_size \
+                        and old.mtime == st.st_mtime \
+                        and (self._store == None or old.digest != None):
+                    entries[filename] = old
+                else:
+                    entries[filename] = self._identify(path, st, known)
+            except (OSError, IOError):
+                # Deleted while we were looking at it
+                continue
+        changed = entries != previous
+        if changed:
+            self._save(entries)
+        return entries, changed
+
+    def _identify(self, path, st, known):
+        # Runs in a worker thread
+        filename = os.path.basename(path)
+        if self._store == None:
+            return probe(path)
+        with self._expected_lock:
+            expected = self._expected.pop(filename, None)
+        digest = None
+        if expected != None and expected[0] == st.st_size:
+            digest = expected[1]
+        digest = self._store.add(path, digest)
+        # Storing may have swapped the file for a link to an identical blob
+        st = os.stat(path)
+        info = known.get(digest)
+        if info == None or info.file_format != file_format_for(filename):
+            info = probe(path)
+        return info._replace(filename=filename, size=st.st_size,
+                             mtime=st.st_mtime, digest=digest)
+
+    def _index_digests(self):
+        self._by_digest = {}
+        for filename in sorted(self._entries.keys()):
+            digest = self._entries[filename].digest
+            if digest != None and digest not in self._by_digest:
+                self._by_digest[digest] = filename
+
+    def _save(self, entries):
+        self._write(self._index_path, entries)
+
+    def _write(self, path, obj):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+
+    def _scan_done(self, result):
+        entries, changed = result
+        self._scanning = False
+        if changed:
+            self._entries = entries
+            self._index_digests()
+            self.version += 1
+            for callback in list(self._listeners):
+                callback(self)
+        if self._rescan_wanted:
+            self._rescan_wanted = False
+            self.rescan()
+
+    def _scan_failed(self, failure):
+        self._scanning = False
+        print("Scanning audio files failed: %s" % failure.getErrorMessage())
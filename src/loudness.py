@@ -0,0 +1,192 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Loudness, peak and silence analysis of decoded audio.
+
+Files arrive at all sorts of levels and often with seconds of silence at
+either end, which holds PTT for nothing. Each file is analysed once, when
+it is rendered, and the render is made with a static gain that brings it to
+target_loudness and with the leading and trailing silence trimmed off.
+
+Integrated loudness follows ITU-R BS.1770 (EBU R128): K-weighted mean
+square over 400 ms blocks overlapping by 75%, gated at -70 LUFS and then
+10 LU below the ungated result. The K-weighting filter is applied in the
+frequency domain to each 100 ms quarter block, so the whole file is
+processed in a few vectorised passes. True peak is found by 4x
+oversampling with a windowed sinc interpolator.
+
+NumPy is optional. Without it analyse() returns None and files go to air
+at their own level, as they always have.
+"""
+
+from collections import namedtuple
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Programme loudness we aim for, in LUFS, and the highest true peak the gain
+# may push a file to, in dBTP
+target_loudness = -18.0
+peak_ceiling = -1.0
+
+# Audio quieter than this, in dBFS RMS over 10 ms, counts as silence, and
+# this many seconds of it are left either side of trimmed audio
+silence_threshold = -50.0
+trim_padding = 0.1
+
+# Samples read at a time, in 100 ms segments
+_SEGMENTS_PER_READ = 300
+
+
+class Analysis(namedtuple("Analysis", ["loudness", "true_peak", "start",
+                                       "end"])):
+    """Loudness in LUFS and true peak in dBTP, None if the file is silent,
+    and the start and end in seconds of the audio worth keeping."""
+    __slots__ = ()
+
+
+def gain_for(analysis):
+    """Returns the gain in dB to apply to a file, 0 if it is unknown."""
+    if analysis == None or analysis.loudness == None:
+        return 0.0
+    gain = target_loudness - analysis.loudness
+    if analysis.true_peak != None:
+        gain = min(gain, peak_ceiling - analysis.true_peak)
+    return gain
+
+
+def parameters():
+    """Describes the analysis settings, for use in cache keys."""
+    if numpy == None:
+        return "none"
+    return "r128 %s %s %s %s" % (target_loudness, peak_ceiling,
+                                 silence_threshold, trim_padding)
+
+
+def analyse(path, sample_rate):
+    """Analyses a raw signed 16 bit little endian mono PCM file.
+
+    Returns an Analysis, or None if NumPy is not available. Runs for a
+    while on long files, so call it from a worker thread.
+    """
+    if numpy == None:
+        return None
+    segment = sample_rate // 10
+    window = sample_rate // 100
+    weights = _k_weights(sample_rate, segment)
+    interpolators = _interpolators()
+    taps = interpolators.shape[1]
+    energies = []
+    loud = []
+    peak = 0.0
+    total = 0
+    previous = numpy.zeros(taps - 1)
+    quiet = 10 ** (silence_threshold / 10.0)
+    with open(path, "rb") as f:
+        while True:
+            samples = numpy.fromfile(f, dtype="<i2",
+                                     count=segment * _SEGMENTS_PER_READ)
+            if len(samples) == 0:
+                break
+            total += len(samples)
+            x = samples.astype(numpy.float64) / 32768.0
+
+            # True peak, carrying the end of the last read over so samples
+            # either side of the boundary are interpolated too
+            joined = numpy.concatenate((previous, x))
+            peak = max(peak, numpy.abs(x).max())
+            for h in interpolators:
+                if len(joined) >= taps:
+                    peak = max(peak, numpy.abs(
+                        numpy.correlate(joined, h, "valid")).max())
+            previous = joined[-(taps - 1):]
+
+            # The last read is padded out with silence
+            x = numpy.concatenate((x, numpy.zeros(-len(x) % segment)))
+            spectra = numpy.fft.rfft(x.reshape(-1, segment), axis=1)
+            power = spectra.real ** 2 + spectra.imag ** 2
+            energies.append(power.dot(weights))
+            windows = x.reshape(-1, window)
+            loud.append((windows ** 2).mean(axis=1) > quiet)
+
+    duration = total / float(sample_rate)
+    if total == 0:
+        return Analysis(None, None, 0.0, 0.0)
+    integrated = _gated_loudness(numpy.concatenate(energies))
+    true_peak = None
+    if peak > 0:
+        true_peak = 20 * math.log10(float(peak))
+    start, end = 0.0, duration
+    loud = numpy.flatnonzero(numpy.concatenate(loud))
+    if len(loud) > 0:
+        start = max(0.0, int(loud[0]) * window / float(sample_rate) -
+                    trim_padding)
+        end = min(duration, (int(loud[-1]) + 1) * window /
+                  float(sample_rate) + trim_padding)
+    # Plain floats, so pickled analyses load without NumPy
+    return Analysis(integrated, true_peak, start, end)
+
+
+# Private
+
+def _biquad_power(b, a, z):
+    # |H|^2 of a biquad at the points z = e^-jw
+    h = (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+    return h.real ** 2 + h.imag ** 2
+
+
+def _k_weights(sample_rate, count):
+    # Weights that turn the power spectrum of count samples into the mean
+    # square of the K-weighted signal. The filter is BS.1770's two stages,
+    # a high shelf for the head and a high pass, worked out for any rate.
+    z = numpy.exp(-2j * numpy.pi * numpy.arange(count // 2 + 1) / count)
+
+    k = math.tan(math.pi * 1681.974450955533 / sample_rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    shelf = _biquad_power(
+        (vh + vb * k / q + k * k, 2 * (k * k - vh), vh - vb * k / q + k * k),
+        (1 + k / q + k * k, 2 * (k * k - 1), 1 - k / q + k * k), z)
+
+    k = math.tan(math.pi * 38.13547087602444 / sample_rate)
+    q = 0.5003270373238773
+    high_pass = _biquad_power(
+        (1, -2, 1), (1, 2 * (k * k - 1) / (1 + k / q + k * k),
+                     (1 - k / q + k * k) / (1 + k / q + k * k)), z)
+
+    # Parseval for a real FFT: the bins other than DC and Nyquist stand for
+    # two, and sum |X|^2 / n^2 is the mean square
+    weights = shelf * high_pass * 2.0 / (count * count)
+    weights[0] /= 2
+    if count % 2 == 0:
+        weights[-1] /= 2
+    return weights
+
+
+def _gated_loudness(energies):
+    # energies are mean squares per 100 ms; blocks are four of them
+    if len(energies) >= 4:
+        blocks = numpy.convolve(energies, numpy.ones(4) / 4, "valid")
+    else:
+        blocks = numpy.array([energies.mean()])
+    gated = blocks[blocks > 10 ** ((-70 + 0.691) / 10)]
+    if len(gated) == 0:
+        return None
+    relative = 10 * math.log10(gated.mean()) - 10
+    gated = gated[gated > 10 ** (relative / 10)]
+    return -0.691 + 10 * math.log10(gated.mean())
+
+
+def _interpolators(phases=4, taps=12):
+    # Hann windowed sinc filters giving the points between samples
+    offsets = numpy.arange(taps) - taps // 2 + 1
+    filters = []
+    for phase in range(1, phases):
+        t = offsets - phase / float(phases)
+        filters.append(numpy.sinc(t) *
+                       (0.5 + 0.5 * numpy.cos(numpy.pi * t / (taps // 2))))
+    return numpy.array(filters)
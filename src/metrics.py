@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Counters and histograms exposed in the Prometheus text format.
+
+Instrumented code records into module-level metrics as it runs. Recording
+is a dictionary lookup and a few additions, so it costs next to nothing
+when nobody is scraping; all of the formatting happens in exposition(),
+which only runs when /metrics is requested.
+
+Everything here is used from the reactor thread only.
+"""
+
+import bisect
+
+# Suits latencies from a millisecond up to a minute
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra != None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return "%d" % value
+    return repr(value)
+
+
+class Counter(object):
+    """A count that only goes up, optionally split by labels."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *label_values, **kwargs):
+        amount = kwargs.get("amount", 1)
+        key = tuple(str(v) for v in label_values)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key in sorted(self._values):
+            yield self.name, _format_labels(self.labels, key), self._values[key]
+
+
+class Histogram(object):
+    """Observations counted into cumulative buckets, optionally by label."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per bucket counts (last is +Inf), sum, count]
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value, *label_values):
+        key = tuple(str(v) for v in label_values)
+        entry = self._values.get(key)
+        if entry == None:
+            entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self._values[key] = entry
+        # Counted in the first bucket that holds it; made cumulative on output
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        bounds = self.buckets + (float("inf"),)
+        for key in sorted(self._values):
+            counts, total, count = self._values[key]
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                yield (self.name + "_bucket",
+                       _format_labels(self.labels, key,
+                                      ("le", _format_value(float(bound)))),
+                       cumulative)
+            yield self.name + "_sum", _format_labels(self.labels, key), total
+            yield self.name + "_count", _format_labels(self.labels, key), count
+
+
+class Gauge(object):
+    """A value read from a function when metrics are scraped.
+
+    With labels, the function returns a dictionary from tuples of label
+    values to values instead.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, function, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._function = function
+        _registry.append(self)
+
+    def samples(self):
+        try:
+            value = self._function()
+        except Exception:
+            return
+        if not self.labels:
+            value = {(): value}
+        for key in sorted(value):
+            if value[key] != None:
+                yield self.name, _format_labels(self.labels, key), value[key]
+
+
+def exposition():
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append("# HELP %s %s" % (metric.name, metric.help_text))
+        lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append("%s%s %s" % (name, labels, _format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+# Hot path metrics, recorded where the work happens
+
+ticker_duration = Histogram(
+    "radio_ticker_duration_seconds",
+    "Time spent in each run of the 250 ms main ticker.")
+ticker_lateness = Histogram(
+    "radio_ticker_lateness_seconds",
+    "How late each run of the main ticker started.")
+command_duration = Histogram(
+    "radio_command_duration_seconds",
+    "Latency of node binaries and scripts.", labels=("command",))
+command_exits = Counter(
+    "radio_command_exits_total",
+    "Node binaries and scripts run, by exit code.", labels=("command", "code"))
+key_to_audio = Histogram(
+    "player_key_to_audio_seconds",
+    "Time from keying PTT to the first audio of a session.")
+channel_wait = Histogram(
+    "player_channel_wait_seconds",
+    "Time a file waited for the channel to clear before keying PTT.",
+    buckets=DEFAULT_BUCKETS + (120.0, 300.0, 600.0))
+start_lateness = Histogram(
+    "scheduler_start_lateness_seconds",
+    "How long after its scheduled start time each broadcast was started.")
+hard_start_error = Histogram(
+    "player_hard_start_error_seconds",
+    "How far the first sample of each hard start was from its instant, "
+    "estimated from the audio the sink had queued.")
+http_duration = Histogram(
+    "http_request_duration_seconds",
+    "Time taken to answer HTTP requests, by resource.", labels=("resource",))
@@ -0,0 +1,256 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""MP3 duration from frame headers, without decoding any audio.
+
+An MP3 is a sequence of frames, each starting with a four byte header that
+gives its length and how many samples it holds. Most encoders also put a
+Xing/Info or VBRI header in the first frame, which records the total number
+of frames up front. We use that when it is present and otherwise walk the
+frame headers, skipping from one to the next.
+
+The file is memory mapped so the walk reads only the header bytes it needs
+and the whole thing runs in well under a second even for multi-hour
+recordings.
+"""
+
+from collections import namedtuple
+import mmap
+import os
+import struct
+
+
+class Mp3Info(namedtuple("Mp3Info", ["duration_ms", "sample_rate", "channels",
+        "bitrate", "frames", "vbr", "method"])):
+    """Result of analysing an MP3 file.
+
+    bitrate is the average bitrate in bits per second. method says where the
+    frame count came from: "xing", "vbri" or "walk".
+    """
+    __slots__ = ()
+
+
+class Mp3Error(Exception):
+    """The file does not look like an MP3."""
+
+
+# Versions as encoded in the header
+MPEG_25 = 0
+MPEG_2 = 2
+MPEG_1 = 3
+
+_SAMPLE_RATES = {
+    MPEG_1: (44100, 48000, 32000),
+    MPEG_2: (22050, 24000, 16000),
+    MPEG_25: (11025, 12000, 8000),
+}
+
+# kbit/s, indexed by [version is MPEG-1][layer][bitrate index]
+_BITRATES = {
+    True: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    },
+    False: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    },
+}
+
+# How far we will search for the first frame after any ID3v2 tag, and for a
+# lost sync during the walk
+_MAX_SYNC_SEARCH = 64 * 1024
+
+
+class _FrameHeader(namedtuple("_FrameHeader", ["version", "layer", "sample_rate",
+        "bitrate", "channels", "length", "samples"])):
+    __slots__ = ()
+
+
+def _parse_header(value):
+    """Decodes a 32 bit frame header, returning None if it is not valid."""
+    if (value >> 21) & 0x7FF != 0x7FF:
+        return None
+    version = (value >> 19) & 3
+    layer = 4 - ((value >> 17) & 3)
+    bitrate_index = (value >> 12) & 0xF
+    rate_index = (value >> 10) & 3
+    padding = (value >> 9) & 1
+    mode = (value >> 6) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        # Reserved values, or free format which we cannot size
+        return None
+    mpeg1 = version == MPEG_1
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    bitrate = _BITRATES[mpeg1][layer][bitrate_index] * 1000
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 2 or mpeg1:
+        samples = 1152
+        length = 144 * bitrate // sample_rate + padding
+    else:
+        samples = 576
+        length = 72 * bitrate // sample_rate + padding
+    channels = 1 if mode == 3 else 2
+    return _FrameHeader(version, layer, sample_rate, bitrate, channels,
+                        length, samples)
+
+
+def _id3v2_size(buf):
+    """Returns the number of bytes taken by an ID3v2 tag at the start."""
+    if len(buf) < 10 or buf[0:3] != b"ID3":
+        return 0
+    flags = struct.unpack_from(">B", buf, 5)[0]
+    b = struct.unpack_from(">4B", buf, 6)
+    size = (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+    size += 10
+    if flags & 0x10:
+        # Footer present
+        size += 10
+    return size
+
+
+def _find_frame(buf, start, limit):
+    """Finds the first position from start where two valid frames follow."""
+    end = min(len(buf) - 4, start + limit)
+    pos = start
+    while pos < end:
+        header = _parse_header(struct.unpack_from(">I", buf, pos)[0])
+        if header != None:
+            following = pos + header.length
+            if following + 4 > len(buf):
+                return pos, header
+            if _parse_header(struct.unpack_from(">I", buf, following)[0]) != None:
+                return pos, header
+        pos += 1
+    return None, None
+
+
+def _xing_offset(header):
+    # The Xing header sits after the side information of the first frame
+    if header.version == MPEG_1:
+        side = 17 if header.channels == 1 else 32
+    else:
+        side = 9 if header.channels == 1 else 17
+    return 4 + side
+
+
+def _encoder_delay(buf, pos):
+    """Reads the LAME/ffmpeg tag encoder delay and padding, in samples."""
+    if pos + 24 > len(buf) or buf[pos:pos + 4] not in (b"LAME", b"Lavf", b"Lavc"):
+        return 0
+    b = struct.unpack_from(">3B", buf, pos + 21)
+    delay = (b[0] << 4) | (b[1] >> 4)
+    padding = ((b[1] & 0x0F) << 8) | b[2]
+    return delay + padding
+
+
+def _vbr_frames(buf, pos, header):
+    """Looks for a Xing/Info or VBRI header in the frame at pos.
+
+    Returns (frames, bytes, vbr, method, trimmed samples) or None. A header
+    cut short by the end of the file is ignored, so the frames get walked.
+    """
+    xing = pos + _xing_offset(header)
+    tag = buf[xing:xing + 4]
+    if tag in (b"Xing", b"Info"):
+        if xing + 8 > len(buf):
+            return None
+        flags = struct.unpack_from(">I", buf, xing + 4)[0]
+        cursor = xing + 8
+        frames = None
+        audio_bytes = None
+        if flags & 1:
+            if cursor + 4 > len(buf):
+                return None
+            frames = struct.unpack_from(">I", buf, cursor)[0]
+            cursor += 4
+        if flags & 2:
+            if cursor + 4 > len(buf):
+                return None
+            audio_bytes = struct.unpack_from(">I", buf, cursor)[0]
+            cursor += 4
+        if flags & 4:
+            cursor += 100
+        if flags & 8:
+            cursor += 4
+        if frames == None:
+            return None
+        return (frames, audio_bytes, tag == b"Xing", "xing",
+                _encoder_delay(buf, cursor))
+    vbri = pos + 4 + 32
+    if buf[vbri:vbri + 4] == b"VBRI" and vbri + 18 <= len(buf):
+        audio_bytes, frames = struct.unpack_from(">II", buf, vbri + 10)
+        return (frames, audio_bytes, True, "vbri", 0)
+    return None
+
+
+def _walk(buf, pos, end):
+    """Counts frames and samples by hopping from header to header."""
+    frames = 0
+    samples = 0
+    audio_bytes = 0
+    bitrates = set()
+    while pos + 4 <= end:
+        header = _parse_header(struct.unpack_from(">I", buf, pos)[0])
+        if header == None:
+            if buf[pos:pos + 3] == b"TAG":
+                # ID3v1 tag at the end of the file
+                break
+            pos, header = _find_frame(buf, pos + 1, _MAX_SYNC_SEARCH)
+            if pos == None:
+                break
+        if pos + header.length > end:
+            # Truncated last frame
+            break
+        frames += 1
+        samples += header.samples
+        audio_bytes += header.length
+        bitrates.add(header.bitrate)
+        pos += header.length
+    return frames, samples, audio_bytes, len(bitrates) > 1
+
+
+def analyse(path):
+    """Returns an Mp3Info for the file at path.
+
+    Raises Mp3Error if no MPEG audio frames can be found.
+    """
+    size = os.path.getsize(path)
+    if size < 4:
+        raise Mp3Error("File too short: %s" % path)
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _analyse(buf, path)
+        finally:
+            buf.close()
+
+
+def _analyse(buf, path):
+    start = _id3v2_size(buf)
+    pos, first = _find_frame(buf, start, _MAX_SYNC_SEARCH)
+    if pos == None:
+        raise Mp3Error("No MPEG audio frames found: %s" % path)
+
+    vbr_info = _vbr_frames(buf, pos, first)
+    if vbr_info != None:
+        frames, audio_bytes, vbr, method, trimmed = vbr_info
+        samples = frames * first.samples - trimmed
+        if audio_bytes == None:
+            audio_bytes = len(buf) - pos
+    else:
+        frames, samples, audio_bytes, vbr = _walk(buf, pos, len(buf))
+        method = "walk"
+        if frames == 0:
+            raise Mp3Error("No complete MPEG audio frames: %s" % path)
+
+    duration_ms = int(round(samples * 1000.0 / first.sample_rate))
+    if duration_ms > 0:
+        bitrate = int(audio_bytes * 8 * 1000 // duration_ms)
+    else:
+        bitrate = first.bitrate
+    return Mp3Info(duration_ms, first.sample_rate, first.channels, bitrate,
+                   frames, vbr, method)
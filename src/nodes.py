@@ -0,0 +1,136 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Several IRLP/Echolink nodes driven from one process.
+
+A PC may serve several repeater ports, each with its own IRLP installation,
+radio interface and sound card. Each is a Node: command runners, Radio,
+Player, Scheduler and StatusPublisher of its own. Nodes share the reactor,
+the library's MetadataIndex and the RenderCache, so a bulletin scheduled on
+several nodes is decoded once and every node streams the same render.
+
+Nodes are described in settings.cfg by a subsection of [nodes] each, e.g.
+
+    [nodes]
+    [[vk7rad]]
+    irlp_home = /home/irlp
+    [[vk7rot]]
+    irlp_home = /home/irlp2
+    audio_device = hw:1
+
+Anything a node's section leaves out comes from the top level. Without a
+[nodes] section the top level describes a single node, which keeps the
+schedule files it has always used.
+"""
+
+import os
+import re
+
+import control
+import engine
+import inputs
+import playback
+import radio
+import scheduler
+import status
+
+# Name of the node a settings file without [nodes] describes
+default_name = "default"
+
+# Node names end up in URLs and file names
+_valid_name = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def node_settings(app_settings):
+    """Returns (name, settings) for each node described, in order.
+
+    app_settings is the ConfigObj of settings.cfg, or any dictionary shaped
+    like one.
+    """
+    common = dict((key, value) for key, value in app_settings.items()
+                  if not isinstance(value, dict))
+    sections = app_settings.get("nodes")
+    if not sections:
+        return [(default_name, common)]
+    result = []
+    for name, section in sections.items():
+        if not isinstance(section, dict):
+            continue
+        if not _valid_name.match(name):
+            raise ValueError("Node names may only use letters, digits, _ "
+                             "and -: %s" % name)
+        settings = dict(common)
+        settings.update(section)
+        result.append((name, settings))
+    return result
+
+
+def create_nodes(app_settings, library, renders):
+    """Builds a Node for each node settings.cfg describes."""
+    described = node_settings(app_settings)
+    if "nodes" not in app_settings or not app_settings["nodes"]:
+        # A single node, with the files it always had
+        name, settings = described[0]
+        return [Node(name, settings, library, renders)]
+    directory = os.path.dirname(scheduler.Scheduler.schedule_file)
+    return [Node(name, settings, library, renders,
+                 os.path.join(directory, "schedule-%s.dat" % name),
+                 os.path.join(directory, "archive-%s.dat" % name))
+            for name, settings in described]
+
+
+class Node(object):
+    """Everything needed to broadcast on one node.
+
+    Has the same radio, player, scheduler, status and library attributes
+    the web controllers expect of the server's services, so each node can
+    have a set of controllers of its own.
+    """
+
+    def __init__(self, name, settings, library, renders, schedule_file=None,
+                 archive_file=None):
+        self.name = name
+        self.library = library
+        self.renders = renders
+        self.irlp_home = settings["irlp_home"]
+        self.runner = control.CommandRunner(
+            max_concurrent=int(settings.get("max_commands", 2)))
+        # cosstate and pttstate get their own runner, so COS is still polled
+        # while the control scripts take up every slot of the other
+        self.input_runner = control.CommandRunner(max_concurrent=2)
+        self.radio = radio.Radio(
+            self.irlp_home,
+            inputs.create_inputs(self.irlp_home, settings, self.input_runner),
+            state_ttl=float(settings.get("state_ttl", 0.0)),
+            runner=self.runner,
+            ptt_ttl=float(settings.get("ptt_ttl", 5.0)))
+        device = settings.get("audio_device")
+        device_latency = float(settings.get("audio_device_latency", 0.0))
+        self.player = playback.Player(
+            self.radio, renders,
+            engine.AudioEngine(
+                sink_factory=lambda: engine.ProcessSink(
+                    device=device, device_latency=device_latency),
+                buffer_seconds=float(settings.get("audio_buffer_seconds",
+                                                  2.0))))
+        self.scheduler = scheduler.Scheduler(
+            self.player, self.radio, library, renders,
+            hard_start_lead=float(settings.get("hard_start_lead", 3.0)),
+            schedule_file=schedule_file, archive_file=archive_file)
+        self.status = status.StatusPublisher(self)
+
+    def tick(self):
+        """Called every 250ms by the main app."""
+        self.radio.tick()
+        self.player.tick()
+        self.status.tick()
+
+    def describe(self):
+        """Returns a dictionary describing the node for the web interface."""
+        state = self.radio.state()
+        return {
+            "name": self.name,
+            "irlp_home": self.irlp_home,
+            "ptt": state.ptt,
+            "playback_status": self.player.playback_status(),
+            "upcoming": len(self.scheduler.items()),
+        }
@@ -3,45 +3,72 @@
 """Audio file playback and management
 """
 
-import contextlib
 from datetime import datetime
 import math
 import os
-import subprocess
 import sys
-import wave
-import mad
 import time
 
+import engine
+import library
+import metrics
+import render
+import timing
+
 class AudioFile(object):
     """An audio file on disk.
 
     Initialise it with a path. It will analyse the contents of the file and be
     able to report its file format and duration.
 
-    Currently only works with PCM WAVE files.
+    Metadata comes from the library's MetadataIndex when the file is indexed,
+    so asking for it does not touch the disk. Files outside the index are
+    probed directly.
+
+    Given the digest of its contents, the file is found by content rather
+    than by name, so it survives being renamed or deleted from the files
+    directory as long as the content store still has it.
     """
 
-    def __init__(self, path):
-        if not os.path.isfile(path):
+    # Files pickled before digests existed are found by path only
+    _digest = None
+
+    # (path, AudioInfo) of the last probe, for files not in the index
+    _probed = None
+
+    def __init__(self, path, digest=None):
+        if library.lookup(path) == None and not os.path.isfile(path):
             raise ValueError("Not an audio file path: %s" % path)
         self._path = path
+        self._digest = digest
 
     def __str__(self):
         return self.filename()
 
-    def _extension(self):
-        filename, ext = os.path.splitext(self.filename())
-        return ext
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_probed", None)
+        return state
+
+    def _info(self):
+        path = self.path()
+        info = library.lookup(path)
+        if info != None:
+            return info
+        # Typically a blob whose name has gone from the files directory.
+        # Probe it once, not every time the status asks for progress.
+        if self._probed == None or self._probed[0] != path:
+            self._probed = (path, library.probe(path,
+                                                os.path.basename(self._path)))
+        return self._probed[1]
+
+    def digest(self):
+        """Returns the SHA-256 of the contents, or None if not known."""
+        return self._digest
 
     def file_format(self):
         """Returns a string describing the file format."""
-        ext = self._extension().upper()
-        if ext == ".WAV":
-            return "WAVE"
-        elif self._extension().upper() == ".MP3":
-            return "MP3"
-        return "unsupported"
+        return library.file_format_for(os.path.basename(self._path))
 
     def is_supported(self):
         return self.file_format() != "unsupported"
@@ -55,19 +82,9 @@ class AudioFile(object):
     def duration(self):
         """Returns the file duration in floating point seconds."""
         try:
-            if self.is_wave():
-                with contextlib.closing(wave.open(self._path)) as f:
-                    frames = f.getnframes()
-                    rate = f.getframerate()
-                    duration = frames / float(rate)
-                    return duration
-            elif self.is_mp3():
-                mf = mad.MadFile(self._path)
-                ms = mf.total_time()
-                return ms / 1000.0
-        except:
-            pass
-        return 0.0
+            return self._info().duration
+        except OSError:
+            return 0.0
 
     def duration_string(self):
         """Returns the file duration in the format MM:SS.SS"""
@@ -78,15 +95,27 @@ class AudioFile(object):
 
     def filename(self):
         """Returns the base filename of the object, e.g. 'news.wav'"""
+        info = library.lookup(self.path())
+        if info != None:
+            # Its current name, if it has been renamed
+            return info.filename
         return os.path.basename(self._path)
 
     def path(self):
         """Returns full path to audio file"""
-        return self._path
+        if self._digest == None:
+            return self._path
+        info = library.lookup(self._path)
+        if info != None and info.digest == self._digest:
+            return self._path
+        path = library.path_for_digest(self._digest)
+        if path == None:
+            return self._path
+        return path
 
     def size(self):
         """Returns the size of the file in bytes."""
-        return os.path.getsize(self._path)
+        return self._info().size
 
     def size_string_mb(self):
         """Returns the size of the tile in the format 'XXX.XX MB'"""
@@ -94,34 +123,85 @@ class AudioFile(object):
         return "%.2f MB" % (float(size_bytes) / 1024 / 1024)
 
 class Player(object):
+    """Puts audio files to air through an engine.AudioEngine.
+
+    Files are played in the order they are given to play_file(). While we
+    hold PTT, further files are queued into the same engine session and play
+    back to back, so callers should hand over the next file as early as
+    they know it.
+    """
+
+    # Seconds to give the repeater to key up before audio starts
+    key_delay = 0.5
 
-    def __init__(self, radio):
+    def __init__(self, radio, renders=None, audio_engine=None):
         self._radio = radio
+        self._timers = timing.Timers()
+        self._renders = renders
+        if audio_engine == None:
+            audio_engine = engine.AudioEngine()
+        self._engine = audio_engine
         self._playing_now = False
         self._attempting_to_play = False
-        self._playing_process = None
+        self._keying = False
         self._playing_audio = None
+        # Files handed to us before the engine session started
+        self._pending = []
+        # When we started waiting for the channel, and when PTT was keyed
+        # for the session whose first audio has not played yet
+        self._wait_start = None
+        self._key_time = None
+        # Hard start: when the first sample is due and who to tell how
+        # close we came
+        self._start_at = None
+        self._started_callback = None
+        self._radio.add_listener(self._radio_changed)
 
     def play_file(self, audio_file, finished_callback):
-        self._finished_callback = finished_callback
-        if self._playing_now:
-            # We already have PTT, just switch files
-            self._stop_audio()
-            self._playing_audio = audio_file
-            self._start_audio()
+        if self._playing_now and not self._keying:
+            # We already have PTT, play it after whatever is queued
+            self._enqueue(audio_file, finished_callback)
         else:
-            # We'll confirm that the channel is clear and play in tick()
-            self._playing_audio = audio_file
-            self._attempting_to_play = True
+            self._pending.append((audio_file, finished_callback))
+            if not self._playing_now:
+                # We'll start when the radio tells us the channel is clear,
+                # or in tick() if it already is
+                if not self._attempting_to_play:
+                    self._wait_start = time.time()
+                self._attempting_to_play = True
+
+    def play_at(self, audio_file, start_at, finished_callback,
+                started_callback=None):
+        """Plays audio_file with its first sample at start_at, a time.time().
+
+        Call this a few seconds early. The channel is checked and PTT keyed
+        straight away, and the start of the file is decoded into the engine
+        while silence goes out until start_at. started_callback(error) is
+        told how many seconds late (negative if early) the first sample was.
+        If we are already on air the file just follows what is playing.
+        """
+        if not self._playing_now:
+            self._start_at = start_at
+            self._started_callback = started_callback
+        self.play_file(audio_file, finished_callback)
 
     def stop(self):
+        self._timers.cancel_all()
         if self._playing_now:
-            self._stop_audio()
+            self._engine.stop()
             self._radio.ptt_off()
             self._playing_now = False
         self._playing_audio = None
         self._attempting_to_play = False
-        self._finished_callback = False
+        self._keying = False
+        self._pending = []
+        self._wait_start = None
+        self._key_time = None
+        self._start_at = None
+        self._started_callback = None
+
+    def is_on_air(self):
+        return self._playing_now
 
     def playback_status(self):
         if self._attempting_to_play:
@@ -130,13 +210,17 @@ class Player(object):
             return "playing"
         return "stopped"
 
+    def engine_stats(self):
+        """Underrun count and key up to first sample latency of the engine."""
+        return self._engine.stats()
+
     def current_file(self):
         if self._playing_audio == None:
             return "-"
         return self._playing_audio.filename()
 
     def seconds_played(self):
-        if not self._playing_now:
+        if not self._playing_now or self._playing_audio == None:
             return 0.0
         return (datetime.now() - self._start_time).total_seconds()
 
@@ -158,38 +242,103 @@ class Player(object):
 
     def _start_audio(self):
         self._playing_now = True
-        self._start_time = datetime.now()
+        self._keying = True
+        d = self._radio.ptt_on()
+        d.addCallback(self._keyed, time.time())
+
+    def _keyed(self, keyed, key_time):
+        if not self._keying:
+            # Stopped while we were keying up
+            return
+        if not keyed:
+            self._playing_now = False
+            self._keying = False
+            if self._radio.ptt_locked_out():
+                print("PTT locked out, not playing")
+                self.stop()
+            else:
+                # Lost the channel, try again once it clears
+                self._attempting_to_play = True
+            return
         # Give the repeater a moment to key up
-        time.sleep(0.5)
-        if self._playing_audio.is_mp3():
-            p1 = subprocess.Popen(
-                ["mpg123", "-m", "-s", "-r", "44100", self._playing_audio.path()],
-                stdout=subprocess.PIPE)
-            self._playing_process = subprocess.Popen("play --buffer 2048 -t raw -e signed-integer -r 44100 -b 16 -c 1 - compand 0.1,0.3 -60,-60,-30,-20,-20,-15,-4,-8,-2,-7 -2".split(),
-                stdin=p1.stdout, stdout=subprocess.PIPE)
-            self._playing_process.stdout.close()
-        else: # at least attempt as wave
-            self._playing_process = subprocess.Popen(
-                ['play', '--buffer', '2048', self._playing_audio.path()] + "compand 0.1,0.3 -60,-60,-30,-20,-20,-15,-4,-8,-2,-7 -2".split())
-
-    def _stop_audio(self):
-        if self._playing_process != None:
-            self._playing_process.terminate()
-            self._playing_process.wait()
-            self._playing_process = None
+        self._key_time = key_time
+        if self._start_at != None:
+            # The engine sends silence until the start, so open it now to
+            # decode ahead, but never release audio before key up
+            self._begin_session(key_time, max(self._start_at,
+                                              key_time + self.key_delay))
+            return
+        self._timers.call_later(self.key_delay, self._begin_session, key_time)
+
+    def _begin_session(self, key_time, start_at=None):
+        self._keying = False
+        self._engine.start_session(self._engine_idle, key_time, start_at)
+        pending = self._pending
+        self._pending = []
+        for audio_file, finished_callback in pending:
+            self._enqueue(audio_file, finished_callback)
+
+    def _enqueue(self, audio_file, finished_callback):
+        prepared = None
+        if self._renders != None:
+            prepared = self._renders.lookup(audio_file.path(),
+                                            audio_file.digest())
+        source = None
+        if prepared != None:
+            # Already decoded and companded, just stream it. Opening it now
+            # keeps it readable even if the cache evicts it before it plays.
+            try:
+                source = engine.PcmFileSource(prepared)
+                self._renders.touch(prepared)
+            except (IOError, OSError):
+                # Evicted since the lookup, decode it instead
+                pass
+        if source == None:
+            # Not rendered yet, but it may have been analysed
+            digest = audio_file.digest()
+            if digest == None:
+                info = library.lookup(audio_file.path())
+                digest = info.digest if info != None else None
+            source = engine.DecoderSource(
+                audio_file.path(), audio_file.is_mp3(),
+                render.effects_for(library.analysis_for(digest)))
+        self._engine.enqueue(source,
+                             started=lambda: self._file_started(audio_file),
+                             finished=finished_callback)
+
+    def _file_started(self, audio_file):
+        self._playing_audio = audio_file
+        self._start_time = datetime.now()
+        if self._key_time != None:
+            metrics.key_to_audio.observe(time.time() - self._key_time)
+            self._key_time = None
+        if self._start_at != None:
+            error = self._engine.first_sample_time - self._start_at
+            callback = self._started_callback
+            self._start_at = None
+            self._started_callback = None
+            metrics.hard_start_error.observe(abs(error))
+            if callback != None:
+                callback(error)
+
+    def _engine_idle(self):
+        print("naturally finished")
+        self.stop()
 
     def tick(self):
-        if self._playing_now and self._playing_process != None:
-            if self._playing_process.poll() != None:
-                print("naturally finished")
-                # Finished playing naturally
-                self._playing_process = None
-                if self._finished_callback != None:
-                    self._finished_callback()
-                self.stop()
-        else:
-            if self._attempting_to_play and self._radio.channel_clear():
-                print("channel clear, starting playback")
-                self._attempting_to_play = False
-                self._radio.ptt_on() #TODO check return value
-                self._start_audio()
+        if self._attempting_to_play and not self._playing_now:
+            # Cheap now that the radio caches its inputs
+            self._start_if_clear()
+
+    def _radio_changed(self, event, active):
+        if event == "clear" and active:
+            self._start_if_clear()
+
+    def _start_if_clear(self):
+        if self._attempting_to_play and self._radio.channel_clear():
+            print("channel clear, starting playback")
+            self._attempting_to_play = False
+            if self._wait_start != None:
+                metrics.channel_wait.observe(time.time() - self._wait_start)
+                self._wait_start = None
+            self._start_audio()
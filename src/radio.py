@@ -3,14 +3,44 @@
 """Radio state and control.
 
 We do not control the radio directly. Intead we integrate with an 
-echolink/IRLP node. State is determined by a combination of running external 
-binaries and checking for the existence of files. Control is achieved by 
-executing external binaries and shell scripts.
+echolink/IRLP node. State is determined by a combination of reading the COS/PTT 
+inputs (see inputs.py) and checking for the existence of files. Control is 
+achieved by executing external binaries and shell scripts.
+
+All of those programs run through a control.CommandRunner, so none of the 
+control methods block. They return Deferreds for callers that need to know 
+when the command has finished.
 """
 
+from collections import namedtuple
 import os
-import subprocess
 import sys
+import time
+
+from twisted.internet import defer
+from twisted.python import failure
+
+import control
+import inputs
+import metrics
+
+# Need to be clear for at least this long before we jump in
+CHANNEL_CLEAR_SECONDS = 2.0
+
+
+class RadioState(namedtuple("RadioState", ["timestamp", "ptt", "channel_active",
+        "channel_clear", "irlp_active", "echolink_active", "ptt_locked"])):
+    """An immutable snapshot of everything we know about the node.
+
+    Captured by Radio.tick() so that every reader during a tick (the player,
+    the scheduler, any number of web status requests) shares one set of
+    binary runs and file checks.
+    """
+    __slots__ = ()
+
+    def age(self):
+        return time.time() - self.timestamp
+
 
 class Radio(object):
     """An IRLP node installation that we can query and control.
@@ -21,43 +51,75 @@ class Radio(object):
         /home/user/irlp/local
         /home/user/irlp/scripts
     ... you would pass in '/home/user/irlp'
+    
+    COS and PTT are read through an input backend. By default that is the 
+    node's own cosstate/pttstate binaries. Interested parties can register 
+    with add_listener() to be told when either input changes rather than 
+    polling for it.
+    
+    The query methods all answer from a RadioState snapshot which tick() 
+    refreshes once it is older than state_ttl seconds. A state_ttl of zero 
+    captures a fresh snapshot on every tick.
+    
+    PTT in the snapshot is the last value the backend reported. Reading it
+    may mean running pttstate, so it is only re-read once it is ptt_ttl
+    seconds old, and after each of our own control commands.
     """
     
-    def __init__(self, root_path):
+    # Seconds we allow node binaries and scripts before killing them
+    bin_timeout = 5.0
+    script_timeout = 30.0
+    
+    def __init__(self, root_path, input_backend=None, state_ttl=0.0,
+                 runner=None, ptt_ttl=5.0):
         if not os.path.isdir(root_path):
             raise ValueError("Supplied path is not directory: %s" % root_path)
         self._root = root_path
+        if runner == None:
+            runner = control.CommandRunner()
+        self._runner = runner
         self._ptt_lock = False
         self._channel_clear = False
-        self._clear_count = 0
+        self._last_active = time.time()
+        self._listeners = []
+        if input_backend == None:
+            # A runner of its own, so polls never wait behind our scripts
+            input_backend = inputs.BinInputs(
+                root_path, control.CommandRunner(max_concurrent=2))
+        self._inputs = input_backend
+        self._cos = self._inputs.cos_active()
+        self._ptt = self._inputs.ptt_active()
+        # True from when our key command succeeds until we unkey
+        self._keyed = False
+        self._state_ttl = state_ttl
+        self._ptt_ttl = ptt_ttl
+        self._ptt_read = time.time()
+        self._state = self._capture_state()
+        self._inputs.start(self._inputs_changed)
         self._enable_dtmf()
     
     # Public
     
     # Querying state
     
+    def state(self):
+        """Returns the current RadioState snapshot. Never runs anything."""
+        return self._state
+    
     def ptt_active(self):
-        try:
-            return self._run_bin("pttstate") == 1
-        except:
-            return True
+        return self._state.ptt
     
     def channel_active(self):
-        try:
-            return self._run_bin("cosstate") == 1
-        except:
-            return True
+        return self._state.channel_active
     
     def channel_clear(self):
-        return (not self.channel_active()) and self._channel_clear
+        return self._state.channel_clear
     
     def echolink_active(self):
-        check_path = os.path.join(self._root, "local", "echo_enable")
-        return os.path.isfile(check_path)
+        return self._state.echolink_active
     
     def irlp_active(self):
-        check_path = os.path.join(self._root, "local", "enable")
-        return os.path.isfile(check_path)
+        return self._state.irlp_active
     
     def ptt_locked_out(self):
         return self._ptt_lock
@@ -65,76 +127,195 @@ class Radio(object):
     # Manipulating controls
     
     def ptt_on(self):
+        """Key up if allowed. Fires True once keyed, or False if refused or
+        the key command failed."""
         print("PTT ON")
-        self._disable_dtmf()
-        if (not self.ptt_locked_out()) and self.channel_clear():
-            self._run_bin("key")
-            return True
-        else:
-            return False
+        if not self._may_key():
+            return defer.succeed(False)
+        d = self._disable_dtmf()
+        d.addBoth(self._key_if_clear)
+        return d
     
     def ptt_off(self):
         print("PTT OFF")
+        self._keyed = False
         self._enable_dtmf()
-        self._run_bin("unkey")
+        return self._control(self._run_bin("unkey"))
     
     def irlp_on(self):
         print("IRLP ON")
-        self._run_script("enable")
+        return self._control(self._run_script("enable"))
     
     def irlp_off(self):
         print("IRLP OFF")
-        self._run_script("disable")
+        return self._control(self._run_script("disable"))
     
     def echolink_on(self):
         print("ECHOLINK ON")
-        self._run_echo_script("echo_enable")
+        return self._control(self._run_echo_script("echo_enable"))
     
     def echolink_off(self):
         print("ECHOLINK OFF")
-        self._run_echo_script("echo_disable")
+        return self._control(self._run_echo_script("echo_disable"))
     
     def ptt_lock(self):
         self._ptt_lock = True
-        if self.ptt_active():
+        self._state = self._state._replace(ptt_locked=True)
+        # Not the snapshot, which may be a tick behind our own key command
+        if self._keyed or self._ptt:
             self.ptt_off()
     
     def ptt_unlock(self):
         self._ptt_lock = False
+        self._state = self._state._replace(ptt_locked=False)
+    
+    # Events
+    
+    def add_listener(self, callback):
+        """Register callback(event, active) for input changes.
+        
+        event is "cos", "ptt" or "clear". Callbacks run on the reactor thread.
+        """
+        self._listeners.append(callback)
+    
+    def remove_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
     
     def tick(self):
         """Called every 250ms by main app to get work done."""
         
-        if self.channel_active():
-            self._clear_count = 0
+        # Event driven backends update us from _inputs_changed instead
+        self._inputs.poll()
+        if time.time() - self._ptt_read >= self._ptt_ttl:
+            self._ptt_read = time.time()
+            self._inputs.refresh_ptt()
+        
+        clear = (not self._cos) and \
+            (time.time() - self._last_active) > CHANNEL_CLEAR_SECONDS
+        changed = clear != self._channel_clear
+        self._channel_clear = clear
+        
+        if self._state.age() >= self._state_ttl:
+            self._state = self._capture_state()
         else:
-            self._clear_count += 1
+            self._state = self._state._replace(channel_active=self._cos,
+                                               channel_clear=clear)
         
-        # Need to be clear for at least two seconds before we jump in
-        self._channel_clear = (self._clear_count > 8)
+        if changed:
+            self._notify("clear", clear)
 
     
     # Private
     
+    def _capture_state(self):
+        return RadioState(
+            timestamp=time.time(),
+            ptt=self._ptt,
+            channel_active=self._cos,
+            channel_clear=(not self._cos) and self._channel_clear,
+            irlp_active=os.path.isfile(os.path.join(self._root, "local", "enable")),
+            echolink_active=os.path.isfile(os.path.join(self._root, "local", "echo_enable")),
+            ptt_locked=self._ptt_lock)
+    
+    def _invalidate_state(self):
+        # Make the next tick capture a fresh snapshot
+        self._state = self._state._replace(timestamp=0)
+    
+    def _control(self, d):
+        # The command changed node state, pick it up at the next tick
+        d.addBoth(self._control_done)
+        return d
+    
+    def _control_done(self, result):
+        self._invalidate_state()
+        # The command may have keyed or unkeyed, re-read PTT at the next tick
+        self._ptt_read = 0
+        return result
+    
+    def _may_key(self):
+        return (not self.ptt_locked_out()) and self.channel_clear()
+
+    def _key_if_clear(self, ignored):
+        # Someone may have keyed up, or we were locked out, while key
+        # waited for dtmf to be stopped
+        if not self._may_key():
+            print("PTT refused, channel no longer clear")
+            self._enable_dtmf()
+            return False
+        d = self._control(self._run_bin("key"))
+        d.addCallback(self._keyed_result)
+        return d
+
+    def _keyed_result(self, code):
+        # _run() turns a failure to run key into None
+        self._keyed = code == 0
+        return self._keyed
+    
+    def _inputs_changed(self, cos, ptt):
+        if cos != None and cos != self._cos:
+            self._cos = cos
+            # Either edge restarts the clear timer
+            self._last_active = time.time()
+            if cos:
+                self._channel_clear = False
+            self._state = self._state._replace(channel_active=cos,
+                                               channel_clear=False)
+            self._notify("cos", cos)
+        if ptt != None and ptt != self._ptt:
+            self._ptt = ptt
+            self._state = self._state._replace(ptt=ptt)
+            self._notify("ptt", ptt)
+    
+    def _notify(self, event, active):
+        for callback in list(self._listeners):
+            callback(event, active)
+    
     def _run_bin(self, command):
         bin_path = os.path.join(self._root, "bin", command)
-        return subprocess.call([bin_path])
+        return self._run([bin_path], self.bin_timeout)
     
     def _run_script(self, command):
         script_path = os.path.join(self._root, "scripts", command)
-        return subprocess.call([script_path])
+        return self._run([script_path], self.script_timeout)
 
     def _run_echo_script(self, command):
         script_path = os.path.join(self._root, "features", "EchoIRLP", "scripts", command)
-        return subprocess.call([script_path])
+        return self._run([script_path], self.script_timeout)
+
+    def _run(self, args, timeout):
+        d = self._runner.run(args, timeout=timeout)
+        d.addBoth(self._command_done, os.path.basename(args[0]), time.time())
+        d.addErrback(self._command_failed, args)
+        return d
+
+    def _command_done(self, result, command, started):
+        metrics.command_duration.observe(time.time() - started, command)
+        if not isinstance(result, failure.Failure):
+            metrics.command_exits.inc(command, result)
+        elif result.check(control.CommandTimeout):
+            metrics.command_exits.inc(command, "timeout")
+        else:
+            metrics.command_exits.inc(command, "error")
+        return result
+
+    def _command_failed(self, failure, args):
+        print("Command %s failed: %s" % (" ".join(args), failure.getErrorMessage()))
+        return None
 
     def _disable_dtmf(self):
         # This daemon will shut off PTT if it detects a transmission going for longer than 5 mins
-        subprocess.call(["killall", "dtmf"])
+        return self._run(["killall", "dtmf"], self.bin_timeout)
     
     def _enable_dtmf(self):
         # Enable DTMF listening again
         # The process can run multiple times so make sure it isn't already running
-        if not "dtmf" in subprocess.check_output(["ps", "waux"]):
+        d = self._runner.output(["ps", "waux"], timeout=self.bin_timeout)
+        d.addCallback(self._start_dtmf_unless_running)
+        d.addErrback(self._command_failed, ["ps", "waux"])
+        return d
+    
+    def _start_dtmf_unless_running(self, processes):
+        if not b"dtmf" in processes:
             dtmf_path = os.path.join(self._root, "bin", "dtmf")
-            subprocess.call([dtmf_path])
+            return self._run([dtmf_path], self.bin_timeout)
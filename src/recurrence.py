@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Recurrence rules for schedules that repeat.
+
+A Rule describes every occurrence of a repeating broadcast from its first
+start time: daily, weekly on given days, or on the nth weekday of each
+month, optionally ending at an until date or after a count of occurrences.
+
+Occurrences are not stored. next_after() works out the one following any
+moment directly, by jumping to the right day, week or month, so a rule
+covering years of broadcasts costs the same as one covering a week.
+between() lists the occurrences in a range, for checking overlaps.
+"""
+
+import calendar
+from datetime import date, datetime, timedelta
+
+DAILY = "daily"
+WEEKLY = "weekly"
+MONTHLY = "monthly"
+
+FREQUENCIES = (DAILY, WEEKLY, MONTHLY)
+
+WEEKDAY_NAMES = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+class Rule(object):
+    """When a repeating schedule occurs.
+
+    start is the datetime of the first occurrence; every occurrence is at
+    its time of day. weekdays is a list of 0 (Monday) to 6 (Sunday) and
+    defaults to the weekday of start. For monthly rules nth picks the week
+    of the month, 1 to 4 or -1 for the last, and defaults to the week start
+    falls in, or the last for the 29th to 31st. until is an inclusive date.
+
+    If start falls on one of the weekdays it must be the first occurrence,
+    so a monthly nth that misses it is refused rather than silently
+    skipping the first broadcast.
+    """
+
+    def __init__(self, start, frequency, interval=1, weekdays=None, nth=None,
+                 until=None, count=None):
+        if frequency not in FREQUENCIES:
+            raise ValueError("Unknown frequency: %s" % frequency)
+        if interval < 1:
+            raise ValueError("Interval must be at least 1")
+        if count != None and count < 1:
+            raise ValueError("Count must be at least 1")
+        if weekdays == None or len(weekdays) == 0 or frequency == DAILY:
+            weekdays = [start.weekday()]
+        for day in weekdays:
+            if day not in range(7):
+                raise ValueError("Not a weekday: %s" % day)
+        if frequency == MONTHLY:
+            if nth == None:
+                nth = (start.day - 1) // 7 + 1
+                if nth == 5:
+                    nth = -1
+            if nth not in (1, 2, 3, 4, -1):
+                raise ValueError("nth must be 1 to 4 or -1")
+        self.start = start
+        self.frequency = frequency
+        self.interval = interval
+        self.weekdays = sorted(set(weekdays))
+        self.nth = nth
+        self.until = until
+        self.count = count
+        if start.weekday() in self.weekdays:
+            first = self.first()
+            if first != None and first[1] != start:
+                raise ValueError("%s is not an occurrence of %s" %
+                                 (start.strftime("%d/%m/%Y"), self))
+
+    def __str__(self):
+        days = ", ".join(WEEKDAY_NAMES[d].capitalize() for d in self.weekdays)
+        if self.frequency == DAILY:
+            text = "daily" if self.interval == 1 else \
+                "every %d days" % self.interval
+        elif self.frequency == WEEKLY:
+            text = "weekly" if self.interval == 1 else \
+                "every %d weeks" % self.interval
+            text += " on " + days
+        else:
+            text = "monthly" if self.interval == 1 else \
+                "every %d months" % self.interval
+            week = "last" if self.nth == -1 else _ordinal(self.nth)
+            text += " on the %s %s" % (week, days)
+        if self.until != None:
+            text += " until %s" % self.until.strftime("%d/%m/%Y")
+        if self.count != None:
+            text += ", %d times" % self.count
+        return text
+
+    def first(self):
+        """Returns (index, datetime) of the first occurrence, or None."""
+        return self.next_after(None)
+
+    def next_after(self, moment):
+        """Returns (index, datetime) of the first occurrence after moment.
+
+        index counts occurrences from 0. Returns None once the rule has
+        ended. A moment of None means from the very start.
+        """
+        per_period = len(self.weekdays)
+        skipped = len([s for s in self._slots(0) if s < self.start])
+        if moment == None or moment < self.start:
+            period = 0
+        else:
+            period = self._period_of(moment)
+        while True:
+            for slot, when in enumerate(self._slots(period)):
+                if when < self.start or (moment != None and when <= moment):
+                    continue
+                index = period * per_period + slot - skipped
+                if self.count != None and index >= self.count:
+                    return None
+                if self.until != None and when.date() > self.until:
+                    return None
+                return index, when
+            period += 1
+
+    def between(self, start, end):
+        """Returns (index, datetime) of each occurrence from start up to, but
+        not including, end."""
+        found = []
+        occurrence = self.next_after(start - timedelta(microseconds=1))
+        while occurrence != None and occurrence[1] < end:
+            found.append(occurrence)
+            occurrence = self.next_after(occurrence[1])
+        return found
+
+    # Private
+
+    def _period_of(self, moment):
+        # The period (day, week or month, counted in intervals from the
+        # start) containing moment
+        if self.frequency == DAILY:
+            days = (moment.date() - self.start.date()).days
+            return max(days // self.interval, 0)
+        if self.frequency == WEEKLY:
+            days = (moment.date() - self._first_monday()).days
+            return max(days // (7 * self.interval), 0)
+        months = (moment.year - self.start.year) * 12 + \
+            moment.month - self.start.month
+        return max(months // self.interval, 0)
+
+    def _first_monday(self):
+        return self.start.date() - timedelta(days=self.start.weekday())
+
+    def _slots(self, period):
+        # Every candidate occurrence in a period, in order
+        at = self.start.time()
+        if self.frequency == DAILY:
+            day = self.start.date() + timedelta(days=period * self.interval)
+            return [datetime.combine(day, at)]
+        if self.frequency == WEEKLY:
+            monday = self._first_monday() + \
+                timedelta(days=7 * period * self.interval)
+            return [datetime.combine(monday + timedelta(days=d), at)
+                    for d in self.weekdays]
+        month = self.start.month - 1 + period * self.interval
+        year = self.start.year + month // 12
+        month = month % 12 + 1
+        return sorted(datetime.combine(_nth_weekday(year, month, d, self.nth), at)
+                      for d in self.weekdays)
+
+
+def _nth_weekday(year, month, weekday, nth):
+    if nth == -1:
+        last = date(year, month, calendar.monthrange(year, month)[1])
+        return last - timedelta(days=(last.weekday() - weekday) % 7)
+    first = date(year, month, 1)
+    offset = (weekday - first.weekday()) % 7
+    return first + timedelta(days=offset + 7 * (nth - 1))
+
+
+def _ordinal(n):
+    return {1: "first", 2: "second", 3: "third", 4: "fourth"}[n]
+
+
+def from_json(json_dict, start):
+    """Builds a Rule from the recurrence part of a new schedule request.
+
+    Recognised keys are frequency, interval, weekdays (names such as "mon"
+    or numbers 0-6), nth, until (dd/mm/yyyy) and count.
+    """
+    weekdays = []
+    for day in json_dict.get("weekdays") or []:
+        if isinstance(day, int):
+            weekdays.append(day)
+        elif str(day)[:3].lower() in WEEKDAY_NAMES:
+            weekdays.append(WEEKDAY_NAMES.index(str(day)[:3].lower()))
+        else:
+            raise ValueError("Not a weekday: %s" % day)
+    until = json_dict.get("until")
+    if until:
+        until = datetime.strptime(until, "%d/%m/%Y").date()
+    else:
+        until = None
+    count = json_dict.get("count")
+    nth = json_dict.get("nth")
+    return Rule(start, json_dict.get("frequency"),
+                interval=int(json_dict.get("interval") or 1),
+                weekdays=weekdays,
+                nth=int(nth) if nth not in (None, "") else None,
+                until=until,
+                count=int(count) if count not in (None, "") else None)
@@ -0,0 +1,327 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Broadcast-ready renders of audio files.
+
+Every file we put to air goes through the same processing: decode, mix down
+to mono 16 bit PCM at 44.1kHz and compand. Rather than doing that live each
+time a file plays, the RenderCache does it once, ahead of time, and keeps
+the result as a raw PCM file that the player can stream directly.
+
+Where NumPy is available, the decoded audio is analysed with loudness.py
+before it is companded, and the render gets a static gain to a common
+loudness with its leading and trailing silence trimmed. The analysis is
+kept in the library, so a file played before its render is ready can be
+given the same treatment as it decodes.
+
+Renders are keyed by a SHA-256 of the source file contents plus a digest of
+the processing parameters, so identical files share one render and changing
+the processing invalidates everything. The cache is kept under a size limit
+by deleting the least recently used renders. Files are rendered when they
+arrive in the library and when they are scheduled, never the whole library
+at once.
+"""
+
+import hashlib
+import os
+
+from twisted.internet import defer, threads
+from twisted.python import failure
+
+import library
+import loudness
+import store
+
+# Format of every render: signed 16 bit little endian mono at this rate
+SAMPLE_RATE = 44100
+PCM_FORMAT = ["-t", "raw", "-e", "signed-integer", "-r", str(SAMPLE_RATE),
+              "-b", "16", "-c", "1"]
+
+COMPAND = "compand 0.1,0.3 -60,-60,-30,-20,-20,-15,-4,-8,-2,-7 -2".split()
+
+# mpg123 decodes MP3, sox does everything else. $1 is the source, $2 the
+# output file and any further arguments are sox effects.
+MP3_PIPELINE = "in=\"$1\"; out=\"$2\"; shift 2; " \
+    "mpg123 -q -m -s -r %d \"$in\" | sox %s - %s \"$out\" \"$@\"" % (
+        SAMPLE_RATE, " ".join(PCM_FORMAT), " ".join(PCM_FORMAT))
+SOX_PIPELINE = "in=\"$1\"; out=\"$2\"; shift 2; " \
+    "sox \"$in\" %s \"$out\" \"$@\"" % " ".join(PCM_FORMAT)
+
+
+def params_digest():
+    """Identifies the processing applied, for use in cache keys."""
+    description = "|".join([MP3_PIPELINE, SOX_PIPELINE, " ".join(COMPAND),
+                            loudness.parameters()])
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()[:12]
+
+
+def effects_for(analysis):
+    """Returns the sox effects that make audio ready for air.
+
+    Given a loudness.Analysis the silence either end is trimmed and the
+    level set before companding.
+    """
+    if analysis == None:
+        return list(COMPAND)
+    return ["trim", "%.3f" % analysis.start, "=%.3f" % analysis.end,
+            "gain", "%.2f" % loudness.gain_for(analysis)] + COMPAND
+
+
+def content_hash(path):
+    """Returns the SHA-256 hex digest of a file, as the content store does."""
+    return store.file_digest(path)
+
+
+class RenderCache(object):
+    """Rendered PCM for audio files, prepared in the background.
+
+    cache_path is the directory renders are kept in and max_bytes the total
+    size they may use. runner is a control.CommandRunner used to run the
+    decoders; give it its own so renders cannot hold up node control.
+    """
+
+    # A render of a long recording can take minutes on a small PC
+    render_timeout = 3600
+
+    def __init__(self, cache_path, max_bytes, runner):
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        self._cache_path = cache_path
+        self._max_bytes = max_bytes
+        self._runner = runner
+        self._params = params_digest()
+        # Source path -> (size, mtime, render path) of renders we know about
+        self._renders = {}
+        # Content digest -> render path, for sources found by content
+        self._by_digest = {}
+        self._in_flight = {}
+        # Render path -> Deferreds waiting on a render already running, so
+        # identical files are only decoded once
+        self._rendering = {}
+        # Digests in the watched index as of its last change
+        self._indexed = set()
+
+    # Public
+
+    def lookup(self, path, digest=None):
+        """Returns the render for a source file, or None if there isn't one.
+
+        digest, the SHA-256 of the source if known, finds a render made for
+        the same contents under another name. Only in-memory state is
+        consulted, so this is cheap enough to call when a file is about to
+        go to air.
+        """
+        entry = self._renders.get(os.path.abspath(path))
+        if entry == None:
+            if digest != None:
+                return self._by_digest.get(digest)
+            return None
+        info = library.lookup(path)
+        if info != None and (info.size, info.mtime) != entry[:2]:
+            # The source has changed since we rendered it
+            return None
+        return entry[2]
+
+    def prepare(self, path, digest=None):
+        """Makes sure a render exists for path.
+
+        digest is the SHA-256 of the source if known; otherwise the library
+        is asked for it, and failing that the file is hashed. Returns a
+        Deferred firing with the render path, or None if the file could not
+        be rendered.
+        """
+        path = os.path.abspath(path)
+        if self.lookup(path) != None:
+            return defer.succeed(self.lookup(path))
+        if path in self._in_flight:
+            d = defer.Deferred()
+            self._in_flight[path].append(d)
+            return d
+        self._in_flight[path] = []
+        if digest == None:
+            # The library already knows the digest of stored files
+            info = library.lookup(path)
+            digest = info.digest if info != None else None
+        d = threads.deferToThread(self._identify, path, digest)
+        d.addCallback(self._render_if_needed, path)
+        d.addErrback(self._render_failed, path)
+        d.addBoth(self._prepared, path)
+        return d
+
+    def watch(self, index):
+        """Prepares files as they are added to a MetadataIndex, or changed.
+
+        Only contents the index did not have before are rendered. Files
+        already there, or evicted since, are rendered when they are
+        scheduled, so a library bigger than the cache is not rendered over
+        and over.
+        """
+        self._indexed = index.digests()
+        index.add_listener(self._index_changed)
+
+    def touch(self, render_path):
+        """Marks a render as recently used."""
+        try:
+            os.utime(render_path, None)
+        except OSError:
+            pass
+
+    # Private
+
+    def _identify(self, path, digest):
+        # Runs in a worker thread
+        st = os.stat(path)
+        if digest == None:
+            digest = content_hash(path)
+        render_path = os.path.join(self._cache_path, "%s-%s.raw" % (
+            digest, self._params))
+        exists = os.path.isfile(render_path)
+        if exists:
+            self.touch(render_path)
+        return st.st_size, st.st_mtime, render_path, exists, digest
+
+    def _render_if_needed(self, identity, path):
+        size, mtime, render_path, exists, digest = identity
+        if exists:
+            return identity
+        if render_path in self._rendering:
+            d = defer.Deferred()
+            self._rendering[render_path].append(d)
+            d.addCallback(lambda _: identity)
+            return d
+        self._rendering[render_path] = []
+        print("Rendering %s" % os.path.basename(path))
+        tmp_path = render_path + ".tmp"
+        if loudness.numpy == None:
+            # Nothing to analyse with, process it as it decodes
+            d = self._decode(path, tmp_path, COMPAND)
+            d.addCallback(self._rendered, identity, tmp_path)
+        else:
+            decoded_path = render_path + ".decoded"
+            d = self._decode(path, decoded_path, [])
+            d.addCallback(self._decoded, identity, decoded_path, tmp_path)
+        d.addBoth(self._render_done, render_path)
+        return d
+
+    def _decode(self, path, output_path, effects):
+        if library.file_format_for(path) == "MP3":
+            script = MP3_PIPELINE
+        else:
+            script = SOX_PIPELINE
+        # In a group of its own, so a timeout kills the decoder and sox too
+        return self._runner.run(
+            ["/bin/sh", "-c", script, "render", path, output_path] + effects,
+            timeout=self.render_timeout, group=True)
+
+    def _decoded(self, code, identity, decoded_path, tmp_path):
+        # Analyse the plain decode, then level, trim and compand it
+        if code != 0:
+            self._remove(decoded_path)
+            raise RuntimeError("decoder exited with %s" % code)
+        d = threads.deferToThread(loudness.analyse, decoded_path, SAMPLE_RATE)
+        d.addCallback(self._analysed, identity, decoded_path, tmp_path)
+        d.addBoth(self._remove_after, decoded_path)
+        return d
+
+    def _analysed(self, analysis, identity, decoded_path, tmp_path):
+        size, mtime, render_path, exists, digest = identity
+        library.record_analysis(digest, analysis)
+        d = self._runner.run(["sox"] + PCM_FORMAT + [decoded_path] +
+                             PCM_FORMAT + [tmp_path] + effects_for(analysis),
+                             timeout=self.render_timeout)
+        d.addCallback(self._rendered, identity, tmp_path)
+        return d
+
+    def _remove_after(self, result, path):
+        self._remove(path)
+        return result
+
+    def _remove(self, path):
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def _render_done(self, result, render_path):
+        for d in self._rendering.pop(render_path, []):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        return result
+
+    def _rendered(self, code, identity, tmp_path):
+        size, mtime, render_path, exists, digest = identity
+        if code != 0 or not os.path.isfile(tmp_path) \
+                or os.path.getsize(tmp_path) == 0:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise RuntimeError("renderer exited with %s" % code)
+        os.rename(tmp_path, render_path)
+        d = threads.deferToThread(self._evict, render_path)
+        d.addCallback(self._forget)
+        d.addCallback(lambda _: identity)
+        return d
+
+    def _evict(self, keep):
+        # Runs in a worker thread. Removes least recently used renders
+        # until we are back under the size limit. A render the player has
+        # queued or is playing is already open, so it plays out regardless
+        # and its space is freed when it is closed.
+        renders = []
+        total = 0
+        for name in os.listdir(self._cache_path):
+            if not name.endswith(".raw"):
+                continue
+            full = os.path.join(self._cache_path, name)
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            renders.append((st.st_mtime, st.st_size, full))
+            total += st.st_size
+        renders.sort()
+        removed = []
+        for mtime, size, full in renders:
+            if total <= self._max_bytes:
+                break
+            if full == keep:
+                continue
+            try:
+                os.remove(full)
+                total -= size
+                removed.append(full)
+            except OSError:
+                pass
+        return removed
+
+    def _forget(self, removed):
+        removed = set(removed)
+        for path, entry in list(self._renders.items()):
+            if entry[2] in removed:
+                del self._renders[path]
+        for digest, render_path in list(self._by_digest.items()):
+            if render_path in removed:
+                del self._by_digest[digest]
+
+    def _index_changed(self, index):
+        digests = index.digests()
+        new = digests - self._indexed
+        self._indexed = digests
+        for filename in index.filenames():
+            info = index.info(filename)
+            if info.digest in new and info.file_format != "unsupported":
+                new.discard(info.digest)
+                self.prepare(index.path(filename), info.digest)
+
+    def _render_failed(self, reason, path):
+        print("Could not render %s: %s" % (os.path.basename(path),
+                                           reason.getErrorMessage()))
+        return None
+
+    def _prepared(self, identity, path):
+        render_path = None
+        if identity != None:
+            size, mtime, render_path, exists, digest = identity
+            self._renders[path] = (size, mtime, render_path)
+            self._by_digest[digest] = render_path
+        for d in self._in_flight.pop(path, []):
+            d.callback(render_path)
+        return render_path
@@ -4,14 +4,22 @@
 """
 
 from datetime import datetime, timedelta
+import heapq
+import itertools
 import os
 import sys
 import time
 import uuid
-import pickle
-from threading import Timer
 
+from twisted.internet import reactor
+
+import archive
+import journal
+import metrics
 import playback
+import recurrence
+import timeline
+import timing
 
 class Gap(object):
     """A playlist item that represents a pause between other items.
@@ -39,6 +47,23 @@ class Inet(object):
 
 
 class ScheduledItem(object):
+    """One broadcast, or the next occurrence of a repeating one.
+
+    A repeating item has a recurrence.Rule. Its start_time is the start of
+    its next occurrence and occurrence counts from 0; when an occurrence
+    has played the same item moves on to the following one.
+
+    A hard_start item has its first audio go out at start_time rather than
+    as soon as we get to it. start_error records how close the last start
+    came, in seconds, as estimated from the audio the sink had queued.
+    """
+
+    # Class defaults so older pickled items still load
+    rule = None
+    occurrence = 0
+    hard_start = False
+    start_error = None
+
     def __init__(self):
         self.identifier = str(uuid.uuid4())
         self.playlist = []
@@ -47,28 +72,260 @@ class ScheduledItem(object):
         self.pending = False
 
 
+def summarise(item, status):
+    """Returns a plain dictionary describing a ScheduledItem.
+
+    This is what the web interface lists and what the archive keeps.
+    """
+    summary = {
+        "identifier": item.identifier,
+        "playlist": [str(e) for e in item.playlist],
+        "timestamp_string": item.start_time.strftime("%I:%M:%S %p %d/%m/%Y"),
+        "start_time": item.start_time,
+        "status": status,
+        "recurrence": None,
+        "hard_start": item.hard_start,
+        "start_error": item.start_error,
+    }
+    if item.rule != None:
+        summary["recurrence"] = str(item.rule)
+    return summary
+
+
+def describe_overlaps(items):
+    """Returns a message naming the schedules a new one would overlap."""
+    times = ", ".join(i.start_time.strftime("%I:%M:%S %p %d/%m/%Y")
+                      for i in items)
+    return "Overlaps the schedule starting at %s" % times
+
+
+def _collide(spans, others):
+    # Whether any of two lists of (start, end) spans overlap. Each list is
+    # ordered by start, and so by end as its spans are all the same length.
+    i = j = 0
+    while i < len(spans) and j < len(others):
+        if spans[i][0] < others[j][1] and others[j][0] < spans[i][1]:
+            return True
+        if spans[i][1] <= others[j][1]:
+            i += 1
+        else:
+            j += 1
+    return False
+
+
+def describe_error(e):
+    """Returns the message of an exception raised by a bad schedule."""
+    if isinstance(e, KeyError):
+        return "Missing field: %s" % e.args[0]
+    return str(e)
+
+
 class Scheduler(object):
+    """Starts ScheduledItems at their start times.
+
+    Pending items are kept in a min-heap on start time and a single reactor
+    call is armed for the earliest one, so nothing runs between broadcasts
+    however many schedules exist. Deleted or already started items are left
+    in the heap and skipped when they reach the top.
+
+    Changes are persisted through a journal.Journal, so each one costs a
+    small append rather than a rewrite of every schedule.
+
+    Only upcoming and on-air items are held here. Once an item has played,
+    or its start time passed without it playing, it is summarised into an
+    archive.Archive and forgotten.
+
+    The time each item will be on air, worked out from its file durations
+    and gaps, is kept in a timeline.Timeline. It only holds the next
+    occurrence of a repeating item, so repeating items are also checked
+    occurrence by occurrence up to overlap_horizon ahead. New schedules that
+    would overlap one already there are rejected, or with overlap_policy
+    "flag" accepted and reported. Should items still overlap (a file may be
+    replaced by a longer one), a later item waits for the one on air to
+    finish rather than cutting it off.
+
+    Hard start items are acted on hard_start_lead seconds early, so the
+    player can key up and decode ahead and start them on the instant.
+    """
 
     schedule_file = "../config/schedule.dat"
+    archive_file = "../config/archive.dat"
+
+    # Statuses accepted by query()
+    statuses = ("upcoming", "archived", "all")
+
+    # Longest we sleep before re-checking, in case the wall clock is stepped
+    max_wakeup_delay = 60.0
 
-    def __init__(self, player, radio):
+    # "reject" or "flag" schedules that overlap others
+    overlap_policy = "reject"
+
+    # How far ahead occurrences of repeating items are checked for overlaps
+    overlap_horizon = timedelta(days=366)
+
+    # Seconds allowed on top of the playlist for the channel to clear and
+    # PTT to key up
+    start_allowance = 5.0
+
+    # Seconds before a hard start that the channel is checked, PTT keyed
+    # and the first audio decoded
+    hard_start_lead = 3.0
+
+    def __init__(self, player, radio, library, renders=None,
+                 hard_start_lead=None, schedule_file=None, archive_file=None):
+        if hard_start_lead != None:
+            self.hard_start_lead = hard_start_lead
+        if schedule_file != None:
+            self.schedule_file = schedule_file
+        if archive_file != None:
+            self.archive_file = archive_file
         self._player = player
         self._radio = radio
-        self._items = []
+        self._library = library
+        self._renders = renders
+        self._items = {}
+        self._pending = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._timers = timing.Timers()
+        self._timeline = timeline.Timeline()
+        # Repeating items by identifier, for overlaps with later occurrences
+        self._recurring = {}
+        self.current_item = None
+        # Playlist position already handed to the player ahead of time
+        self._queued_position = None
+        # Bumped on every change to what items() or query() would return
+        self.version = 0
+
+        self._archive = archive.Archive(self.archive_file)
+        self._journal = journal.Journal(self.schedule_file, self.items)
+        for item in self._journal.load().values():
+            if item.pending:
+                self._insert(item)
+            else:
+                # Started before we were last shut down and will not
+                # resume. Older schedule files also hold every past item.
+                self._items[item.identifier] = item
+                self._retire(item, "completed")
+        # Start each run from a clean snapshot, which also discards any
+        # record torn by a crash
+        self._journal.compact()
+        self._prepare(self.items())
+        self._arm()
+
+    def items(self):
+        """Returns all upcoming and on-air items ordered by start time."""
+        return sorted(self._items.values(), key=lambda i: i.start_time)
+
+    def query(self, status="upcoming", start=None, end=None, after=None,
+              limit=50):
+        """Returns up to limit item summaries ordered by start time.
 
-        if os.path.isfile(self.schedule_file):
-            f = open(self.schedule_file, "rb")
-            self._items = pickle.load(f)
-            f.close()
+        status is one of Scheduler.statuses. start and end bound the start
+        time (end is exclusive) and after is the (start_time, identifier)
+        returned for the previous page. Also returns the (start_time,
+        identifier) to pass as after for the next page, or None.
+        """
+        if status not in self.statuses:
+            raise ValueError("Unknown status: %s" % status)
+        keys = []
+        if status in ("upcoming", "all"):
+            for item in self._items.values():
+                key = (item.start_time, item.identifier)
+                if start != None and key[0] < start:
+                    continue
+                if end != None and key[0] >= end:
+                    continue
+                if after != None and key <= after:
+                    continue
+                keys.append((key, item))
+        more = False
+        if status in ("archived", "all"):
+            summaries, following = self._archive.query(start, end, after, limit)
+            keys.extend(((s["start_time"], s["identifier"]), s) for s in summaries)
+            more = following != None
+        keys.sort(key=lambda k: k[0])
+        if len(keys) > limit:
+            keys = keys[:limit]
+            more = True
+        page = []
+        for key, entry in keys:
+            if isinstance(entry, ScheduledItem):
+                if entry is self.current_item:
+                    entry = summarise(entry, "active")
+                else:
+                    entry = summarise(entry, "pending")
+            page.append(entry)
+        if more and keys:
+            return page, keys[-1][0]
+        return page, None
 
-    def save_items(self):
-        # Make sure it exists first
-        #open(self.schedule_file, 'a').close()
-        f = open(self.schedule_file, "wb")
-        pickle.dump(self._items, f)
-        f.close()
+    def digests(self):
+        """Returns the set of content digests upcoming items will play."""
+        result = set()
+        for item in self._items.values():
+            for entry in item.playlist:
+                if isinstance(entry, playback.AudioFile) \
+                        and entry.digest() != None:
+                    result.add(entry.digest())
+        return result
+
+    def flush(self):
+        """Makes sure every change so far is on disk."""
+        self._journal.flush()
 
     def add_new_schedule(self, json_dict):
+        """Adds one schedule and returns its identifier.
+
+        Raises ValueError if the schedule is not valid.
+        """
+        item = self._build_item(json_dict)
+        overlaps = self._overlaps(item)
+        if overlaps:
+            if self.overlap_policy == "reject":
+                raise ValueError(describe_overlaps(overlaps))
+            print("Warning: %s" % describe_overlaps(overlaps))
+        self._commit([item])
+        return item.identifier
+
+    def add_schedules(self, json_dicts):
+        """Adds many schedules in one go.
+
+        Every schedule is validated first; the valid ones are then inserted
+        together, persisted with a single journal flush and one wakeup is
+        armed. Returns a result dictionary per schedule, in order, with
+        either the new identifier or the error.
+        """
+        results = []
+        items = []
+        # The batch is checked against itself as well as existing items
+        batch = timeline.Timeline()
+        for index, json_dict in enumerate(json_dicts):
+            try:
+                item = self._build_item(json_dict)
+                overlaps = self._overlaps(item, batch)
+                if overlaps and self.overlap_policy == "reject":
+                    raise ValueError(describe_overlaps(overlaps))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                results.append({"index": index, "ok": False,
+                                "error": describe_error(e)})
+                continue
+            items.append(item)
+            if item.pending:
+                start, end = self.span_of(item)
+                batch.add(item.identifier, start, end, item)
+            result = {"index": index, "ok": True,
+                      "identifier": item.identifier,
+                      "status": "pending" if item.pending else "missed"}
+            if overlaps:
+                result["overlaps"] = [o.identifier for o in overlaps]
+            results.append(result)
+        self._commit(items)
+        self.flush()
+        return results
+
+    def _build_item(self, json_dict):
+        # Validates a new schedule and makes its item, without adding it
         item = ScheduledItem()
         for f in json_dict["playlist"]:
             if f.startswith(":GAP:"):
@@ -84,30 +341,272 @@ class Scheduler(object):
             elif f.startswith(":INETOFF:"):
                 item.playlist.append(Inet(False))
             else:
-                a = playback.AudioFile("../files/%s" % f)
+                if not self._library.contains(f):
+                    raise ValueError("Not an audio file: %s" % f)
+                # Refer to the contents, so renaming the file is harmless
+                a = playback.AudioFile(self._library.path(f),
+                                       self._library.info(f).digest)
                 item.playlist.append(a)
         timestamp = json_dict["date"] + " " + json_dict["time"]
         date = datetime.strptime(timestamp, "%d/%m/%Y %I:%M:%S %p")
         item.start_time = date
-        # If it was scheduled in the past, do not mark it pending
+        if json_dict.get("recurrence"):
+            item.rule = recurrence.from_json(json_dict["recurrence"], date)
+            # Occurrences already in the past are skipped, not archived
+            occurrence = item.rule.next_after(max(datetime.now(), date) -
+                                              timedelta(microseconds=1))
+            if occurrence == None:
+                raise ValueError("Recurrence has no occurrences to come")
+            item.occurrence, item.start_time = occurrence
+        item.hard_start = bool(json_dict.get("hard_start"))
+        # If it was scheduled in the past it will never play
         item.pending = datetime.now() < item.start_time
-        self._items.append(item)
-        self.save_items()
+        return item
+
+    def span_of(self, item):
+        """Returns the (start, end) datetimes an item will be on air for."""
+        seconds = self.start_allowance
+        for entry in item.playlist:
+            if isinstance(entry, Gap):
+                seconds += entry.duration
+            elif isinstance(entry, playback.AudioFile):
+                seconds += entry.duration()
+        start = item.start_time
+        if item.hard_start:
+            # PTT is keyed ahead of time
+            start = self._due_time(item)
+        return start, item.start_time + timedelta(seconds=seconds)
+
+    def timeline(self, start, end):
+        """Returns summaries of items on air at any time in [start, end).
+
+        Each has "end_time" added, the time the item should finish.
+        """
+        result = []
+        for span_start, span_end, identifier, item in \
+                self._timeline.overlapping(start, end):
+            if item is self.current_item:
+                summary = summarise(item, "active")
+            else:
+                summary = summarise(item, "pending")
+            summary["end_time"] = span_end
+            result.append(summary)
+        return result
+
+    def _overlaps(self, item, batch=None):
+        # Items whose time on air would overlap this one's
+        if not item.pending:
+            return []
+        until = datetime.now() + self.overlap_horizon
+        spans = self._spans(item, until)
+        timelines = [self._timeline]
+        others = list(self._recurring.values())
+        if batch != None:
+            timelines.append(batch)
+            others += [o for o in batch.values() if o.rule != None]
+        found = []
+        for t in timelines:
+            for start, end in spans:
+                for o in t.overlapping(start, end):
+                    if not any(o[3] is f for f in found):
+                        found.append(o[3])
+        # Only the next occurrence of these is in the timelines
+        for other in others:
+            if not any(other is f for f in found) and \
+                    _collide(spans, self._spans(other, until)):
+                found.append(other)
+        return found
+
+    def _spans(self, item, until):
+        # (start, end) of an item's next occurrence and of each later one
+        # starting before until, in order
+        start, end = self.span_of(item)
+        spans = [(start, end)]
+        if item.rule != None:
+            for index, when in item.rule.between(
+                    item.start_time + timedelta(microseconds=1), until):
+                offset = when - item.start_time
+                spans.append((start + offset, end + offset))
+        return spans
+
+    def _commit(self, items):
+        # Inserts built items and records them
+        if not items:
+            return
+        self.version += 1
+        missed = []
+        for item in items:
+            if not item.pending:
+                missed.append(summarise(item, "missed"))
+                continue
+            self._insert(item)
+            self._journal.add(item)
+        if missed:
+            self._archive.add_many(missed)
+        self._prepare([item for item in items if item.pending])
+        self._arm()
+
+    def _prepare(self, items):
+        # Get the items' files rendered well before they are needed. Done
+        # again on loading and for each new occurrence, which brings back
+        # renders evicted since.
+        if self._renders == None:
+            return
+        digests = {}
+        for item in items:
+            for entry in item.playlist:
+                if isinstance(entry, playback.AudioFile):
+                    digests[entry.path()] = entry.digest()
+        for path in sorted(digests):
+            self._renders.prepare(path, digests[path])
 
     def delete_schedule(self, identifier):
-        self._items = [i for i in self._items if i.identifier != identifier]
-        self.save_items()
-
-    def tick(self):
-        for i in self._items:
-            if i.pending and i.start_time < datetime.now() \
-                    and len(i.playlist) > 0:
-                # Uh make this better
-                i.pending = False
-                self.save_items()
-                self.current_item = i
+        self.version += 1
+        self._timeline.remove(identifier)
+        self._recurring.pop(identifier, None)
+        if self._items.pop(identifier, None) != None:
+            self._journal.delete(identifier)
+        else:
+            self._archive.delete(identifier)
+        if self.current_item != None and self.current_item.identifier == identifier:
+            # Abandon the rest of its playlist
+            self._timers.cancel_all()
+            self._player.stop()
+            self.current_item = None
+            # Something may have been waiting for it to finish
+            self._arm()
+
+    def _insert(self, item):
+        self._items[item.identifier] = item
+        if item.pending:
+            heapq.heappush(self._pending,
+                           (item.start_time, next(self._sequence), item))
+            start, end = self.span_of(item)
+            self._timeline.add(item.identifier, start, end, item)
+            if item.rule != None:
+                self._recurring[item.identifier] = item
+
+    def _next_pending(self):
+        # Drop heap entries for items that were deleted or already started
+        while self._pending:
+            start_time, sequence, item = self._pending[0]
+            if item.pending and self._items.get(item.identifier) is item \
+                    and item.start_time == start_time:
+                return item
+            heapq.heappop(self._pending)
+        return None
+
+    def _arm(self):
+        """Schedules a wakeup for the earliest pending item."""
+        if self._wakeup != None and self._wakeup.active():
+            self._wakeup.cancel()
+        self._wakeup = None
+        item = self._next_pending()
+        if item == None:
+            return
+        delay = (self._due_time(item) - datetime.now()).total_seconds()
+        delay = min(max(delay, 0), self.max_wakeup_delay)
+        self._wakeup = reactor.callLater(delay, self._wake)
+
+    def _wake(self):
+        self._wakeup = None
+        now = datetime.now()
+        while True:
+            item = self._next_pending()
+            if item == None or self._due_time(item) > now:
+                break
+            if self.current_item != None:
+                # Overlaps the broadcast on air; it starts when that ends
+                print("Holding schedule until the current one finishes")
+                return
+            heapq.heappop(self._pending)
+            item.pending = False
+            self.version += 1
+            if not item.hard_start:
+                metrics.start_lateness.observe(
+                    (datetime.now() - item.start_time).total_seconds())
+            self._journal.update(item)
+            if len(item.playlist) > 0:
+                self.current_item = item
                 self.current_item.position = 0
-                self._play_playlist_entry(0)
+                self._queued_position = None
+                if not (item.hard_start and self._hard_start(item)):
+                    self._play_playlist_entry(0)
+            else:
+                self._retire(item, "completed")
+        self._arm()
+
+    def _due_time(self, item):
+        # When we have to act on a pending item
+        if item.hard_start:
+            return item.start_time - timedelta(seconds=self.hard_start_lead)
+        return item.start_time
+
+    def _hard_start(self, item):
+        # Start the first audio of an item at its start time. IRLP
+        # and Echolink switches ahead of it happen now, gaps ahead of it
+        # push it back. Returns False if there is no audio to start.
+        first = None
+        for position, entry in enumerate(item.playlist):
+            if isinstance(entry, playback.AudioFile):
+                first = position
+                break
+        if first == None:
+            return False
+        start_at = time.mktime(item.start_time.timetuple()) + \
+            item.start_time.microsecond / 1e6
+        for entry in item.playlist[:first]:
+            if isinstance(entry, Gap):
+                start_at += entry.duration
+            else:
+                self._switch_inet(entry.on)
+        item.position = first
+        self._player.play_at(item.playlist[first], start_at,
+                             self.playback_finished,
+                             lambda error: self._hard_started(item, error))
+        self._queue_next_file(first)
+        return True
+
+    def _hard_started(self, item, error):
+        print("Hard start %.1f ms %s" % (abs(error) * 1000.0,
+                                          "late" if error > 0 else "early"))
+        item.start_error = error
+        self.version += 1
+        if self._items.get(item.identifier) is item:
+            self._journal.update(item)
+
+    def _retire(self, item, status):
+        # Move a finished item out of the hot store into the archive. The
+        # archive write is synchronous, so a crash in between leaves the item
+        # in both and it is archived again, harmlessly, on the next start.
+        self.version += 1
+        self._timeline.remove(item.identifier)
+        summary = summarise(item, status)
+        if item.rule != None:
+            # Each occurrence is archived under its own identifier
+            summary["identifier"] = "%s.%d" % (item.identifier, item.occurrence)
+            summary["schedule"] = item.identifier
+        self._archive.add(summary)
+        if item.rule != None and self._advance(item):
+            return
+        self._recurring.pop(item.identifier, None)
+        if self._items.pop(item.identifier, None) != None:
+            self._journal.delete(item.identifier)
+
+    def _advance(self, item):
+        # Materialise the next occurrence of a repeating item in place.
+        # Occurrences missed while we were not running are skipped.
+        occurrence = item.rule.next_after(max(item.start_time, datetime.now()))
+        if occurrence == None:
+            return False
+        item.occurrence, item.start_time = occurrence
+        item.position = 0
+        item.pending = True
+        self._journal.update(item)
+        self._insert(item)
+        self._prepare([item])
+        self._arm()
+        return True
 
     def playback_finished(self):
         # The player is letting us know that it finished playing a file
@@ -115,24 +614,52 @@ class Scheduler(object):
         if self.current_item.position < len(self.current_item.playlist):
             self._play_playlist_entry(self.current_item.position)
         else:
+            item = self.current_item
             self.current_item = None
+            self._retire(item, "completed")
+            # Start anything that was held waiting for it
+            self._arm()
 
     def _play_playlist_entry(self, position):
         entry = self.current_item.playlist[position]
         if isinstance(entry, Gap):
             print("Gap of duration %d" % entry.duration)
-            Timer(entry.duration, self.playback_finished, ()).start()
+            self._timers.call_later(entry.duration, self.playback_finished)
         elif isinstance(entry, Inet):
-            if entry.on:
-                print("Echolink and IRLP on")
-                self._radio.echolink_on()
-                self._radio.irlp_on()
-            else:
-                print("Echolink and IRLP off")
-                self._radio.echolink_off()
-                self._radio.irlp_off()
+            self._switch_inet(entry.on)
             self.playback_finished()
         else:
             print("Playing entry in position %d" % position)
-            # Wait one second to let PTT reset
-            Timer(1.0, self._player.play_file, (entry, self.playback_finished)).start()
+            if position == self._queued_position:
+                # Already queued behind the previous file
+                self._queue_next_file(position)
+            elif self._player.is_on_air():
+                self._start_file(position)
+            else:
+                # Wait one second to let PTT reset
+                self._timers.call_later(1.0, self._start_file, position)
+
+    def _switch_inet(self, on):
+        if on:
+            print("Echolink and IRLP on")
+            self._radio.echolink_on()
+            self._radio.irlp_on()
+        else:
+            print("Echolink and IRLP off")
+            self._radio.echolink_off()
+            self._radio.irlp_off()
+
+    def _start_file(self, position):
+        entry = self.current_item.playlist[position]
+        self._player.play_file(entry, self.playback_finished)
+        self._queue_next_file(position)
+
+    def _queue_next_file(self, position):
+        # Hand a following file to the player now so it plays straight on
+        # from this one under the same PTT
+        following = position + 1
+        if following < len(self.current_item.playlist):
+            entry = self.current_item.playlist[following]
+            if isinstance(entry, playback.AudioFile):
+                self._player.play_file(entry, self.playback_finished)
+                self._queued_position = following
@@ -1,7 +1,8 @@
 #!/usr/bin/python
 
 from twisted.web import server, resource, static
-from twisted.internet import reactor, task
+from twisted.internet import reactor, task, threads
+from twisted.python import threadpool
 from twisted.web.wsgi import WSGIResource
 
 from twisted.web.template import Element, renderer, XMLFile
@@ -9,20 +10,24 @@ from twisted.python.filepath import FilePath
 from twisted.web.template import flattenString
 
 import os
+import time
 
 from wsgidav.wsgidav_app import WsgiDAVApp
-from wsgidav.fs_dav_provider import FilesystemProvider
 from wsgidav.wsgidav_app import DEFAULT_CONFIG
 
 from configobj import ConfigObj
 
-import radio
-import playback
+import control
+import dav
+import library
+import metrics
+import nodes
+import render
 import web
-import scheduler
+import store
+import uploads
 
 app_settings = ConfigObj("../config/settings.cfg")
-irlp_home = app_settings['irlp_home']
 port = int(app_settings['port'])
 
 
@@ -30,7 +35,7 @@ class ExampleElement(Element):
     loader = XMLFile(FilePath('../web/index.xml'))
 
     def getFiles(self):
-        return os.listdir('../files/')
+        return services.library.filenames()
 
     @renderer
     def files(self, request, tag):
@@ -40,14 +45,12 @@ class ExampleElement(Element):
 
 
 
-class Simple(resource.Resource):
+class Simple(web.CachedPage):
     isLeaf = False
-    def render_GET(self, request):
-        def renderDone(output):
-            request.write(output)
-            request.finish()
-        flattenString(None, ExampleElement()).addCallback(renderDone)
-        return server.NOT_DONE_YET
+    def __init__(self):
+        # Re-rendered when index.xml or the set of files changes
+        web.CachedPage.__init__(self, web.TemplateCache(
+            ExampleElement, '../web/index.xml', lambda: services.library.version))
 
 class Hello(resource.Resource):
     isLeaf = True
@@ -64,7 +67,7 @@ class Hello(resource.Resource):
         return "Hello, world\n"
 
 config = DEFAULT_CONFIG.copy()
-provider = FilesystemProvider('../files/')
+provider = dav.FilesystemProvider('../files/')
 config.update({
     "mount_path": "",
     "provider_mapping": {"/": provider},
@@ -83,15 +86,70 @@ class Services:
     pass
 
 services = Services()
-services.radio = radio.Radio(irlp_home)
-services.player = playback.Player(services.radio)
-services.scheduler = scheduler.Scheduler(services.player, services.radio)
+# Audio is kept by content in the store, ../files is the named view of it
+services.store = store.ContentStore('../store')
+services.library = library.MetadataIndex('../files/', '../config/metadata.dat',
+                                         services.store)
+library.set_default_index(services.library)
+services.library.start()
+# Renders get their own runner so a long decode never holds up node control.
+# Every node shares them, so a file scheduled on several is decoded once.
+services.renders = render.RenderCache(
+    '../cache/render', int(app_settings.get('render_cache_mb', 500)) * 1024 * 1024,
+    control.CommandRunner(max_concurrent=1))
+services.renders.watch(services.library)
+services.nodes = nodes.create_nodes(app_settings, services.library,
+                                    services.renders)
+# The first node also answers at /radio and /schedule, as before
+first_node = services.nodes[0]
+services.runner = first_node.runner
+services.radio = first_node.radio
+services.player = first_node.player
+services.scheduler = first_node.scheduler
+services.status = first_node.status
+
+def collect_blobs(index):
+    # Drop stored content no file or upcoming schedule refers to
+    digests = set()
+    for node in services.nodes:
+        digests.update(node.scheduler.digests())
+    threads.deferToThread(services.store.collect, digests)
+services.library.add_listener(collect_blobs)
+services.uploads = uploads.UploadStats()
+
+def per_node(function):
+    return lambda: dict(((node.name,), function(node)) for node in services.nodes)
+
+metrics.Gauge("player_underruns",
+              "Audio engine underruns since startup.",
+              per_node(lambda node: node.player.engine_stats()["underruns"]),
+              labels=("node",))
+metrics.Gauge("player_buffered_seconds",
+              "Decoded audio waiting in the engine buffer.",
+              per_node(lambda node: node.player.engine_stats()["buffered_seconds"]),
+              labels=("node",))
+metrics.Gauge("radio_commands_in_flight",
+              "Node commands running or queued.",
+              per_node(lambda node: node.runner.in_flight()),
+              labels=("node",))
+metrics.Gauge("scheduler_items",
+              "Upcoming and on air schedules.",
+              per_node(lambda node: len(node.scheduler.items())),
+              labels=("node",))
+
+TICK_INTERVAL = 0.250
+last_tick = [None]
 
 # Put all top level module instances here that need to get stuff done
 def top_ticker():
-    services.radio.tick()
-    services.player.tick()
-    services.scheduler.tick()
+    started = time.time()
+    if last_tick[0] != None:
+        metrics.ticker_lateness.observe(
+            max(0.0, started - last_tick[0] - TICK_INTERVAL))
+    last_tick[0] = started
+    for node in services.nodes:
+        node.tick()
+    metrics.ticker_duration.observe(time.time() - started)
 
 
 
@@ -105,16 +163,40 @@ radio_controller = web.RadioController(services)
 root.putChild("radio", radio_controller)
 schedule_controller = web.ScheduleController(services)
 root.putChild("schedule", schedule_controller)
-root.putChild("dav", WSGIResource(reactor, reactor.getThreadPool(), wsgidav_application))
-root.putChild("home", web.HomePage())
+root.putChild("nodes", web.NodesController(services.nodes))
+# WebDAV gets a pool of its own so slow uploads cannot starve the reactor's
+# pool, which the library scanner and render cache use
+dav_pool = threadpool.ThreadPool(
+    minthreads=1, maxthreads=int(app_settings.get('dav_threads', 4)), name="dav")
+reactor.callWhenRunning(dav_pool.start)
+reactor.addSystemEventTrigger('during', 'shutdown', dav_pool.stop)
+root.putChild("dav", WSGIResource(reactor, dav_pool, wsgidav_application))
+root.putChild("uploads", web.UploadStatus(services))
+root.putChild("metrics", web.Metrics())
+home_page = web.HomePage()
+root.putChild("home", home_page)
 
 site = server.Site(root)
+# Uploads are limited and metered as they arrive, see uploads.py
+site.requestFactory = uploads.UploadRequest
+site.upload_limiter = uploads.UploadLimiter(
+    services.uploads,
+    uploads_per_client=int(app_settings.get('dav_uploads_per_client', 2)),
+    uploaded=lambda path, size, digest: services.library.expect(
+        os.path.basename(path), size, digest))
+
 
 
 
+# Render the home page now rather than on the first request
+home_page.warm()
 
 ticker = task.LoopingCall(top_ticker)
-ticker.start(0.250) # call every 250 ms
+ticker.start(TICK_INTERVAL) # call every 250 ms
+
+# Don't lose the last few schedule changes on a clean shutdown
+for node in services.nodes:
+    reactor.addSystemEventTrigger('before', 'shutdown', node.scheduler.flush)
 
 reactor.listenTCP(port, site)
 reactor.run()
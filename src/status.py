@@ -0,0 +1,167 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Radio status for the web interface, computed once and pushed to clients.
+
+The StatusPublisher builds the status dictionary the web page shows from the
+radio, player and scheduler, and keeps the last one it built. Each time
+something changes, only the fields that differ are sent to every connected
+listener as one pre-encoded message, so the work is the same for one
+browser or fifty. Playback progress changes every second on its own, so
+changes to it alone are sent at most once per progress_interval.
+"""
+
+import json
+import time
+
+from twisted.internet import reactor
+
+
+class StatusPublisher(object):
+    """Computes the status once per change and fans it out to listeners.
+
+    services is the server's Services object. Listeners are called with
+    one encoded Server-Sent Events message at a time.
+    """
+
+    # Least time between messages that only move the progress on
+    progress_interval = 1.0
+
+    # Comment sent to idle clients so proxies keep the connection open
+    heartbeat_interval = 15.0
+
+    # status() reuses a computation at most this old
+    max_age = 0.25
+
+    def __init__(self, services, clock=reactor):
+        self._s = services
+        self._clock = clock
+        self._listeners = []
+        self._status = None
+        self._computed = 0
+        # Last status sent to listeners and when
+        self._published = None
+        self._progress_sent = 0
+        self._last_sent = 0
+        self._publish_call = None
+        # Bumped whenever a computation differs from the one before
+        self.version = 0
+        self._s.radio.add_listener(self._radio_changed)
+
+    # Public
+
+    def status(self):
+        """Returns the current status dictionary.
+
+        Polling clients share a computation made within max_age seconds.
+        """
+        now = time.time()
+        if self._status == None or now - self._computed >= self.max_age:
+            status = self._compute()
+            if status != self._status:
+                self.version += 1
+            self._status = status
+            self._computed = now
+        return self._status
+
+    def subscribe(self, callback):
+        """Adds a listener and returns the full status message for it.
+
+        Later changes are sent relative to the status returned, so none
+        made before the next tick are lost.
+        """
+        now = time.time()
+        status = self.status()
+        if self._published == None:
+            self._progress_sent = now
+            self._last_sent = now
+        else:
+            # Bring the other listeners up to the same status first
+            delta = self._changes(status)
+            if delta:
+                self._publish(status, delta, now)
+        self._published = status
+        self._listeners.append(callback)
+        return encode_event(status)
+
+    def unsubscribe(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def listener_count(self):
+        return len(self._listeners)
+
+    def tick(self):
+        """Called every 250ms by the main app to look for changes."""
+        if not self._listeners:
+            # Nobody to tell, so don't compute anything
+            self._published = None
+            return
+        now = time.time()
+        status = self.status()
+        delta = self._changes(status)
+        if list(delta.keys()) == ["progress"]:
+            if now - self._progress_sent < self.progress_interval:
+                delta = {}
+        if delta:
+            self._publish(status, delta, now)
+        elif now - self._last_sent >= self.heartbeat_interval:
+            self._send(": keepalive\n\n", now)
+
+    # Private
+
+    def _compute(self):
+        status = {}
+
+        # Shared snapshot from the last tick, this never runs pttstate
+        state = self._s.radio.state()
+        status["ptt"] = state.ptt
+        status["ptt_locked"] = state.ptt_locked
+        status["irlp_active"] = state.irlp_active
+        status["echolink_active"] = state.echolink_active
+
+        status["file_playing"] = self._s.player.current_file()
+        status["playback_status"] = self._s.player.playback_status()
+        status["progress"] = self._s.player.progress_string()
+
+        engine_stats = self._s.player.engine_stats()
+        status["underruns"] = engine_stats["underruns"]
+        status["start_latency"] = engine_stats["start_latency"]
+
+        status["schedule_version"] = self._s.scheduler.version
+        return status
+
+    def _radio_changed(self, event, active):
+        # PTT and COS changes should reach the page at once rather than on
+        # the next tick; coalesce a burst of them into one message
+        if self._listeners and self._publish_call == None:
+            self._publish_call = self._clock.callLater(0, self._publish_now)
+
+    def _publish_now(self):
+        self._publish_call = None
+        self._computed = 0
+        self.tick()
+
+    def _changes(self, status):
+        # Fields that differ from the last status published
+        delta = {}
+        for key, value in status.items():
+            if self._published.get(key) != value:
+                delta[key] = value
+        return delta
+
+    def _publish(self, status, delta, now):
+        self._published = status
+        if "progress" in delta:
+            self._progress_sent = now
+        self._send(encode_event(delta), now)
+
+    def _send(self, message, now):
+        self._last_sent = now
+        for callback in list(self._listeners):
+            callback(message)
+
+
+def encode_event(status):
+    """Returns a status dictionary as a Server-Sent Events message."""
+    return "data: %s\n\n" % json.dumps(status, sort_keys=True,
+                                        separators=(",", ":"))
@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Content-addressed storage for audio files.
+
+Every audio file in the files directory is hard linked into the store under
+the SHA-256 of its contents, e.g. blobs/3f/3fa9...e1, so the blob is the
+only copy of the bytes. The files directory stays the name-based view that
+WebDAV and the web page use, and the MetadataIndex keeps the name to hash
+catalogue.
+
+A link shares its contents with the blob, so nothing may write into a file
+in place: uploads are written to a temporary file and renamed over the old
+name (see dav.py), which leaves the blob as it was.
+
+Storing by hash gives us:
+
+  - deduplication: a file whose contents are already stored is replaced
+    by a hard link to the existing blob, so contents are stored once
+    however many names they have;
+  - stable references: schedules refer to the hash, so a file can be
+    renamed or even deleted from the files directory and still play;
+  - a content key for anything derived from the audio, such as durations
+    and renders.
+
+All methods except path() do file I/O and are meant for a worker thread.
+"""
+
+import hashlib
+import os
+
+
+def file_digest(path):
+    """Returns the SHA-256 hex digest of a file, read in blocks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class ContentStore(object):
+    """Blobs named by the SHA-256 of their contents.
+
+    store_path must be on the same filesystem as the files it takes in.
+    """
+
+    def __init__(self, store_path):
+        self._blobs_path = os.path.abspath(os.path.join(store_path, "blobs"))
+        if not os.path.isdir(self._blobs_path):
+            os.makedirs(self._blobs_path)
+
+    def path(self, digest):
+        """Returns where the blob for digest lives, whether or not it exists."""
+        return os.path.join(self._blobs_path, digest[:2], digest)
+
+    def contains(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    def add(self, path, digest=None):
+        """Takes a named file into the store and returns its digest.
+
+        digest, if known (e.g. computed while the file was uploaded), saves
+        reading the file again. If the contents are already stored, path
+        is replaced by a hard link to the existing blob.
+        """
+        if digest == None:
+            digest = file_digest(path)
+        blob = self.path(digest)
+        if not os.path.isdir(os.path.dirname(blob)):
+            os.makedirs(os.path.dirname(blob))
+        try:
+            if not os.path.isfile(blob):
+                os.link(path, blob)
+            elif not os.path.samefile(path, blob):
+                # A duplicate, keep one copy. Atomic, so the name never
+                # disappears.
+                tmp_path = path + ".dedup"
+                os.link(blob, tmp_path)
+                os.rename(tmp_path, path)
+                print("%s duplicates stored content, linked" %
+                      os.path.basename(path))
+        except OSError as e:
+            print("Could not store %s: %s" % (os.path.basename(path), e))
+        return digest
+
+    def collect(self, keep):
+        """Removes blobs no file links to any more and not in keep.
+
+        keep is a set of digests still wanted, e.g. by schedules. Returns
+        the number of blobs removed.
+        """
+        removed = 0
+        for directory in os.listdir(self._blobs_path):
+            directory = os.path.join(self._blobs_path, directory)
+            if not os.path.isdir(directory):
+                continue
+            for digest in os.listdir(directory):
+                blob = os.path.join(directory, digest)
+                try:
+                    if os.stat(blob).st_nlink == 1 and digest not in keep:
+                        os.remove(blob)
+                        removed += 1
+                except OSError:
+                    continue
+        return removed
@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""When scheduled broadcasts will be on air.
+
+The Timeline is an interval tree: a treap of (start, end) spans ordered by
+start time, where every node also records the latest end time anywhere in
+its subtree. Finding every span that overlaps a range then only visits the
+O(log n) nodes on the way down plus the k spans that match, instead of
+every schedule.
+"""
+
+import random
+
+
+class _Node(object):
+    __slots__ = ("key", "end", "value", "priority", "left", "right", "max_end")
+
+    def __init__(self, key, end, value):
+        self.key = key
+        self.end = end
+        self.value = value
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.max_end = end
+
+    def update(self):
+        self.max_end = self.end
+        if self.left != None and self.left.max_end > self.max_end:
+            self.max_end = self.left.max_end
+        if self.right != None and self.right.max_end > self.max_end:
+            self.max_end = self.right.max_end
+
+
+class Timeline(object):
+    """Spans of time, each belonging to an identifier.
+
+    Spans are half open: a span ending at 18:00 does not overlap one
+    starting at 18:00. Start and end may be anything ordered, such as
+    datetimes.
+    """
+
+    def __init__(self):
+        self._root = None
+        # identifier -> (start, end, value)
+        self._spans = {}
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __contains__(self, identifier):
+        return identifier in self._spans
+
+    def add(self, identifier, start, end, value=None):
+        """Adds a span, replacing any the identifier already had."""
+        self.remove(identifier)
+        self._spans[identifier] = (start, end, value)
+        self._root = self._insert(self._root, _Node((start, identifier), end,
+                                                    value))
+
+    def remove(self, identifier):
+        """Removes an identifier's span. Returns False if it had none."""
+        span = self._spans.pop(identifier, None)
+        if span == None:
+            return False
+        self._root = self._delete(self._root, (span[0], identifier))
+        return True
+
+    def span(self, identifier):
+        """Returns (start, end) for an identifier, or None."""
+        span = self._spans.get(identifier)
+        if span == None:
+            return None
+        return span[0], span[1]
+
+    def values(self):
+        """Returns the value of every span, in no particular order."""
+        return [span[2] for span in self._spans.values()]
+
+    def overlapping(self, start, end):
+        """Returns (start, end, identifier, value) for spans overlapping
+        [start, end), ordered by start."""
+        found = []
+        self._search(self._root, start, end, found)
+        return found
+
+    # Private
+
+    def _insert(self, node, new):
+        if node == None:
+            return new
+        if new.key < node.key:
+            node.left = self._insert(node.left, new)
+            if node.left.priority > node.priority:
+                node = self._rotate_right(node)
+        else:
+            node.right = self._insert(node.right, new)
+            if node.right.priority > node.priority:
+                node = self._rotate_left(node)
+        node.update()
+        return node
+
+    def _delete(self, node, key):
+        if node == None:
+            return None
+        if key < node.key:
+            node.left = self._delete(node.left, key)
+        elif key > node.key:
+            node.right = self._delete(node.right, key)
+        else:
+            # Rotate it down until it has at most one child
+            if node.left == None:
+                return node.right
+            if node.right == None:
+                return node.left
+            if node.left.priority > node.right.priority:
+                node = self._rotate_right(node)
+                node.right = self._delete(node.right, key)
+            else:
+                node = self._rotate_left(node)
+                node.left = self._delete(node.left, key)
+        node.update()
+        return node
+
+    def _rotate_right(self, node):
+        left = node.left
+        node.left = left.right
+        left.right = node
+        node.update()
+        left.update()
+        return left
+
+    def _rotate_left(self, node):
+        right = node.right
+        node.right = right.left
+        right.left = node
+        node.update()
+        right.update()
+        return right
+
+    def _search(self, node, start, end, found):
+        # In order, so results come out sorted by start
+        if node == None or node.max_end <= start:
+            # Everything below ends before the range begins
+            return
+        self._search(node.left, start, end, found)
+        node_start, identifier = node.key
+        if node_start >= end:
+            # This and everything to the right starts after the range
+            return
+        if node.end > start:
+            found.append((node_start, node.end, identifier, node.value))
+        self._search(node.right, start, end, found)
@@ -0,0 +1,47 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Delayed calls on the reactor.
+
+Every wait in the playback state machine (gaps between playlist entries,
+letting PTT reset, letting the repeater key up) goes through a Timers object
+instead of a thread or a sleep. The calls run on the reactor thread like
+everything else, and an owner can cancel all of its outstanding calls at
+once when it changes its mind.
+"""
+
+from twisted.internet import reactor
+
+
+class Timers(object):
+    """A set of pending delayed calls belonging to one owner."""
+
+    def __init__(self, clock=reactor):
+        self._clock = clock
+        self._calls = set()
+
+    def call_later(self, delay, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) after delay seconds.
+
+        Returns the IDelayedCall so the caller can cancel just this call.
+        """
+        holder = []
+
+        def fire():
+            self._calls.discard(holder[0])
+            func(*args, **kwargs)
+
+        call = self._clock.callLater(delay, fire)
+        holder.append(call)
+        self._calls.add(call)
+        return call
+
+    def cancel_all(self):
+        """Cancels every call that has not run yet."""
+        for call in list(self._calls):
+            if call.active():
+                call.cancel()
+        self._calls.clear()
+
+    def pending(self):
+        """Returns the number of calls still waiting to run."""
+        return len([c for c in self._calls if c.active()])
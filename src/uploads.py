@@ -0,0 +1,218 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Limits and metrics for audio uploads over WebDAV.
+
+WsgiDAV runs on its own thread pool (see server.py) so that a few large
+uploads over a slow link cannot starve the reactor's pool, which the
+library scanner and render cache depend on.
+
+Twisted reads a whole request body, spooling large ones to a temporary
+file, before the WSGI application sees it. So uploads are limited and
+metered by UploadRequest, the site's request class, as the body arrives
+from the network. A client already running as many uploads as it may has
+its request refused as soon as the headers are in, before any of the body
+is read, and the bytes counted into UploadStats are the bytes on the wire.
+
+The SHA-256 of each upload is worked out as it streams in, so the content
+store does not have to read the file again once it lands.
+"""
+
+import collections
+import hashlib
+import threading
+import time
+
+try:
+    from urllib import unquote as unquote_to_bytes
+except ImportError:
+    from urllib.parse import unquote_to_bytes
+
+import web
+
+
+class UploadStats(object):
+    """Counters for uploads, safe to update from any thread."""
+
+    # Seconds of history used for the throughput figure
+    window = 10
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = {}
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._bytes = 0
+        # [second, bytes] for each recent second that saw data
+        self._recent = collections.deque()
+
+    def try_start(self, client, limit):
+        """Counts an upload from client in, unless it already has limit running."""
+        with self._lock:
+            running = self._active.get(client, 0)
+            if limit > 0 and running >= limit:
+                self._rejected += 1
+                return False
+            self._active[client] = running + 1
+            return True
+
+    def finished(self, client, ok):
+        with self._lock:
+            running = self._active.get(client, 0) - 1
+            if running > 0:
+                self._active[client] = running
+            else:
+                self._active.pop(client, None)
+            if ok:
+                self._completed += 1
+            else:
+                self._failed += 1
+
+    def received(self, count):
+        """Records count bytes of upload data."""
+        second = int(time.time())
+        with self._lock:
+            self._bytes += count
+            if self._recent and self._recent[-1][0] == second:
+                self._recent[-1][1] += count
+            else:
+                self._recent.append([second, count])
+            self._trim(second)
+
+    def snapshot(self):
+        """Returns the counters as a dictionary."""
+        with self._lock:
+            self._trim(int(time.time()))
+            recent = sum(count for second, count in self._recent)
+            return {
+                "active_uploads": sum(self._active.values()),
+                "active_clients": len(self._active),
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "bytes_received": self._bytes,
+                "bytes_per_second": recent / float(self.window),
+            }
+
+    def _trim(self, second):
+        while self._recent and self._recent[0][0] <= second - self.window:
+            self._recent.popleft()
+
+
+class UploadLimiter(object):
+    """How uploads are limited, for UploadRequest.
+
+    uploads_per_client of 0 means no limit. uploaded(path, size, digest) is
+    called, on the reactor thread, for every successful upload. Only PUTs
+    to paths under prefix count as uploads.
+    """
+
+    upload_methods = (b"PUT",)
+
+    def __init__(self, stats, uploads_per_client=2, uploaded=None,
+                 prefix=b"/dav/"):
+        self.stats = stats
+        self.uploads_per_client = uploads_per_client
+        self.uploaded = uploaded
+        self.prefix = prefix
+
+    def is_upload(self, method, path):
+        return method in self.upload_methods and path.startswith(self.prefix)
+
+
+class UploadRequest(web.TimedRequest):
+    """Request that limits and meters uploads while their bodies arrive.
+
+    Uses the UploadLimiter in the site's upload_limiter attribute. A client
+    over its limit gets 503 with a Retry-After header, which DAV clients
+    treat as a transient failure, and its connection is closed so the body
+    is never read.
+    """
+
+    _upload = None
+    _rejected = False
+    # Whether the refusal went straight out on the transport
+    _refused_early = False
+
+    def gotLength(self, length):
+        web.TimedRequest.gotLength(self, length)
+        limiter = getattr(self.channel.site, "upload_limiter", None)
+        # Only the channel knows the method and path this early
+        method = getattr(self.channel, "_command", None)
+        path = getattr(self.channel, "_path", None) or b""
+        if limiter == None or not limiter.is_upload(method, path):
+            return
+        client = self.channel.transport.getPeer().host
+        if not limiter.stats.try_start(client, limiter.uploads_per_client):
+            self._reject()
+            return
+        self._upload = _Upload(limiter, client, path)
+        self.notifyFinish().addBoth(self._upload_done)
+
+    def handleContentChunk(self, data):
+        if self._rejected:
+            return
+        if self._upload != None:
+            self._upload.received(data)
+        web.TimedRequest.handleContentChunk(self, data)
+
+    def process(self):
+        if self._refused_early:
+            # Answered already, the connection is closing
+            return
+        if self._rejected:
+            self.setResponseCode(503)
+            self.setHeader(b"Retry-After", b"10")
+            self.setHeader(b"Content-Type", b"text/plain")
+            self.write(_REFUSED)
+            self.finish()
+            return
+        web.TimedRequest.process(self)
+
+    def _reject(self):
+        self._rejected = True
+        # Don't invite the body with 100 Continue
+        self.requestHeaders.removeHeader(b"expect")
+        if self.channel.requests and self.channel.requests[0] is not self:
+            # Earlier pipelined requests are still being answered, so drop
+            # the body and refuse in turn, from process()
+            return
+        self.channel.transport.write(
+            b"HTTP/1.1 503 Service Unavailable\r\n"
+            b"Retry-After: 10\r\n"
+            b"Content-Type: text/plain\r\n"
+            b"Content-Length: " + str(len(_REFUSED)).encode("ascii") +
+            b"\r\nConnection: close\r\n\r\n" + _REFUSED)
+        self.channel.transport.loseConnection()
+        self._refused_early = True
+
+    def _upload_done(self, result):
+        # result is a Failure if the connection was lost first
+        self._upload.finish(result == None and self.code < 400)
+
+
+_REFUSED = b"Too many uploads from this address at once\n"
+
+
+class _Upload(object):
+    """Counts and hashes the body of one upload as it arrives."""
+
+    def __init__(self, limiter, client, path):
+        self._limiter = limiter
+        self._client = client
+        self._path = path
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def received(self, data):
+        self.size += len(data)
+        self.sha256.update(data)
+        self._limiter.stats.received(len(data))
+
+    def finish(self, ok):
+        self._limiter.stats.finished(self._client, ok)
+        if ok and self._limiter.uploaded != None:
+            path = unquote_to_bytes(self._path.split(b"?")[0])
+            if not isinstance(path, str):
+                path = path.decode("utf-8", "replace")
+            self._limiter.uploaded(path, self.size, self.sha256.hexdigest())
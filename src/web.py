@@ -6,9 +6,16 @@ Various classes to handle different parts of the URL tree.
 """
 
 import cgi
+import csv
+from datetime import datetime, timedelta
+import hashlib
 import json
+import metrics
 import scheduler
+import time
+import zlib
 
+from twisted.internet import defer
 from twisted.web import server, resource
 from twisted.web.template import Element, XMLFile
 from twisted.python.filepath import FilePath
@@ -17,12 +24,89 @@ from twisted.web.template import flattenString
 import os
 
 
+class JsonBody(object):
+    """A serialised JSON response with its strong ETags.
+
+    The gzip encoding is made the first time a client asks for it and then
+    kept, like the plain body.
+    """
+
+    def __init__(self, obj):
+        self.data = json.dumps(obj, sort_keys=True, separators=(",", ":"))
+        digest = hashlib.sha1(self.data.encode("utf-8")).hexdigest()[:20]
+        self.etag = '"%s"' % digest
+        # A different representation needs a different strong ETag
+        self.gzip_etag = '"%s-gz"' % digest
+        self._gzipped = None
+
+    def gzipped(self):
+        if self._gzipped == None:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._gzipped = compressor.compress(self.data.encode("utf-8")) + \
+                compressor.flush()
+        return self._gzipped
+
+
+class JsonCache(object):
+    """Serialised responses keyed by the version of the data behind them.
+
+    Keys include a version counter, so a stale body is never served; old
+    keys are simply dropped once there are more than max_entries.
+    """
+
+    max_entries = 32
+
+    def __init__(self):
+        self._bodies = {}
+        self._order = []
+
+    def get(self, key, build):
+        """Returns the JsonBody for key, calling build() for the data if needed."""
+        body = self._bodies.get(key)
+        if body == None:
+            body = JsonBody(build())
+            self._bodies[key] = body
+            self._order.append(key)
+            while len(self._order) > self.max_entries:
+                del self._bodies[self._order.pop(0)]
+        return body
+
+
+# Bodies smaller than this are not worth compressing
+GZIP_MIN_BYTES = 512
+
+
+def render_json(request, body):
+    """Writes the headers for a JsonBody and returns what to send.
+
+    Honours If-None-Match with a 304 and Accept-Encoding: gzip.
+    """
+    request.setHeader("Content-Type", "application/json")
+    request.setHeader("Cache-Control", "no-cache")
+    request.setHeader("Vary", "Accept-Encoding")
+    accept = request.getHeader("accept-encoding") or ""
+    use_gzip = "gzip" in accept and len(body.data) >= GZIP_MIN_BYTES
+    etag = body.gzip_etag if use_gzip else body.etag
+    request.setHeader("ETag", etag)
+    if_none_match = request.getHeader("if-none-match")
+    if if_none_match != None:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        if "*" in tags or etag in tags:
+            request.setResponseCode(304)
+            return ""
+    if use_gzip:
+        request.setHeader("Content-Encoding", "gzip")
+        return body.gzipped()
+    return body.data
+
+
 class RadioController(resource.Resource):
     isLeaf = False
     
     def __init__(self, services):
         resource.Resource.__init__(self)
         self.putChild("status", RadioStatus(services))
+        self.putChild("events", RadioEvents(services))
         self.putChild("stop", RadioStop(services))
         self.putChild("enable_irlp", RadioEnableIRLP(services))
         self.putChild("disable_irlp", RadioDisableIRLP(services))
@@ -38,22 +122,34 @@ class RadioLeaf(resource.Resource):
     isLeaf = True
     def __init__(self, services):
         self._s = services
+        self._cache = JsonCache()
         
         
 class RadioStatus(RadioLeaf):
     def render_GET(self, request):
-        status = {}
-        
-        status["ptt"] = self._s.radio.ptt_active()
-        status["ptt_locked"] = self._s.radio.ptt_locked_out()
-        status["irlp_active"] = self._s.radio.irlp_active()
-        status["echolink_active"] = self._s.radio.echolink_active()
-        
-        status["file_playing"] = self._s.player.current_file()
-        status["playback_status"] = self._s.player.playback_status()
-        status["progress"] = self._s.player.progress_string()
-        
-        return json.dumps(status, sort_keys=True, indent=4)
+        # Shared with every other client polling or streaming the status
+        publisher = self._s.status
+        publisher.status()
+        body = self._cache.get(publisher.version, publisher.status)
+        return render_json(request, body)
+
+
+class RadioEvents(RadioLeaf):
+    """Server-Sent Events stream of status changes.
+
+    The first message is the full status, later ones only the fields that
+    changed. See status.StatusPublisher.
+    """
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/event-stream")
+        request.setHeader("Cache-Control", "no-cache")
+        # Tell nginx and friends not to hold the stream back
+        request.setHeader("X-Accel-Buffering", "no")
+        request.write(self._s.status.subscribe(request.write))
+        finished = request.notifyFinish()
+        finished.addBoth(lambda _: self._s.status.unsubscribe(request.write))
+        return server.NOT_DONE_YET
     
 
 class RadioStop(RadioLeaf):
@@ -86,20 +182,207 @@ class RadioDisableEcholink(RadioLeaf):
         self._s.radio.echolink_off()
         return ""
 
-class HomePageTemplate(Element):
-    loader = XMLFile(FilePath('../templates/home.xml'))
-        
+class TemplateCache(object):
+    """The flattened output of a template Element, kept until it goes stale.
 
-class HomePage(resource.Resource):
+    element_class is the Element and template_path the file it is rendered
+    from; the file is loaded afresh whenever it changes. version(), if given, returns a counter for the data the
+    element shows, such as the library version. The template file is only
+    stat'ed once per check_interval, so a cached page is served without
+    touching the filesystem.
+    """
+
+    check_interval = 2.0
+
+    def __init__(self, element_class, template_path, version=None):
+        self._element_class = element_class
+        self._template_path = template_path
+        self._version = version
+        self._output = None
+        self._key = None
+        self._mtime = None
+        self._checked = 0
+        self._waiting = None
+
+    def warm(self):
+        """Renders now so the first request is served from the cache."""
+        return self.render()
+
+    def render(self):
+        """Returns a Deferred firing with the flattened page."""
+        key = self._current_key()
+        if self._output != None and key == self._key:
+            return defer.succeed(self._output)
+        if self._waiting != None:
+            d = defer.Deferred()
+            self._waiting.append(d)
+            return d
+        self._waiting = []
+        loader = XMLFile(FilePath(self._template_path))
+        d = flattenString(None, self._element_class(loader=loader))
+        d.addBoth(self._rendered, key)
+        return d
+
+    def cached(self):
+        """Returns the flattened page if it is still fresh, otherwise None."""
+        if self._output != None and self._current_key() == self._key:
+            return self._output
+        return None
+
+    # Private
+
+    def _current_key(self):
+        now = time.time()
+        if now - self._checked >= self.check_interval:
+            self._checked = now
+            try:
+                self._mtime = os.stat(self._template_path).st_mtime
+            except OSError:
+                self._mtime = None
+        version = self._version() if self._version != None else None
+        return (self._mtime, version)
+
+    def _rendered(self, output, key):
+        waiting = self._waiting
+        self._waiting = None
+        if isinstance(output, bytes):
+            self._output = output
+            self._key = key
+        for d in waiting:
+            d.callback(output)
+        return output
+
+
+class CachedPage(resource.Resource):
+    """Serves a page from a TemplateCache."""
     isLeaf = True
+
+    def __init__(self, cache):
+        resource.Resource.__init__(self)
+        self._cache = cache
+
+    def warm(self):
+        """Renders the page ahead of the first request."""
+        return self._cache.warm()
+
     def render_GET(self, request):
+        output = self._cache.cached()
+        if output != None:
+            return output
         def renderDone(output):
             request.write(output)
             request.finish()
-        flattenString(None, HomePageTemplate()).addCallback(renderDone)
+        def renderFailed(failure):
+            print("Could not render page: %s" % failure.getErrorMessage())
+            request.setResponseCode(500)
+            request.finish()
+        self._cache.render().addCallbacks(renderDone, renderFailed)
         return server.NOT_DONE_YET
 
 
+class HomePageTemplate(Element):
+    loader = XMLFile(FilePath('../templates/home.xml'))
+        
+
+class HomePage(CachedPage):
+    def __init__(self, cache=None):
+        if cache == None:
+            cache = TemplateCache(HomePageTemplate, '../templates/home.xml')
+        CachedPage.__init__(self, cache)
+
+
+
+class NodesController(resource.Resource):
+    """Lists the nodes and has /radio and /schedule for each under its name."""
+    isLeaf = False
+
+    def __init__(self, nodes):
+        resource.Resource.__init__(self)
+        self._nodes = nodes
+        for node in nodes:
+            self.putChild(node.name, NodeController(node))
+
+    def render_GET(self, request):
+        return render_json(request, JsonBody([n.describe() for n in self._nodes]))
+
+
+class NodeController(resource.Resource):
+    isLeaf = False
+
+    def __init__(self, node):
+        resource.Resource.__init__(self)
+        self.putChild("radio", RadioController(node))
+        self.putChild("schedule", ScheduleController(node))
+
+    def render_GET(self, request):
+        return ""
+
+
+class UploadStatus(resource.Resource):
+    """Upload counters and throughput from uploads.UploadStats."""
+    isLeaf = True
+
+    def __init__(self, services):
+        resource.Resource.__init__(self)
+        self._s = services
+
+    def render_GET(self, request):
+        return render_json(request, JsonBody(self._s.uploads.snapshot()))
+
+
+class Metrics(resource.Resource):
+    """Hot path metrics in the Prometheus text format, see metrics.py."""
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        return metrics.exposition().encode("utf-8")
+
+
+class TimedRequest(server.Request):
+    """Request that records how long it took into metrics.http_duration.
+
+    Labelled by the top level resource, plus the leaf under /radio and
+    /schedule or the node under /nodes, so the number of series stays fixed
+    whatever URLs are asked for; any that don't exist are labelled "other".
+    Streams such as /radio/events are timed until they end.
+    """
+
+    # Top level resources whose children are labelled separately
+    split_resources = ("radio", "schedule", "nodes")
+
+    def process(self):
+        self._started = time.time()
+        server.Request.process(self)
+
+    def finish(self):
+        started = getattr(self, "_started", None)
+        if started != None:
+            metrics.http_duration.observe(time.time() - started,
+                                          self._resource_label())
+        return server.Request.finish(self)
+
+    def _resource_label(self):
+        segments = [s.decode("utf-8", "replace") if isinstance(s, bytes)
+                    else s for s in self.prepath[:2]]
+        if not segments or not segments[0]:
+            return "/"
+        top = _child(self.site.resource, segments[0])
+        if top == None:
+            return "other"
+        if segments[0] in self.split_resources and len(segments) > 1:
+            # Only children that exist, anything else would be a new series
+            if _child(top, segments[1]) == None:
+                return "other"
+            return "/".join(segments)
+        return segments[0]
+
+
+def _child(parent, name):
+    # A static child of a resource, whichever type its name was put with
+    children = parent.children
+    return children.get(name, children.get(name.encode("utf-8")))
+
 
 class ScheduleController(resource.Resource):
     isLeaf = False
@@ -108,7 +391,9 @@ class ScheduleController(resource.Resource):
         resource.Resource.__init__(self)
         self.putChild("files", ScheduleFiles(services))
         self.putChild("new", ScheduleNew(services))
+        self.putChild("import", ScheduleImport(services))
         self.putChild("list", ScheduleList(services))
+        self.putChild("timeline", ScheduleTimeline(services))
         self.putChild("delete", ScheduleDelete(services))
         
     def render_GET(self, request):
@@ -117,33 +402,190 @@ class ScheduleController(resource.Resource):
     
 class ScheduleLeaf(resource.Resource):
     isLeaf = True
+
+    # Times in query arguments look like 2017-06-30T18:00:00
+    time_format = "%Y-%m-%dT%H:%M:%S"
+
     def __init__(self, services):
         self._s = services
+        self._cache = JsonCache()
+
+    def _arg(self, request, name, default=None):
+        values = request.args.get(name)
+        if not values or values[0] == "":
+            return default
+        return values[0]
+
+    def _time_arg(self, request, name):
+        value = self._arg(request, name)
+        if value == None:
+            return None
+        return datetime.strptime(value, self.time_format)
         
 class ScheduleFiles(ScheduleLeaf):
     def render_GET(self, request):
-        files = os.listdir('../files/')
-        return json.dumps(files, sort_keys=True, indent=4)
+        library = self._s.library
+        body = self._cache.get(library.version, library.filenames)
+        return render_json(request, body)
 
 class ScheduleNew(ScheduleLeaf):
     def render_POST(self, request):
         new_json = request.content.read()
         d = json.loads(new_json)
-        self._s.scheduler.add_new_schedule(d)
+        try:
+            self._s.scheduler.add_new_schedule(d)
+        except (ValueError, KeyError) as e:
+            # e.g. it overlaps another schedule
+            request.setResponseCode(400)
+            return scheduler.describe_error(e)
         return ""
         
+class ScheduleImport(ScheduleLeaf):
+    """Adds many schedules in one request.
+
+    The body is either a JSON list of the objects ScheduleNew takes, or CSV
+    with a header row and the columns date, time and playlist (entries
+    separated by ";"), plus optionally frequency, until and count for
+    recurring schedules and hard_start ("yes" or "1"). Valid schedules are
+    added even if others are not, and a result is returned for each, in
+    order. A body that is not a list of schedules is refused with a 400.
+    """
+
+    def render_POST(self, request):
+        body = request.content.read()
+        content_type = request.getHeader("content-type") or ""
+        try:
+            if "csv" in content_type or not body.lstrip().startswith(("[", "{")):
+                schedules = parse_schedule_csv(body)
+            else:
+                schedules = json.loads(body)
+                if isinstance(schedules, dict):
+                    schedules = schedules["schedules"]
+                if not isinstance(schedules, list) or \
+                        not all(isinstance(s, dict) for s in schedules):
+                    raise ValueError("expected a list of schedule objects")
+        except (ValueError, KeyError, csv.Error) as e:
+            request.setResponseCode(400)
+            return "Could not read schedules: %s" % e
+        results = self._s.scheduler.add_schedules(schedules)
+        added = len([r for r in results if r["ok"]])
+        print("Imported %d of %d schedules" % (added, len(results)))
+        summary = {"added": added, "failed": len(results) - added,
+                   "results": results}
+        return render_json(request, JsonBody(summary))
+
+
+def parse_schedule_csv(text):
+    """Turns CSV rows into the schedule objects ScheduleNew takes."""
+    schedules = []
+    for row in csv.DictReader(text.splitlines()):
+        row = dict((k.strip().lower(), (v or "").strip())
+                   for k, v in row.items() if k != None)
+        schedule = {
+            "date": row.get("date", ""),
+            "time": row.get("time", ""),
+            "playlist": [e.strip() for e in row.get("playlist", "").split(";")
+                         if e.strip()],
+        }
+        if row.get("frequency"):
+            schedule["recurrence"] = {
+                "frequency": row["frequency"],
+                "until": row.get("until"),
+                "count": row.get("count"),
+            }
+        if row.get("hard_start", "").lower() in ("1", "yes", "true"):
+            schedule["hard_start"] = True
+        schedules.append(schedule)
+    return schedules
+
+
 class ScheduleList(ScheduleLeaf):
+    """Pages through schedules ordered by start time.
+
+    Query arguments, all optional:
+      status  upcoming (the default), archived or all
+      from    only items starting at or after this time
+      to      only items starting before this time
+      cursor  next_cursor from the previous page
+      limit   items per page, at most max_limit
+    Times are given as 2017-06-30T18:00:00.
+    """
+
+    cursor_format = "%Y-%m-%dT%H:%M:%S.%f"
+    default_limit = 50
+    max_limit = 500
+
     def render_GET(self, request):
-        items = self._s.scheduler._items
+        try:
+            status = self._arg(request, "status", "upcoming")
+            start = self._time_arg(request, "from")
+            end = self._time_arg(request, "to")
+            after = self._cursor_arg(request)
+            limit = int(self._arg(request, "limit", self.default_limit))
+            limit = max(1, min(limit, self.max_limit))
+            key = (self._s.scheduler.version, status, start, end, after, limit)
+            body = self._cache.get(key, lambda: self._page(status, start, end,
+                                                           after, limit))
+        except ValueError as e:
+            request.setResponseCode(400)
+            return str(e)
+        return render_json(request, body)
+
+    def _page(self, status, start, end, after, limit):
+        page, following = self._s.scheduler.query(status, start, end,
+                                                  after, limit)
         s_list = []
-        for i in items:
-            s_item = {}
-            s_item["identifier"] = i.identifier
-            s_item["playlist"] = [str(e) for e in i.playlist]
-            s_item["timestamp_string"] = i.start_time.strftime("%I:%M:%S %p %d/%m/%Y")
+        for summary in page:
+            s_item = dict(summary)
+            s_item["start_time"] = summary["start_time"].strftime(self.time_format)
             s_list.append(s_item)
-        return json.dumps(s_list, sort_keys=True, indent=4)
+        next_cursor = None
+        if following != None:
+            next_cursor = "%s|%s" % (following[0].strftime(self.cursor_format),
+                                     following[1])
+        return {"items": s_list, "next_cursor": next_cursor}
+
+    def _cursor_arg(self, request):
+        value = self._arg(request, "cursor")
+        if value == None:
+            return None
+        timestamp, separator, identifier = value.partition("|")
+        if not separator:
+            raise ValueError("Bad cursor: %s" % value)
+        return datetime.strptime(timestamp, self.cursor_format), identifier
     
+class ScheduleTimeline(ScheduleLeaf):
+    """Upcoming and on-air schedules whose time on air overlaps a range.
+
+    Query arguments from and to bound the range, defaulting to the start of
+    the current minute and a day after from. Each item has start_time and
+    end_time.
+    """
+
+    def render_GET(self, request):
+        try:
+            start = self._time_arg(request, "from")
+            if start == None:
+                # Whole minutes, so requests within one share a cached body
+                start = datetime.now().replace(second=0, microsecond=0)
+            end = self._time_arg(request, "to") or start + timedelta(days=1)
+        except ValueError as e:
+            request.setResponseCode(400)
+            return str(e)
+        key = (self._s.scheduler.version, start, end)
+        body = self._cache.get(key, lambda: self._items(start, end))
+        return render_json(request, body)
+
+    def _items(self, start, end):
+        items = []
+        for summary in self._s.scheduler.timeline(start, end):
+            s_item = dict(summary)
+            s_item["start_time"] = summary["start_time"].strftime(self.time_format)
+            s_item["end_time"] = summary["end_time"].strftime(self.time_format)
+            items.append(s_item)
+        return items
+
+
 class ScheduleDelete(ScheduleLeaf):
     def render_POST(self, request):
         identifier = request.content.read()
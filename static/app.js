@@ -1,5 +1,13 @@
 var files_cache = null;
 
+// The node being controlled, from ?node=name. Without one the API at / is
+// used, which is the first node.
+var node_name = (function() {
+    var match = /[?&]node=([^&]*)/.exec(window.location.search);
+    return match ? decodeURIComponent(match[1]) : null;
+})();
+var api_base = node_name ? "/nodes/" + encodeURIComponent(node_name) : "";
+
 
 
 function chooseFile(el, filename) {
@@ -36,23 +44,66 @@ $(document).ready(function() {
         showSeconds: true
 	});
 
-    do_radio_status_update();
+    $("#node-select").on("change", function() {
+        window.location.search = "?node=" + encodeURIComponent($(this).val());
+    });
+
+    loadNodes();
+    start_radio_status_stream();
     refreshSchedules();
 });
 
 
+// Nodes
+
+// Fills the node picker, which is only shown if there is more than one
+function loadNodes() {
+    $.ajax("/nodes", {dataType: "json"}).done(function(data, status, jqXHR) {
+        if (data.length < 2) return;
+        var select = $("#node-select");
+        select.empty();
+        $.each(data, function(i, node) {
+            select.append($("<option>").val(node.name).text(node.name));
+        });
+        select.val(node_name ? node_name : data[0].name);
+        $("#node-picker").show();
+    });
+}
+
+
 // Radio state updates
 
+var radio_status = {};
+
+// The server pushes changes to the status as they happen. Browsers without
+// EventSource, or a stream that fails, fall back to polling.
+function start_radio_status_stream() {
+    if (!window.EventSource) {
+        do_radio_status_update();
+        return;
+    }
+    var source = new EventSource(api_base + "/radio/events");
+    var opened = false;
+    source.onopen = function() {
+        opened = true;
+    };
+    source.onmessage = function(event) {
+        applyRadioStatus(JSON.parse(event.data));
+    };
+    source.onerror = function() {
+        if (!opened) {
+            // Never connected, the server probably doesn't stream
+            source.close();
+            do_radio_status_update();
+        }
+        // Otherwise EventSource reconnects by itself
+    };
+}
+
 // The regularly-run function to do updates
 function do_radio_status_update() {
-    $.ajax("/radio/status").done(function(data, status, jqXHR) {
-        var s = JSON.parse(data)
-        updateInternetFunctionState("echolink", s.echolink_active);
-        updateInternetFunctionState("irlp", s.irlp_active);
-        updatePTTState(s.ptt);
-        updatePlaybackState(s.playback_status);
-        updatePlayingFile(s.file_playing);
-        updatePlaybackProgress(s.progress);
+    $.ajax(api_base + "/radio/status", {dataType: "json"}).done(function(data, status, jqXHR) {
+        applyRadioStatus(data);
 
         setTimeout(function() {
             do_radio_status_update();
@@ -60,6 +111,24 @@ function do_radio_status_update() {
     });
 }
 
+// Merges a full or partial status into the page
+function applyRadioStatus(changes) {
+    var schedules_changed = "schedule_version" in changes &&
+        "schedule_version" in radio_status &&
+        changes.schedule_version != radio_status.schedule_version;
+    $.extend(radio_status, changes);
+    var s = radio_status;
+    updateInternetFunctionState("echolink", s.echolink_active);
+    updateInternetFunctionState("irlp", s.irlp_active);
+    updatePTTState(s.ptt);
+    updatePlaybackState(s.playback_status);
+    updatePlayingFile(s.file_playing);
+    updatePlaybackProgress(s.progress);
+    if (schedules_changed) {
+        refreshSchedules();
+    }
+}
+
 
 // Functions to update state of page
 
@@ -121,23 +190,23 @@ function updatePlaybackProgress(progress) {
 // In general we just fire a command at the server and wait for something to happen in our one-second updates
 
 function stopTxNowClicked() {
-    $.post("/radio/stop");
+    $.post(api_base + "/radio/stop");
 }
 
 function enableIRLPClicked() {
-    $.post("/radio/enable_irlp");
+    $.post(api_base + "/radio/enable_irlp");
 }
 
 function disableIRLPClicked() {
-    $.post("/radio/disable_irlp");
+    $.post(api_base + "/radio/disable_irlp");
 }
 
 function enableEcholinkClicked() {
-    $.post("/radio/enable_echolink");
+    $.post(api_base + "/radio/enable_echolink");
 }
 
 function disableEcholinkClicked() {
-    $.post("/radio/disable_echolink");
+    $.post(api_base + "/radio/disable_echolink");
 }
 
 
@@ -198,8 +267,8 @@ function removeItemFromPlaylist(ev) {
 }
 
 function updateFilesCache() {
-    $.ajax("/schedule/files").done(function(data, status, jqXHR) {
-        files_cache = JSON.parse(data)
+    $.ajax(api_base + "/schedule/files", {dataType: "json"}).done(function(data, status, jqXHR) {
+        files_cache = data;
         updateFilesInFields();
     });
 }
@@ -250,18 +319,46 @@ function submitPlaylist() {
     new_schedule.date = date;
     new_schedule.time = time;
 
-    $.post("/schedule/new", JSON.stringify(new_schedule), function(data, status) {
+    var repeat = $("#new-schedule-repeat").val();
+    if (repeat) {
+        new_schedule.recurrence = {
+            frequency: repeat,
+            until: $("#new-schedule-until").val()
+        };
+    }
+
+    if ($("#new-schedule-hard-start").is(":checked")) {
+        new_schedule.hard_start = true;
+    }
+
+    $.post(api_base + "/schedule/new", JSON.stringify(new_schedule), function(data, status) {
         refreshSchedules();
+    }).fail(function(jqXHR) {
+        bootbox.alert("Could not add the schedule: " + jqXHR.responseText);
     });
     $("#testmodal").modal('hide');
 }
 
 function refreshSchedules() {
-    $.ajax("/schedule/list").done(function(data, status, jqXHR) {
-        var list = JSON.parse(data)
-        clearSchedules();
-        renderSchedules(list);
-    });
+    // Upcoming schedules only, following next_cursor until we have them all
+    var schedules = [];
+    var fetchPage = function(cursor) {
+        var args = {status: "upcoming"};
+        if (cursor) {
+            args.cursor = cursor;
+        }
+        $.ajax(api_base + "/schedule/list", {data: args, dataType: "json"}).done(function(data, status, jqXHR) {
+            var page = data;
+            schedules = schedules.concat(page.items);
+            if (page.next_cursor) {
+                fetchPage(page.next_cursor);
+            } else {
+                clearSchedules();
+                renderSchedules(schedules);
+            }
+        });
+    };
+    fetchPage(null);
 }
 
 function clearSchedules() {
@@ -272,6 +369,12 @@ function renderSchedules(list) {
     for (var i = 0; i < list.length; i++) {
         var entry = list[i];
         var timestamp = entry["timestamp_string"];
+        if (entry["recurrence"]) {
+            timestamp += "<br/>(" + entry["recurrence"] + ")";
+        }
+        if (entry["hard_start"]) {
+            timestamp += "<br/>(hard start)";
+        }
         var identifier = entry["identifier"];
         var playlist = entry["playlist"];
         var playlist_html = "<ul>\n";
@@ -296,7 +399,7 @@ function renderSchedules(list) {
 function confirmDeleteSchedule(item) {
     bootbox.confirm("Are you sure you want to delete this schedule?", function(result) {
         if (result) {
-            $.post("/schedule/delete", item, function(data, status) {
+            $.post(api_base + "/schedule/delete", item, function(data, status) {
                 console.log("HELLO");
                 refreshSchedules();
             });